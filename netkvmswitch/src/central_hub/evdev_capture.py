@@ -0,0 +1,152 @@
+# Hub input capture straight from Linux evdev devices (needs python-evdev)
+#
+# Reads the kernel's event stream instead of going through pynput's
+# listener callbacks, and can grab the devices (EVIOCGRAB) so apps on the
+# hub stop receiving input meant for the remote machine. The hub needs read
+# access to /dev/input/event* (e.g. membership of the input group).
+
+import select
+import threading
+
+from evdev import InputDevice, ecodes, list_devices
+
+try:
+    from ..common.input_keys import BUTTONS, CHARACTER_KEYS, NAMED_KEYS, UNSHIFTED_CHARACTERS
+    from ..common.protocol import MessageType
+except ImportError:  # central_hub imported as a top-level package, with src on the path (the tests)
+    from common.input_keys import BUTTONS, CHARACTER_KEYS, NAMED_KEYS, UNSHIFTED_CHARACTERS
+    from common.protocol import MessageType
+
+# Toggles the grab while grabbing is enabled, like the hotkey of a hardware KVM
+GRAB_TOGGLE_KEY = ecodes.KEY_SCROLLLOCK
+
+def build_capture_key_table():
+    """evdev key codes to the strings agents expect ("a", "Key.shift", ...), resolved once."""
+    table = {}
+    for name, key in NAMED_KEYS.items():
+        table.setdefault(ecodes.ecodes[key], f"Key.{name}")  # First name wins, e.g. "shift" over "shift_l"
+    for char in UNSHIFTED_CHARACTERS:
+        table.setdefault(ecodes.ecodes[CHARACTER_KEYS[char]], char)
+    return table
+
+def find_input_devices():
+    """Keyboards and mice, leaving out the virtual devices agents inject through."""
+    devices = []
+    for path in list_devices():
+        device = InputDevice(path)
+        capabilities = device.capabilities()
+        keys = capabilities.get(ecodes.EV_KEY, [])
+        is_keyboard = ecodes.KEY_A in keys
+        is_mouse = ecodes.BTN_LEFT in keys and ecodes.REL_X in capabilities.get(ecodes.EV_REL, [])
+        if (is_keyboard or is_mouse) and not device.name.startswith("NetKVM"):
+            devices.append(device)
+        else:
+            device.close()
+    return devices
+
+class EvdevCapture:
+    """
+    Turns raw evdev events into the hub's KEY_EVENT / MOUSE_EVENT payloads
+    and hands them to send_event(msg_type, payload). Relative motion is
+    accumulated per SYN_REPORT frame, so each frame yields at most one move;
+    the pointer position is tracked within the hub's desktop geometry, as a
+    grabbed mouse no longer moves the hub's own pointer.
+    """
+    def __init__(self, send_event, devices=None, grab=False, geometry=(0, 0, 1920, 1080)):
+        self.send_event = send_event
+        self.devices = devices
+        self.grab_enabled = grab  # Whether grabbing is configured at all
+        self.grabbed = False
+        self.keys = build_capture_key_table()
+        self.buttons = {ecodes.ecodes[code]: name for name, code in BUTTONS.items()}
+        self.frames = {}  # Device fd -> pending [dx, dy, wheel, hwheel]
+        self.running = False
+        self.thread = None
+        self.set_geometry(*geometry)
+
+    def set_geometry(self, left, top, width, height):
+        self.left, self.top, self.right, self.bottom = left, top, left + width - 1, top + height - 1
+        self.x, self.y = left + width // 2, top + height // 2
+
+    def start(self):
+        if self.devices is None:
+            self.devices = find_input_devices()
+        print(f"evdev input capture on: {', '.join(device.name for device in self.devices) or 'no devices'}")
+        self.set_grab(self.grab_enabled)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+        self.set_grab(False)
+        for device in self.devices or []:
+            device.close()
+
+    def set_grab(self, grab):
+        """Grabs or releases every device (only ever grabs when grabbing is configured)."""
+        grab = grab and self.grab_enabled
+        if grab == self.grabbed:
+            return
+        for device in self.devices or []:
+            try:
+                device.grab() if grab else device.ungrab()
+            except OSError as e:
+                print(f"Could not {'grab' if grab else 'release'} {device.name}: {e}")
+        self.grabbed = grab
+        print(f"Input devices {'grabbed' if grab else 'released'}.")
+
+    def _run(self):
+        devices = {device.fd: device for device in self.devices}
+        while self.running and devices:
+            ready, _, _ = select.select(list(devices), [], [], 0.2)
+            for fd in ready:
+                try:
+                    # Everything the kernel has queued for the device, in batched reads
+                    events = list(devices[fd].read())
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    print(f"Input device {devices[fd].name} removed: {e}")
+                    del devices[fd]
+                    continue
+                self.handle_events(fd, events)
+
+    def handle_events(self, source, events):
+        frame = self.frames.setdefault(source, [0, 0, 0, 0])
+        for event in events:
+            if event.type == ecodes.EV_KEY:
+                button = self.buttons.get(event.code)
+                if button is not None:
+                    self._flush_motion(frame)  # The click lands where this frame moved to
+                    self.send_event(MessageType.MOUSE_EVENT, {"event_type": "click", "x": self.x, "y": self.y,
+                                                              "button": button, "pressed": event.value != 0})
+                elif event.code == GRAB_TOGGLE_KEY and self.grab_enabled:
+                    if event.value == 1:
+                        self.set_grab(not self.grabbed)
+                else:
+                    key = self.keys.get(event.code)
+                    if key is not None:
+                        # Autorepeat (value 2) is a repeated press, as with pynput
+                        self.send_event(MessageType.KEY_EVENT,
+                                        {"event_type": "release" if event.value == 0 else "press", "key": key})
+            elif event.type == ecodes.EV_REL:
+                if event.code == ecodes.REL_X: frame[0] += event.value
+                elif event.code == ecodes.REL_Y: frame[1] += event.value
+                elif event.code == ecodes.REL_WHEEL: frame[2] += event.value
+                elif event.code == ecodes.REL_HWHEEL: frame[3] += event.value
+            elif event.type == ecodes.EV_SYN and event.code == ecodes.SYN_REPORT:
+                self._flush_motion(frame)
+
+    def _flush_motion(self, frame):
+        dx, dy, wheel, hwheel = frame
+        if dx or dy:
+            self.x = min(self.right, max(self.left, self.x + dx))
+            self.y = min(self.bottom, max(self.top, self.y + dy))
+            self.send_event(MessageType.MOUSE_EVENT, {"event_type": "move", "x": self.x, "y": self.y})
+        if wheel or hwheel:
+            self.send_event(MessageType.MOUSE_EVENT, {"event_type": "scroll", "x": self.x, "y": self.y,
+                                                      "dx": hwheel, "dy": wheel})
+        frame[:] = [0, 0, 0, 0]
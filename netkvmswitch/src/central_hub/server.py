@@ -11,15 +11,24 @@ import ssl
 import sys
 import os
 import serial
-import serial.tools.list_ports
 import base64
 import av
 
-from ..common.protocol import MessageType, create_message, parse_message
-from ..common.serial_protocol import send_framed, receive_framed
+from ..common.protocol import (MessageType, MessageReader, StreamProfile, VideoLayer, DEFAULT_STREAM_ID,
+                               DESKTOP_STREAM_ID, create_message, parse_message)
+from ..common.serial_protocol import FrameReader, send_framed, decode_control, FrameType, FrameFlags
+from ..common.baud_negotiation import negotiate_baudrate, parse_baudrates
+from ..common.file_transfer import HUB, FileTransferChannel, transfer_directory
+from ..common.clipboard import TEXT, ClipboardChannel, LocalClipboard, PasteKeys, create_clipboard
 from ..common.config import config
 from .state_manager import StateManager
-from ..common.utils import resource_path
+from .usb_discovery import PortFilter, SerialDiscovery
+from ..common.utils import resource_path, user_data_path
+
+# How long a video connection may wait for its agent's CLIENT_HELLO (seconds)
+VIDEO_ASSOCIATION_TIMEOUT = 2.0
+# Cursor shapes kept per agent for UIs that connect later, least recently used dropped first
+MAX_CURSOR_SHAPES = 16
 
 def recv_all(sock, n):
     """Helper function to receive n bytes from a socket."""
@@ -44,12 +53,27 @@ class CentralHubServer:
         self.running = False
         self.input_forwarding_enabled = True
 
-        self.state_manager = StateManager()
+        self.state_manager = StateManager(session_file=user_data_path('hub_session.json'))
         self.ui_video_clients = []
         self.ui_video_clients_lock = threading.Lock()
+        # Number of browsers watching, as reported by the web UI (None = unknown)
+        self.ui_viewer_count = None
+        # Sources some browser shows large, as reported by the web UI (None = unknown)
+        self.main_layer_demand = None
+        self.stream_profile_lock = threading.Lock()
 
         self.keyboard_listener = None
         self.mouse_listener = None
+        self.evdev_capture = None
+        self.usb_discovery = None
+        self.hub_desktop = None  # (left, top, width, height) of the hub's desktop, for captured pointer positions
+        # Clipboard sync: the newest clipboard, the hub's own or an agent's, goes to the active agent
+        interval = config.server.clipboard_poll_interval
+        self.clipboard = LocalClipboard(create_clipboard() if interval > 0 else None, self._on_hub_clipboard, interval)
+        self.clipboard_current = None  # Announcement of the newest clipboard
+        self.clipboard_source = None  # Address of the agent it was copied on; None for the hub's own
+        self.clipboard_fetch_lock = threading.Lock()
+        self.hub_paste_keys = PasteKeys()
 
     def start(self):
         if config.security.use_tls:
@@ -98,13 +122,15 @@ class CentralHubServer:
         threading.Thread(target=self._accept_ui_connections, daemon=True).start()
         threading.Thread(target=self._accept_video_connections, daemon=True).start()
         threading.Thread(target=self._accept_ui_video_connections, daemon=True).start()
-        threading.Thread(target=self._listen_for_usb_agents, daemon=True).start()
+        self._start_usb_discovery()
         self._start_input_listeners()
+        self.clipboard.start()
 
     def _accept_connections(self):
         while self.running:
             try:
                 conn, addr = self.server_socket.accept()
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 print(f"Accepted connection from {addr}")
                 threading.Thread(target=self._handle_client, args=(conn, addr), daemon=True).start()
                 self._send_server_ack(conn)
@@ -154,6 +180,9 @@ class CentralHubServer:
             conn.close()
         except:
             pass
+        self.ui_viewer_count = None
+        self.main_layer_demand = None
+        self._update_stream_profiles()
 
     def _process_ui_command(self, message):
         cmd_type = message.get("type")
@@ -165,7 +194,9 @@ class CentralHubServer:
                 clients[str(addr)] = {
                     "name": info.get("name", "Unknown"),
                     "address": str(addr),
-                    "is_active": addr == self.state_manager.get_active_client()
+                    "is_active": addr == self.state_manager.get_active_client(),
+                    "simulcast": bool(info.get("simulcast")),
+                    "streams": info.get("streams", [{"id": DEFAULT_STREAM_ID}]),
                 }
             return {"clients": clients}
         
@@ -173,11 +204,11 @@ class CentralHubServer:
             addr_str = payload.get("address")
             if addr_str:
                 try:
-                    addr_str = addr_str.strip("()'\" ")
-                    ip, port = addr_str.split(", ")
-                    addr = (ip.strip("'\" "), int(port))
+                    addr = self._parse_address(addr_str)
                     
                     if self.state_manager.set_active_client(addr):
+                        self._request_keyframe(addr)
+                        self._update_stream_profiles()
                         return {"success": True, "message": f"Active client set to {addr}"}
                     else:
                         return {"success": False, "message": "Client not found"}
@@ -201,6 +232,9 @@ class CentralHubServer:
         elif cmd_type == "set_input_forwarding":
             enabled = payload.get("enabled", False)
             self.input_forwarding_enabled = bool(enabled)
+            if self.evdev_capture:
+                # Hub apps get their input back while nothing is forwarded
+                self.evdev_capture.set_grab(self.input_forwarding_enabled)
             print(f"Input forwarding {'enabled' if self.input_forwarding_enabled else 'disabled'}.")
             return {"success": True, "enabled": self.input_forwarding_enabled}
             
@@ -211,7 +245,7 @@ class CentralHubServer:
                 if client_info and client_info.get("type") != "USB":
                     try:
                         shutdown_msg = create_message(MessageType.SHUTDOWN, {})
-                        client_info["conn"].sendall(shutdown_msg)
+                        self._send_control(client_info, shutdown_msg)
                         return {"success": True, "message": f"Shutdown signal sent to {active_client_addr}"}
                     except Exception as e:
                         return {"success": False, "message": f"Failed to send shutdown signal: {e}"}
@@ -224,29 +258,93 @@ class CentralHubServer:
             addr_str = payload.get("address")
             if addr_str:
                 try:
-                    addr_str = addr_str.strip("()'\" ")
-                    ip, port = addr_str.split(", ")
-                    addr = (ip.strip("'\" "), int(port))
+                    addr = self._parse_address(addr_str)
                     
                     client_info = self.state_manager.get_client_info(addr)
                     if client_info:
                         restart_msg = create_message(MessageType.RESTART, {})
-                        client_info["conn"].sendall(restart_msg)
+                        self._send_control(client_info, restart_msg)
                         return {"success": True, "message": f"Restart signal sent to {addr}"}
                     else:
                         return {"success": False, "message": "Client not found"}
                 except Exception as e:
                     return {"success": False, "message": f"Invalid address or failed to send: {e}"}
         
+        elif cmd_type == "request_keyframe":
+            # Sent by the UI when a viewer (re)subscribes or its decoder lost sync.
+            addr_str = payload.get("address")
+            if not addr_str:
+                for addr in list(self.state_manager.get_all_clients()):
+                    self._request_keyframe(addr)
+                return {"success": True}
+            try:
+                addr = self._parse_address(addr_str)
+                return {"success": self._request_keyframe(addr, stream_id=payload.get("stream"))}
+            except Exception as e:
+                return {"success": False, "message": f"Invalid address format: {e}"}
+
+        elif cmd_type == "set_focused_client":
+            addr_str = payload.get("address")
+            try:
+                addr = self._parse_address(addr_str) if addr_str else None
+            except Exception as e:
+                return {"success": False, "message": f"Invalid address format: {e}"}
+            self.state_manager.set_focused_client(addr)
+            self._update_stream_profiles()
+            return {"success": True}
+
+        elif cmd_type == "set_viewer_count":
+            was_watched = self._has_ui_viewers()
+            self.ui_viewer_count = int(payload.get("count", 0))
+            self._update_stream_profiles()
+            if not was_watched and self._has_ui_viewers():
+                # Cursor updates are not relayed while nobody watches
+                self._replay_cursor_state()
+            return {"success": True, "count": self.ui_viewer_count}
+
+        elif cmd_type == "set_layer_demand":
+            # Sources that at least one browser tile shows large
+            try:
+                self.main_layer_demand = {self._parse_address(a) for a in payload.get("main", [])}
+            except Exception as e:
+                return {"success": False, "message": f"Invalid address format: {e}"}
+            self._update_stream_profiles()
+            return {"success": True}
+
+        elif cmd_type in ("push_file", "pull_file"):
+            # Paths are on the hub for pushes and on the agent for pulls; rate in bytes/s
+            try:
+                files = self._file_channel(payload.get("address"))
+                rate = payload.get("rate")
+                if cmd_type == "push_file":
+                    transfer_id = files.push(payload.get("path", ""), rate)
+                else:
+                    transfer_id = files.pull(payload.get("path", ""), rate)
+                return {"success": True, "transfer": transfer_id}
+            except Exception as e:
+                return {"success": False, "message": str(e)}
+
+        elif cmd_type == "get_transfers":
+            transfers = []
+            for addr, client_info in list(self.state_manager.get_all_clients().items()):
+                if "files" in client_info:
+                    transfers += [dict(status, address=str(addr)) for status in client_info["files"].get_transfers()]
+            return {"transfers": transfers}
+
+        elif cmd_type == "cancel_transfer":
+            try:
+                files = self._file_channel(payload.get("address"))
+            except Exception as e:
+                return {"success": False, "message": str(e)}
+            return {"success": files.cancel(payload.get("transfer"))}
+
         elif cmd_type == "forward_io_event":
             target_address_str = payload.get("address")
             event_type = payload.get("event_type")
             event_payload = payload.get("payload")
             
             try:
-                addr_str = target_address_str.strip("()'\" ")
-                ip, port = addr_str.split(", ")
-                target_address = (ip.strip("'\" "), int(port))
+                target_address = self._parse_address(target_address_str)
                 
                 self._send_input_event_to_client(target_address, event_type, event_payload)
                 return {"success": True}
@@ -256,21 +354,16 @@ class CentralHubServer:
         return {"error": f"Unknown command: {cmd_type}"}
 
     def _handle_client(self, conn, addr):
+        reader = MessageReader()
         while self.running:
             try:
-                data = conn.recv(4096)
+                data = conn.recv(65536)  # File chunks arrive here too
                 if not data:
                     print(f"Client {addr} disconnected.")
                     self._remove_client(addr)
                     break
-                message = parse_message(data)
-                if message["type"] == MessageType.CLIENT_HELLO:
-                    client_name = message['payload'].get('name', 'Unknown')
-                    client_video_port = message['payload'].get('video_port')
-                    print(f"Client {addr} ({client_name}) sent hello. Video port: {client_video_port}")
-                    self.state_manager.add_client(addr, {"conn": conn, "name": client_name, "video_port": client_video_port})
-                    if not self.state_manager.get_active_client():
-                        self.state_manager.set_active_client(addr)
+                for message in reader.feed(data):
+                    self._handle_client_message(conn, addr, message)
 
             except ConnectionResetError:
                 print(f"Client {addr} forcibly closed the connection.")
@@ -282,6 +375,78 @@ class CentralHubServer:
                 self._remove_client(addr)
                 break
 
+    def _handle_client_message(self, conn, addr, message):
+        if message["type"] == MessageType.CLIENT_HELLO:
+            client_name = message['payload'].get('name', 'Unknown')
+            client_video_port = message['payload'].get('video_port')
+            simulcast = bool(message['payload'].get('simulcast', False))
+            # Each captured monitor is a separately addressable stream
+            streams = message['payload'].get('streams') or [{"id": DEFAULT_STREAM_ID}]
+            session = message['payload'].get('session')
+            print(f"Client {addr} ({client_name}) sent hello. Video port: {client_video_port}, streams: {len(streams)}")
+            previous_addr = self.state_manager.find_client_by_session(session) if session else None
+            if previous_addr and previous_addr != addr:
+                # The agent reconnected before its old connection timed out here
+                print(f"Client {addr} resumes the session of {previous_addr}; dropping the old connection.")
+                self._remove_client(previous_addr)
+            send_lock = threading.Lock()
+            files = FileTransferChannel(conn, send_lock, transfer_directory(config.server.file_transfer_dir),
+                                        config.server.file_transfer_rate,
+                                        progress=lambda status: self._relay_transfer(addr, status), role=HUB)
+            clipboard = ClipboardChannel(conn, send_lock, files.gate, self._provide_clipboard,
+                                         lambda payload: self._on_agent_clipboard(addr, payload))
+            if self.state_manager.add_client(addr, {"conn": conn, "send_lock": send_lock, "files": files,
+                                                    "clipboard": clipboard,
+                                                    "name": client_name, "video_port": client_video_port,
+                                                    "simulcast": simulcast, "streams": streams, "session": session}):
+                print(f"Client {addr} restored its session (active: {self.state_manager.get_active_client() == addr})")
+            if not self.state_manager.get_active_client():
+                self.state_manager.set_active_client(addr, chosen=False)
+            self._update_stream_profiles()
+            self._announce_clipboard()
+        elif message["type"] in (MessageType.CURSOR_SHAPE, MessageType.CURSOR_POSITION):
+            client_info = self.state_manager.get_client_info(addr)
+            if client_info is None:
+                return
+            payload = message["payload"]
+            # Kept so a UI that connects later can be brought up to date. Agents send each
+            # shape once, so the recently used ones are kept rather than only the current one.
+            shapes = client_info.setdefault("cursor_shapes", {})
+            if message["type"] == MessageType.CURSOR_SHAPE:
+                shapes.pop(payload["hash"], None)
+                shapes[payload["hash"]] = payload
+                while len(shapes) > MAX_CURSOR_SHAPES:
+                    del shapes[next(iter(shapes))]
+            else:
+                client_info["cursor"] = payload
+                if payload.get("shape") in shapes:
+                    shapes[payload["shape"]] = shapes.pop(payload["shape"])
+            if self._has_ui_viewers():
+                self._relay_cursor(addr, message["type"], payload)
+        else:
+            client_info = self.state_manager.get_client_info(addr)
+            if client_info and "files" in client_info and not client_info["clipboard"].handle(message):
+                client_info["files"].handle(message)
+
+    def _relay_transfer(self, client_addr, status):
+        """Sends a file transfer's progress to the UI."""
+        status = dict(status, address=str(client_addr))
+        self._forward_packet_to_ui(client_addr, create_message(MessageType.FILE_PROGRESS, status), 0,
+                                   VideoLayer.TRANSFER)
+
+    def _relay_cursor(self, client_addr, msg_type, payload):
+        stream_id = payload.get("stream")
+        self._forward_packet_to_ui(client_addr, create_message(msg_type, payload),
+                                   stream_id if stream_id is not None else 0, VideoLayer.CURSOR)
+
+    def _replay_cursor_state(self):
+        """Sends every known cursor shape and position to the UI."""
+        for client_addr, client_info in list(self.state_manager.get_all_clients().items()):
+            for shape in list(client_info.get("cursor_shapes", {}).values()):
+                self._relay_cursor(client_addr, MessageType.CURSOR_SHAPE, shape)
+            if client_info.get("cursor"):
+                self._relay_cursor(client_addr, MessageType.CURSOR_POSITION, client_info["cursor"])
+
     def _accept_video_connections(self):
         self.video_socket.listen(10)
         print(f"Video server listening on {self.host}:{self.video_port} (TCP)")
@@ -297,7 +462,12 @@ class CentralHubServer:
                 break
 
     def _handle_video_connection(self, conn, addr):
-        client_addr = self.state_manager.find_client_by_ip(addr[0])
+        # The agent connects video right after its hello, which may still be in flight
+        deadline = time.monotonic() + VIDEO_ASSOCIATION_TIMEOUT
+        client_addr = self.state_manager.find_client_by_ip(addr[0], without_video=True)
+        while not client_addr and self.running and time.monotonic() < deadline:
+            time.sleep(0.02)
+            client_addr = self.state_manager.find_client_by_ip(addr[0], without_video=True)
 
         if not client_addr:
             print(f"Error: Could not find matching control client for video connection from {addr}. Dropping.")
@@ -306,6 +476,8 @@ class CentralHubServer:
             
         print(f"Associated video connection from {addr} with control client {client_addr}")
         self.state_manager.add_video_socket(client_addr, conn)
+        # The stream may be joining mid-GOP (e.g. after a dropped video connection)
+        self._request_keyframe(client_addr, force=True)
 
         try:
             while self.running:
@@ -325,9 +497,16 @@ class CentralHubServer:
                     print(f"Video client {addr} disconnected (incomplete frame).")
                     break
                 
-                packet = av.Packet(frame_data)
-                
-                self._forward_packet_to_ui(client_addr, packet)
+                # Stream id (monitor) and simulcast layer, then H.264
+                stream_id, layer = frame_data[0], frame_data[1]
+                packet = memoryview(frame_data)[2:]
+                if layer == VideoLayer.RECONFIGURE:
+                    # Resolution change; forwarded so the UI resets its decoder
+                    geometry = parse_message(bytes(packet))["payload"]
+                    self.state_manager.update_stream_geometry(client_addr, geometry)
+                    print(f"Client {client_addr} stream {stream_id} reconfigured to {geometry.get('width')}x{geometry.get('height')}")
+
+                self._forward_packet_to_ui(client_addr, packet, stream_id, layer)
 
         except ConnectionResetError:
             print(f"Video connection from {addr} was forcibly closed.")
@@ -338,17 +517,18 @@ class CentralHubServer:
             self.state_manager.remove_video_socket(client_addr)
             conn.close()
 
-    def _forward_packet_to_ui(self, client_addr, packet):
+    def _forward_packet_to_ui(self, client_addr, packet, stream_id=DEFAULT_STREAM_ID, layer=VideoLayer.MAIN):
+        disconnected_clients = []
         with self.ui_video_clients_lock:
-            disconnected_clients = []
-            
+            if not self.ui_video_clients:
+                return  # Nobody is watching
             addr_str = str(client_addr)
             addr_bytes = addr_str.encode('utf-8')
             padded_addr = addr_bytes.ljust(40)
 
             h264_data = bytes(packet)
 
-            message_to_send = padded_addr + h264_data
+            message_to_send = padded_addr + bytes([stream_id, layer]) + h264_data
             
             size_header = len(message_to_send).to_bytes(4, 'big')
             full_message = size_header + message_to_send
@@ -363,6 +543,9 @@ class CentralHubServer:
             for client in disconnected_clients:
                 self.ui_video_clients.remove(client)
 
+        if disconnected_clients:
+            self._update_stream_profiles()
+
     def _accept_ui_video_connections(self):
         self.ui_video_socket.listen(5)
         while self.running:
@@ -371,6 +554,11 @@ class CentralHubServer:
                 print(f"UI video client connected from {addr}")
                 with self.ui_video_clients_lock:
                     self.ui_video_clients.append(conn)
+                self._update_stream_profiles()
+                self._replay_cursor_state()
+                # A new viewer can only start decoding at an IDR
+                for client_addr in list(self.state_manager.get_all_clients()):
+                    self._request_keyframe(client_addr)
             except Exception as e:
                 if self.running:
                     print(f"Error accepting UI video connection: {e}")
@@ -381,6 +569,9 @@ class CentralHubServer:
 
     def _remove_client(self, addr):
         client_info = self.state_manager.get_client_info(addr)
+        if client_info and "files" in client_info:
+            client_info["files"].close()
+            client_info["clipboard"].close()
         if client_info and "conn" in client_info:
             try:
                 client_info["conn"].close()
@@ -394,31 +585,172 @@ class CentralHubServer:
             self.state_manager.set_active_client(None)
             print("Active client disconnected. No active client now.")
 
+    def _file_channel(self, addr_str):
+        client_info = self.state_manager.get_client_info(self._parse_address(addr_str or ""))
+        if not client_info:
+            raise ValueError("Client not found")
+        if "files" not in client_info:
+            raise ValueError("File transfer needs a network agent")
+        return client_info["files"]
+
+    def _parse_address(self, addr_str):
+        """Parses the "('ip', port)" strings the UI uses to address clients (USB clients use "USB:<port>")."""
+        if addr_str.startswith("USB:"):
+            return addr_str
+        addr_str = addr_str.strip("()'\" ")
+        ip, port = addr_str.split(", ")
+        return (ip.strip("'\" "), int(port))
+
+    def _has_ui_viewers(self):
+        if self.ui_viewer_count is not None:
+            return self.ui_viewer_count > 0
+        with self.ui_video_clients_lock:
+            return len(self.ui_video_clients) > 0
+
+    def _stream_profile_for(self, addr, watched, simulcast=False):
+        if not watched:
+            return StreamProfile.PAUSED
+        if addr == self.state_manager.get_active_client():
+            return StreamProfile.FULL
+        if self.main_layer_demand is not None and addr in self.main_layer_demand:
+            return StreamProfile.FULL
+        if not simulcast and addr == self.state_manager.get_focused_client():
+            return StreamProfile.FULL
+        # Simulcast sources serve thumbnails from their own layer
+        return StreamProfile.PAUSED if simulcast else StreamProfile.THUMBNAIL
+
+    def _stream_status_payload(self, profile, simulcast=False, watched=True):
+        if profile == StreamProfile.FULL:
+            payload = {"profile": profile, "fps": config.server.active_stream_fps, "scale": 1.0}
+        elif profile == StreamProfile.THUMBNAIL:
+            payload = {"profile": profile, "fps": config.server.thumbnail_stream_fps,
+                       "scale": config.server.thumbnail_stream_scale}
+        else:
+            payload = {"profile": profile, "fps": 0}
+        if simulcast and watched:
+            payload["thumbnail"] = {"fps": config.server.thumbnail_stream_fps,
+                                    "scale": config.server.thumbnail_stream_scale}
+        return payload
+
+    def _update_stream_profiles(self):
+        """
+        Sends STREAM_STATUS to every agent whose profile changed: full quality
+        for the active or hovered client, a low-fps thumbnail for the rest,
+        and paused when no viewer is watching. Simulcast agents always send
+        their thumbnail layer while watched and only encode the main layer
+        when some viewer shows it large.
+        """
+        watched = self._has_ui_viewers()
+        with self.stream_profile_lock:
+            for addr, client_info in list(self.state_manager.get_all_clients().items()):
+                if client_info.get("type") == "USB":
+                    continue
+                simulcast = client_info.get("simulcast", False)
+                profile = self._stream_profile_for(addr, watched, simulcast)
+                payload = self._stream_status_payload(profile, simulcast, watched)
+                if client_info.get("stream_status") == payload:
+                    continue
+                try:
+                    status_msg = create_message(MessageType.STREAM_STATUS, payload)
+                    self._send_control(client_info, status_msg)
+                    client_info["stream_status"] = payload
+                except Exception as e:
+                    print(f"Error sending stream status to {addr}: {e}")
+
+    def _send_control(self, client_info, message):
+        # Input, stream control and file data from several threads share the connection
+        with client_info["send_lock"]:
+            client_info["conn"].sendall(message)
+
     def _send_server_ack(self, conn):
         ack_message = create_message(MessageType.SERVER_ACK, {"status": "connected"})
         conn.sendall(ack_message)
 
+    def _request_keyframe(self, client_addr, force=False, stream_id=None):
+        """
+        Asks a source agent to encode its next frame as an IDR so viewers can
+        resync without waiting for the natural GOP interval. Requests are
+        rate-limited per source (or per stream, when one is given) unless
+        force is set.
+        """
+        client_info = self.state_manager.get_client_info(client_addr)
+        if not client_info:
+            return False
+        interval = 0 if force else config.server.keyframe_request_interval
+        key = client_addr if stream_id is None else (client_addr, stream_id)
+        if not self.state_manager.should_request_keyframe(key, interval):
+            return False
+        payload = {} if stream_id is None else {"stream": stream_id}
+        try:
+            if client_info.get("type") == "USB":
+                return send_framed(client_info["conn"], {"type": MessageType.REQUEST_KEYFRAME, "payload": payload})
+            self._send_control(client_info, create_message(MessageType.REQUEST_KEYFRAME, payload))
+            return True
+        except Exception as e:
+            print(f"Error requesting keyframe from {client_addr}: {e}")
+            return False
+
     def set_active_client(self, addr):
         if self.state_manager.set_active_client(addr):
             print(f"Active client set to {addr}")
+            self._request_keyframe(addr)
+            self._update_stream_profiles()
             for client_addr, client_info in self.state_manager.get_all_clients().items():
+                if client_info.get("type") == "USB":
+                    continue
                 try:
                     switch_msg = create_message(MessageType.SWITCH_CLIENT, {"active_client": str(addr)})
-                    client_info["conn"].sendall(switch_msg)
+                    self._send_control(client_info, switch_msg)
                 except Exception as e:
                     print(f"Error notifying client {client_addr} about active client change: {e}")
+            self._announce_clipboard()
             return True
         else:
             print(f"Client {addr} not found.")
             return False
 
     def _start_input_listeners(self):
+        try:
+            from mss import mss
+            with mss() as sct:
+                desktop = sct.monitors[0]
+            self._set_hub_desktop((desktop['left'], desktop['top'], desktop['width'], desktop['height']))
+        except Exception as e:
+            print(f"Could not read the hub's desktop geometry; forwarding pointer positions as pixels: {e}")
+        if config.server.input_backend == "evdev":
+            try:
+                self._start_evdev_capture()
+                return
+            except Exception as e:
+                print(f"evdev input capture unavailable, using pynput listeners: {e}")
         self.keyboard_listener = keyboard.Listener(on_press=self._on_key_press, on_release=self._on_key_release)
         self.keyboard_listener.start()
         self.mouse_listener = mouse.Listener(on_click=self._on_mouse_click, on_scroll=self._on_mouse_scroll, on_move=self._on_mouse_move)
         self.mouse_listener.start()
         print("Started keyboard and mouse listeners.")
 
+    def _start_evdev_capture(self):
+        from .evdev_capture import EvdevCapture
+        self.evdev_capture = EvdevCapture(self._send_input_event, grab=config.server.input_grab,
+                                          geometry=self.hub_desktop or (0, 0, 1920, 1080))
+        self.evdev_capture.start()
+
+    def _set_hub_desktop(self, desktop):
+        left, top, width, height = desktop
+        self.hub_desktop = desktop
+        # Precomputed once: pixel to normalized scale, the last pixel mapping to 1.0
+        self.hub_desktop_transform = (left, top, 1.0 / max(1, width - 1), 1.0 / max(1, height - 1))
+
+    def _normalize_hub_position(self, payload):
+        """
+        Hub desktop pixels to a position normalized over the whole desktop, which
+        each agent maps onto its own desktop (see DESKTOP_STREAM_ID).
+        """
+        if self.hub_desktop is None or "x" not in payload or "stream" in payload:
+            return payload
+        left, top, scale_x, scale_y = self.hub_desktop_transform
+        return dict(payload, stream=DESKTOP_STREAM_ID, x=(payload["x"] - left) * scale_x, y=(payload["y"] - top) * scale_y)
+
     def _on_key_press(self, key):
         try:
             key_char = key.char if hasattr(key, 'char') else str(key)
@@ -443,11 +775,17 @@ class CentralHubServer:
         self._send_input_event(MessageType.MOUSE_EVENT, {"event_type": "move", "x": x, "y": y})
 
     def _send_input_event(self, event_type, payload):
+        # Modifiers are followed while forwarding too; only pastes into the hub's own programs fetch here
+        pasted = event_type == MessageType.KEY_EVENT and self.hub_paste_keys.feed(payload)
+        if pasted and not self.input_forwarding_enabled:
+            self._fetch_clipboard_for_hub()
         if not self.input_forwarding_enabled:
             return
 
         active_client_address = self.state_manager.get_active_client()
         if active_client_address:
+            if event_type == MessageType.MOUSE_EVENT:
+                payload = self._normalize_hub_position(payload)
             self._send_input_event_to_client(active_client_address, event_type, payload)
 
     def _send_input_event_to_client(self, client_address, event_type, payload):
@@ -462,71 +800,145 @@ class CentralHubServer:
                 if client_info.get("type") == "USB":
                     send_framed(client_info["conn"], {"type": event_type, "payload": payload})
                 else:
-                    client_info["conn"].sendall(message)
+                    self._send_control(client_info, message)
             except Exception as e:
                 print(f"Error sending {event_type} to client {client_address}: {e}")
                 self._remove_client(client_address)
 
-    def _listen_for_usb_agents(self):
-        print("[USB] Starting USB agent listener...")
-        known_ports = set()
-        while self.running:
-            try:
-                available_ports = {p.device for p in serial.tools.list_ports.comports()}
-                new_ports = available_ports - known_ports
-
-                for port in new_ports:
-                    print(f"[USB] New serial port detected: {port}")
-                    time.sleep(1)
-                    thread = threading.Thread(target=self._handle_usb_client, args=(port,), daemon=True)
-                    thread.start()
-
-                known_ports = available_ports
-            except Exception as e:
-                print(f"[USB] Error scanning for serial ports: {e}")
-            
-            time.sleep(5)
-    
-    def _handle_usb_client(self, port):
+    def _on_hub_clipboard(self, payload):
+        self.clipboard_current, self.clipboard_source = payload, None
+        self._announce_clipboard()
+
+    def _on_agent_clipboard(self, addr, payload):
+        """Text copied on the active agent is set here at once; larger content only when it is pasted."""
+        if addr != self.state_manager.get_active_client():
+            return  # Sync is with the active agent; the others' clipboards change without the user
+        self.clipboard_current, self.clipboard_source = payload, addr
+        if "text" in payload:
+            self.clipboard.write(TEXT, payload["text"].encode('utf-8'))
+
+    def _announce_clipboard(self):
+        """
+        Tells the active agent about the newest clipboard. Large content is
+        only announced, so switching agents never sends more than a hash, and
+        the channel skips announcements the agent already has.
+        """
+        active = self.state_manager.get_active_client()
+        client_info = self.state_manager.get_client_info(active) if active else None
+        if self.clipboard_current is None or not client_info or "clipboard" not in client_info:
+            return
+        try:
+            client_info["clipboard"].announce(self.clipboard_current)
+        except Exception as e:
+            print(f"Error announcing the clipboard to {active}: {e}")
+
+    def _provide_clipboard(self, digest):
+        """Content an agent pastes: the hub's own, or fetched from the agent it was copied on."""
+        with self.clipboard_fetch_lock:  # Pastes of the same content share one fetch
+            data = self.clipboard.content(digest)
+            current, source = self.clipboard_current, self.clipboard_source
+            if data is not None or current is None or current["hash"] != digest or source is None:
+                return data
+            client_info = self.state_manager.get_client_info(source)
+            if not client_info or "clipboard" not in client_info:
+                return None
+            data = client_info["clipboard"].fetch(digest)
+            if data is not None:
+                self.clipboard.write(current["mime"], data)  # The hub's clipboard has it from now on
+            return data
+
+    def _fetch_clipboard_for_hub(self):
+        """A paste on the hub: fetches large content copied on an agent, for the next paste."""
+        current = self.clipboard_current
+        if current is None or self.clipboard_source is None or self.clipboard.content(current["hash"]) is not None:
+            return
+        threading.Thread(target=self._provide_clipboard, args=(current["hash"],), daemon=True).start()
+
+    def _start_usb_discovery(self):
+        port_filter = PortFilter(config.server.usb_ids, config.server.usb_descriptions, config.server.usb_exclude)
+        self.usb_discovery = SerialDiscovery(self._probe_usb_port, port_filter,
+                                             workers=config.server.usb_probe_workers,
+                                             negative_ttl=config.server.usb_negative_cache_ttl)
+        self.usb_discovery.start()
+
+    def _probe_usb_port(self, port_info):
+        """Handshakes with a possible agent; on success its connection is served on a thread of its own."""
+        port = port_info.device
         print(f"[USB] Attempting to handshake with agent on {port}...")
         try:
             conn = serial.Serial(port, baudrate=115200, timeout=2)
         except serial.SerialException as e:
             print(f"[USB] Failed to open port {port}: {e}")
-            return
-
-        client_id = f"USB:{port}"
+            return False
 
         try:
-            handshake_payload = {"magic": "NETKVM_SERVER_HELLO"}
+            offered = parse_baudrates(config.server.usb_baudrates)
+            handshake_payload = {"magic": "NETKVM_SERVER_HELLO", "baudrates": offered}
             if not send_framed(conn, {"type": "handshake", "payload": handshake_payload}):
                 conn.close()
-                return
+                return False
 
-            response = receive_framed(conn)
+            reader = FrameReader(conn)
+            response = reader.receive_framed()
             if not response or response.get("payload", {}).get("magic") != "NETKVM_CLIENT_HELLO":
                 print(f"[USB] Handshake failed on {port}. Closing.")
                 conn.close()
-                return
+                return False
+            if "baudrates" in response["payload"]:  # Agents from before negotiation stay at the base rate
+                baudrate, measured = negotiate_baudrate(conn, reader, offered, response["payload"]["baudrates"])
+                link = f", probe measured {measured / 1000:.0f} kB/s" if measured else ""
+                print(f"[USB] Agent on {port} runs at {baudrate} baud{link}")
+        except Exception as e:
+            print(f"[USB] Error during handshake on {port}: {e}")
+            conn.close()
+            return False
+
+        threading.Thread(target=self._handle_usb_client, args=(port, conn, reader, response), daemon=True).start()
+        return True
 
+    def _handle_usb_client(self, port, conn, reader, response):
+        client_id = f"USB:{port}"
+
+        try:
             client_name = response['payload'].get('name', 'USB Agent')
             print(f"[USB] Handshake successful with {client_name} on {port}")
-            self.state_manager.add_client(client_id, {"conn": conn, "name": client_name, "type": "USB"})
+            self.state_manager.add_client(client_id, {"conn": conn, "name": client_name, "type": "USB",
+                                                     "baudrate": conn.baudrate})
 
+            codec = None
+            dropped = 0
             while self.running and client_id in self.state_manager.get_all_clients():
-                message = receive_framed(conn)
-                if message is None:
+                frame = reader.receive_frame()
+                if frame is None:
                     print(f"[USB] Agent {client_id} disconnected.")
                     break
+                if reader.dropped != dropped:
+                    # Later inter frames reference the lost one: resync at an IDR
+                    dropped = reader.dropped
+                    self._request_keyframe(client_id)
                 
-                if message.get("type") == MessageType.VIDEO_FRAME:
-                    frame_data = base64.b64decode(message["payload"]["frame"])
-                    np_arr = np.frombuffer(frame_data, np.uint8)
-                    frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-                    if frame is not None:
-                        self.state_manager.update_latest_frame(client_id, frame)
+                frame_type, flags, payload = frame
+                if frame_type in (FrameType.H264, FrameType.VIDEO):
+                    # Forwarded as they are (JPEG as an MJPEG stream) and only
+                    # decoded when someone asks for a snapshot
+                    frame_codec = "h264" if frame_type == FrameType.H264 else "mjpeg"
+                    if frame_codec != codec:
+                        codec = frame_codec
+                        self.state_manager.update_stream_geometry(client_id,
+                                                                  {"stream": DEFAULT_STREAM_ID, "codec": codec})
+                    self._forward_packet_to_ui(client_id, payload, DEFAULT_STREAM_ID, VideoLayer.MAIN)
+                    self.state_manager.update_latest_encoded(client_id, codec, payload,
+                                                             keyframe=bool(flags & FrameFlags.KEYFRAME))
+                elif frame_type == FrameType.CONTROL:
+                    message = decode_control(payload) or {}
+                    if message.get("type") == MessageType.STREAM_RECONFIGURE:
+                        self.state_manager.update_stream_geometry(client_id, message["payload"])
+                        self._forward_packet_to_ui(client_id, payload, message["payload"]["stream"],
+                                                   VideoLayer.RECONFIGURE)
+                    else:
+                        print(f"[USB] Received unexpected message from {client_id}: {message.get('type')}")
                 else:
-                    print(f"[USB] Received unexpected message from {client_id}: {message.get('type')}")
+                    print(f"[USB] Received unknown frame type {frame_type} from {client_id}")
 
         except Exception as e:
             print(f"[USB] Error handling client {client_id}: {e}")
@@ -535,6 +947,7 @@ class CentralHubServer:
             if conn.is_open:
                 conn.close()
             print(f"[USB] Closed connection on {port}")
+            self.usb_discovery.release(port)
 
     def stop(self):
         self.running = False
@@ -544,6 +957,11 @@ class CentralHubServer:
         if self.mouse_listener:
             self.mouse_listener.stop()
             self.mouse_listener.join()
+        if self.evdev_capture:
+            self.evdev_capture.stop()
+        if self.usb_discovery:
+            self.usb_discovery.stop()
+        self.clipboard.stop()
 
         for addr, client_info in list(self.state_manager.get_all_clients().items()):
             if "conn" in client_info:
@@ -0,0 +1,74 @@
+# Latest pictures of sources, decoded only when a snapshot is asked for
+
+import threading
+
+import av
+import cv2
+import numpy as np
+
+# H.264 kept since the last keyframe or snapshot; a source that goes longer
+# without either starts over at its next keyframe
+MAX_PENDING_BYTES = 8 * 1024 * 1024
+
+class SnapshotSource:
+    """
+    The latest video of one source, kept as it arrived. push() only stores
+    data, so a source nobody takes snapshots of costs no decoding at all.
+
+    An "mjpeg" source decodes its last JPEG on demand. An "h264" source
+    keeps the access units since its last keyframe (or since the previous
+    snapshot) and feeds them to a persistent decoder when a picture is
+    needed. Pictures are BGR arrays, like cv2.imdecode's.
+    """
+    def __init__(self, codec, max_pending_bytes=MAX_PENDING_BYTES):
+        self.codec = codec
+        self.max_pending_bytes = max_pending_bytes
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.restart = True  # The decoder must start over at the first pending access unit
+        self.decoder = None
+        self.latest = None
+        self.decoded = 0  # Pictures decoded, for measuring what snapshots cost
+
+    def push(self, data, keyframe=False):
+        with self.lock:
+            if self.codec == "mjpeg" or keyframe:
+                # Nothing before it is needed any more
+                self.pending = [bytes(data)]
+                self.pending_bytes = len(data)
+                self.restart = True
+            elif self.pending or not self.restart:
+                self.pending.append(bytes(data))
+                self.pending_bytes += len(data)
+                if self.pending_bytes > self.max_pending_bytes:
+                    self.pending, self.pending_bytes, self.restart = [], 0, True
+
+    def picture(self):
+        """The latest picture, decoding whatever arrived since the last call."""
+        with self.lock:
+            pending, self.pending, self.pending_bytes = self.pending, [], 0
+            restart, self.restart = self.restart, False
+            if not pending:
+                return self.latest
+            if self.codec == "mjpeg":
+                image = cv2.imdecode(np.frombuffer(pending[-1], np.uint8), cv2.IMREAD_COLOR)
+                if image is not None:
+                    self.latest = image
+                    self.decoded += 1
+                return self.latest
+            if restart or self.decoder is None:
+                self.decoder = av.CodecContext.create('h264', 'r')
+            try:
+                for data in pending:
+                    # Each access unit arrives whole, so no parser is needed
+                    for frame in self.decoder.decode(av.Packet(data)):
+                        self.latest = frame
+                        self.decoded += 1
+            except av.error.FFmpegError as e:
+                print(f"Could not decode a snapshot: {e}")
+                self.restart = True
+            if isinstance(self.latest, av.VideoFrame):
+                # Only the picture that is returned gets converted
+                self.latest = self.latest.to_ndarray(format='bgr24')
+            return self.latest
@@ -1,52 +1,183 @@
+import json
+import os
 import threading
+import time
+
+from .snapshots import SnapshotSource
+
+DEPARTED_SESSION_TTL = 600.0  # Seconds a departed agent's slot and active status are kept for it
+MAX_DEPARTED_SESSIONS = 64
 
 class StateManager:
-    def __init__(self):
+    def __init__(self, session_file=None, clock=time.monotonic):
         self.active_client = None
+        self.focused_client = None
         self.clients = {}
         self.latest_frames = {}
         self.frame_lock = threading.Lock()
+        self.last_keyframe_requests = {}
+        self.keyframe_lock = threading.Lock()
+        # Agents identify themselves with a session id that survives reconnects
+        self.departed_sessions = {}  # Session id -> {"slot": index, "active": bool, "choice": int, "left": time}
+        self.clock = clock
+        self.active_choices = 0  # Times the user picked an active client; restores yield to newer choices
+        self.session_file = session_file  # Remembers the active session across hub restarts
+        self.active_session = self._load_active_session()
 
     def add_client(self, client_id, client_info):
-        self.clients[client_id] = client_info
+        """
+        Adds a client. One resuming a session that left earlier gets its old
+        slot in the client order back, and becomes active again if it was
+        active (or was the active session before the hub restarted) and no
+        active client was picked since. Returns True when a previous
+        session was restored.
+        """
+        self._expire_departed_sessions()
+        session = client_info.get("session")
+        departed = self.departed_sessions.pop(session, None) if session else None
+        if departed is None:
+            self.clients[client_id] = client_info
+        else:
+            clients = [(key, info) for key, info in self.clients.items() if key != client_id]
+            clients.insert(min(departed["slot"], len(clients)), (client_id, client_info))
+            self.clients = dict(clients)
+        if departed is not None:
+            restore_active = departed["active"] and departed["choice"] == self.active_choices
+        else:
+            restore_active = session is not None and session == self.active_session and self.active_choices == 0
+        if restore_active:
+            self.active_client = client_id
+        return departed is not None or restore_active
+
+    def find_client_by_session(self, session):
+        for client_id, info in list(self.clients.items()):
+            if info.get("session") == session:
+                return client_id
+        return None
 
     def remove_client(self, client_id):
         if client_id in self.clients:
+            session = self.clients[client_id].get("session")
+            if session:
+                self.departed_sessions[session] = {"slot": list(self.clients).index(client_id),
+                                                   "active": self.active_client == client_id,
+                                                   "choice": self.active_choices, "left": self.clock()}
+                self._expire_departed_sessions()
             del self.clients[client_id]
+        if self.focused_client == client_id:
+            self.focused_client = None
         if client_id in self.latest_frames:
             with self.frame_lock:
                 del self.latest_frames[client_id]
+        with self.keyframe_lock:
+            # Keys are client ids or (client id, stream id) pairs
+            for key in list(self.last_keyframe_requests):
+                if key == client_id or (isinstance(key, tuple) and key[0] == client_id):
+                    del self.last_keyframe_requests[key]
 
-    def set_active_client(self, client_id):
+    def set_active_client(self, client_id, chosen=True):
+        """
+        chosen=False is the hub's own pick of a client while none is active:
+        it is not remembered across restarts, and a resuming session that
+        was active takes over from it.
+        """
         if client_id is None:
             self.active_client = None
             return True
         if client_id in self.clients:
             self.active_client = client_id
+            if not chosen:
+                return True
+            self.active_choices += 1
+            session = self.clients[client_id].get("session")
+            if session and session != self.active_session:
+                self.active_session = session
+                self._save_active_session()
             return True
         return False
 
+    def _expire_departed_sessions(self):
+        """Forgets sessions that left too long ago, and the oldest beyond the cap."""
+        cutoff = self.clock() - DEPARTED_SESSION_TTL
+        for session, departed in list(self.departed_sessions.items()):
+            if departed["left"] < cutoff or len(self.departed_sessions) > MAX_DEPARTED_SESSIONS:
+                del self.departed_sessions[session]
+
+    def _load_active_session(self):
+        if not self.session_file or not os.path.exists(self.session_file):
+            return None
+        try:
+            with open(self.session_file, 'r') as f:
+                return json.load(f).get("active_session")
+        except (OSError, ValueError):
+            return None
+
+    def _save_active_session(self):
+        if not self.session_file:
+            return
+        try:
+            with open(self.session_file, 'w') as f:
+                json.dump({"active_session": self.active_session}, f)
+        except OSError as e:
+            print(f"Could not save the active session: {e}")
+
     def get_active_client(self):
         return self.active_client
 
+    def set_focused_client(self, client_id):
+        """The client the UI pointer is hovering over, if any."""
+        self.focused_client = client_id if client_id in self.clients else None
+
+    def get_focused_client(self):
+        return self.focused_client
+
     def get_client_info(self, client_id):
         return self.clients.get(client_id)
 
     def get_all_clients(self):
         return self.clients
 
+    def update_stream_geometry(self, client_id, geometry):
+        """Applies a STREAM_RECONFIGURE payload to the client's stream list."""
+        client_info = self.clients.get(client_id)
+        if not client_info:
+            return False
+        streams = client_info.setdefault("streams", [])
+        for stream in streams:
+            if stream.get("id") == geometry["stream"]:
+                break
+        else:
+            stream = {"id": geometry["stream"]}
+            streams.append(stream)
+        stream.update({key: geometry[key] for key in ("left", "top", "width", "height", "codec") if key in geometry})
+        return True
+
     def update_latest_frame(self, client_id, frame):
         with self.frame_lock:
             self.latest_frames[client_id] = frame
 
+    def update_latest_encoded(self, client_id, codec, data, keyframe=False):
+        """Stores encoded video ("mjpeg" or "h264"); it is decoded only by get_latest_frame."""
+        with self.frame_lock:
+            source = self.latest_frames.get(client_id)
+            if not isinstance(source, SnapshotSource) or source.codec != codec:
+                source = self.latest_frames[client_id] = SnapshotSource(codec)
+        source.push(data, keyframe)
+
     def get_latest_frame(self, client_id):
         with self.frame_lock:
-            return self.latest_frames.get(client_id)
+            frame = self.latest_frames.get(client_id)
+        if isinstance(frame, SnapshotSource):
+            return frame.picture()
+        return frame
 
-    def find_client_by_ip(self, ip_address):
-        """Finds a client by its IP address. Assumes one client per IP."""
-        for client_id, info in self.clients.items():
-            if client_id[0] == ip_address:
+    def find_client_by_ip(self, ip_address, without_video=False):
+        """
+        Finds a client by its IP address. Assumes one client per IP, or with
+        without_video, one per IP still waiting for its video connection.
+        """
+        for client_id, info in list(self.clients.items()):
+            if client_id[0] == ip_address and not (without_video and 'video_conn' in info):
                 return client_id
         return None
 
@@ -58,4 +189,17 @@ class StateManager:
     def remove_video_socket(self, client_id):
         """Removes the video socket association from a client."""
         if client_id in self.clients and 'video_conn' in self.clients[client_id]:
-            del self.clients[client_id]['video_conn']
\ No newline at end of file
+            del self.clients[client_id]['video_conn']
+
+    def should_request_keyframe(self, client_id, min_interval):
+        """
+        Rate-limits keyframe requests per source. Returns True (and records the
+        request) if at least min_interval seconds passed since the last one.
+        """
+        now = time.monotonic()
+        with self.keyframe_lock:
+            last = self.last_keyframe_requests.get(client_id)
+            if last is not None and now - last < min_interval:
+                return False
+            self.last_keyframe_requests[client_id] = now
+            return True
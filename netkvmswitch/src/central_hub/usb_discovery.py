@@ -0,0 +1,233 @@
+# Finds USB serial agents: filtered, cached, concurrent probing of serial ports
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import serial.tools.list_ports
+
+# inotify(7)
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+# Device nodes that can be serial ports (ttyACM*, ttyUSB*, cu.usbmodem*, ...)
+SERIAL_NODE_PREFIXES = ("tty", "cu.", "rfcomm")
+
+def _parse_ids(spec):
+    """ "0483:5740, 2e8a:000a" -> {(0x0483, 0x5740), (0x2e8a, 0x000a)}; "*" matches any product."""
+    ids = set()
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        vid, _, pid = item.partition(":")
+        ids.add((int(vid, 16), None if pid in ("", "*") else int(pid, 16)))
+    return ids
+
+class PortFilter:
+    """
+    Which serial ports are worth a handshake. By default only USB devices
+    (ports with a vendor id) are probed, which leaves out legacy UARTs
+    like /dev/ttyS*. Ports can further be narrowed down to vendor/product
+    ids and to description substrings, and excluded by description
+    (modems, Bluetooth links...).
+    """
+    def __init__(self, ids="", descriptions="", exclude="modem,bluetooth"):
+        self.ids = _parse_ids(ids)
+        self.descriptions = [d.strip().lower() for d in descriptions.split(",") if d.strip()]
+        self.exclude = [d.strip().lower() for d in exclude.split(",") if d.strip()]
+
+    def matches(self, port):
+        if port.vid is None:
+            return False
+        if self.ids and (port.vid, port.pid) not in self.ids and (port.vid, None) not in self.ids:
+            return False
+        text = " ".join(filter(None, (port.description, port.manufacturer, port.product))).lower()
+        if any(word in text for word in self.exclude):
+            return False
+        return not self.descriptions or any(word in text for word in self.descriptions)
+
+def port_identity(port):
+    """What a negative cache entry is for: the device node and what is plugged into it."""
+    return port.device, port.vid, port.pid, port.serial_number
+
+class InotifyWatcher:
+    """Readable whenever serial device nodes appear, change or go away in a directory (Linux)."""
+    def __init__(self, path="/dev"):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"cannot watch {path}")
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Names of the serial nodes in the pending events."""
+        names = set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            if name.startswith(SERIAL_NODE_PREFIXES):
+                names.add(name)
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class SerialDiscovery:
+    """
+    Probes serial ports for USB agents. Ports are filtered first, handshakes
+    run concurrently on a bounded pool, and ports that failed one are not
+    probed again until their negative cache entry expires (or something
+    else is plugged into them). On Linux, new device nodes in /dev trigger
+    a scan right away through inotify; elsewhere the ports are polled.
+
+    probe(port) performs the handshake and returns True once it has taken
+    over the port; release(device) hands the port back when that agent
+    disconnects. Time from a port showing up to its handshake completing
+    is recorded in connect_times.
+    """
+    def __init__(self, probe, port_filter=None, workers=4, negative_ttl=60.0, poll_interval=5.0, settle=0.1,
+                 dev_dir="/dev", list_ports=serial.tools.list_ports.comports, clock=time.monotonic):
+        self.probe = probe
+        self.port_filter = port_filter or PortFilter()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="usb-probe")
+        self.negative_ttl = negative_ttl
+        self.poll_interval = poll_interval
+        self.settle = settle  # Lets udev finish setting up a node before it is opened
+        self.dev_dir = dev_dir
+        self.list_ports = list_ports
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.busy = set()  # Devices being probed or served
+        self.failed = {}  # port_identity -> expiry
+        self.first_seen = {}  # Device -> when it was first listed
+        self.connect_times = deque(maxlen=100)  # Seconds from detection to connection
+        self.running = False
+        self.thread = None
+        self.wake_r = self.wake_w = None  # Interrupts the wait between scans on stop()
+
+    def start(self):
+        self.running = True
+        self.wake_r, self.wake_w = os.pipe()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            os.write(self.wake_w, b"x")
+            self.thread.join(timeout=2)
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+            self.thread = None
+        self.pool.shutdown(wait=False)
+
+    def release(self, device):
+        """The agent on device disconnected; the port may be probed again."""
+        with self.lock:
+            self.busy.discard(device)
+            self.first_seen.pop(device, None)
+
+    def scan(self, detected=None, names=None):
+        """
+        Starts a probe of every matching port not busy or negatively cached.
+        detected is when the event that triggered the scan happened, if
+        earlier than now; names, if given, limits the probes to the ports
+        whose device nodes have those names. Returns the futures.
+        """
+        now = self.clock()
+        ports = self.list_ports()
+        futures = []
+        with self.lock:
+            present = {port.device for port in ports}
+            for device in list(self.first_seen):
+                if device not in present and device not in self.busy:
+                    del self.first_seen[device]
+            self.failed = {key: expiry for key, expiry in self.failed.items() if expiry > now and key[0] in present}
+            for port in ports:
+                if port.device in self.busy or port_identity(port) in self.failed:
+                    continue
+                if names is not None and os.path.basename(port.device) not in names:
+                    continue
+                if not self.port_filter.matches(port):
+                    continue
+                self.busy.add(port.device)
+                self.first_seen.setdefault(port.device, detected or now)
+                futures.append(self.pool.submit(self._probe, port))
+        return futures
+
+    def _probe(self, port):
+        try:
+            connected = self.probe(port)
+        except Exception as e:
+            print(f"[USB] Error probing {port.device}: {e}")
+            connected = False
+        with self.lock:
+            if connected:
+                elapsed = self.clock() - self.first_seen.get(port.device, self.clock())
+                self.connect_times.append(elapsed)
+                print(f"[USB] Agent on {port.device} connected {elapsed * 1000:.0f} ms after it appeared")
+            else:
+                self.busy.discard(port.device)
+                self.first_seen.pop(port.device, None)
+                self.failed[port_identity(port)] = self.clock() + self.negative_ttl
+        return connected
+
+    def _create_watcher(self):
+        if not os.path.isdir(self.dev_dir) or not hasattr(os, "O_CLOEXEC"):
+            return None
+        try:
+            return InotifyWatcher(self.dev_dir)
+        except (OSError, AttributeError) as e:
+            print(f"[USB] No hotplug notifications ({e}); polling serial ports every {self.poll_interval:g} s")
+            return None
+
+    def _run(self):
+        print("[USB] Starting USB agent discovery...")
+        watcher = self._create_watcher()
+        # With hotplug events, rescans are only needed for expiring cache entries
+        interval = min(self.negative_ttl, 30.0) if watcher else self.poll_interval
+        detected = names = None
+        try:
+            while self.running:
+                try:
+                    self.scan(detected, names)
+                except Exception as e:
+                    print(f"[USB] Error scanning for serial ports: {e}")
+                deadline = time.monotonic() + interval
+                while self.running:
+                    timeout = max(0.0, deadline - time.monotonic())
+                    ready, _, _ = select.select([self.wake_r] + ([watcher] if watcher else []), [], [], timeout)
+                    if watcher not in ready:
+                        detected = names = None  # Timeout or stop: a full scan
+                        break
+                    detected = self.clock()
+                    names = watcher.read()
+                    if names:
+                        time.sleep(self.settle)
+                        names |= watcher.read()  # Events of the same hotplug
+                        break
+                    # Nothing but non-serial nodes changed in /dev; not worth listing the ports
+        finally:
+            if watcher is not None:
+                watcher.close()
@@ -0,0 +1,204 @@
+# Baud rate negotiation between the hub and a USB agent, right after the handshake
+#
+# Both ends open the port at BASE_BAUDRATE and list the rates they support in
+# their hellos. The hub then tries the rates both support, fastest first:
+#
+#   hub   BAUD_SWITCH {baudrate, timeout}  ->  agent
+#   agent BAUD_SWITCH_ACK {accepted}       ->  hub      (both switch after this)
+#   hub   PROBE frames                     ->  agent, which echoes each one back
+#   hub   BAUD_CONFIRM {baudrate, ...}     ->  agent
+#   agent BAUD_CONFIRM_ACK                 ->  hub      (the rate is kept)
+#
+# The probe is verified end to end: every echo must come back intact, in
+# order, and before the trial times out. Whatever goes wrong at the new rate
+# (data garbled, a port that cannot be set to it, a lost confirmation), both
+# ends go back to the base rate once the trial's timeout has passed, and the
+# hub tries the next rate. BAUD_DONE ends a negotiation that kept none.
+
+import os
+import threading
+import time
+
+from .protocol import MessageType
+from .serial_protocol import FrameType, decode_control, send_frame, send_framed
+
+BASE_BAUDRATE = 115200
+PROBE_SECONDS = 0.05  # Probe data: this long at the nominal rate of the rate under test
+MIN_PROBE_BYTES = 4096
+MAX_PROBE_BYTES = 65536
+PROBE_FRAME_BYTES = 1024
+TRIAL_MARGIN = 0.5  # Seconds of a trial on top of the probe itself, for USB and scheduling latency
+CONFIRM_MARGIN = 0.2  # A confirmation is only sent with at least this much of the trial left
+ACK_TIMEOUT = 1.0
+POLL_INTERVAL = 0.05  # Port read timeout while negotiating, so deadlines are kept
+
+def parse_baudrates(spec):
+    """ "921600, 3000000" -> [3000000, 921600]; fastest first, without duplicates."""
+    if isinstance(spec, str):
+        spec = spec.split(",")
+    rates = set()
+    for item in spec:
+        try:
+            rate = int(str(item).strip())
+        except ValueError:
+            continue
+        if rate > 0:
+            rates.add(rate)
+    return sorted(rates, reverse=True)
+
+def _probe_size(baudrate):
+    return int(min(MAX_PROBE_BYTES, max(MIN_PROBE_BYTES, baudrate / 10 * PROBE_SECONDS)))
+
+def _set_baudrate(conn, baudrate):
+    try:
+        conn.baudrate = baudrate
+        return True
+    except (ValueError, OSError) as e:  # pyserial's SerialException is an OSError
+        print(f"Cannot set the serial port to {baudrate} baud: {e}")
+        return False
+
+def _revert(conn, reader, baudrate, deadline):
+    """Back to baudrate once the other end has given up on the trial too."""
+    if hasattr(conn, 'reset_output_buffer'):
+        conn.reset_output_buffer()
+    _set_baudrate(conn, baudrate)
+    time.sleep(max(0.0, deadline - time.monotonic()))
+    conn.reset_input_buffer()
+    reader.reset()
+
+def _wait_for(reader, msg_type, deadline):
+    """The payload of the next msg_type control message, or None if the deadline passes first."""
+    while time.monotonic() < deadline:
+        message = reader.receive_framed()
+        if message is not None and message.get("type") == msg_type:
+            return message.get("payload") or {}
+    return None
+
+def _probe(conn, reader, size, deadline):
+    """
+    Sends size bytes of PROBE frames and reads the echoes back. Returns the
+    bytes per second the link carried, or None unless every echo came back
+    intact and in order before the deadline.
+    """
+    payloads = [seq.to_bytes(4, 'big') + os.urandom(PROBE_FRAME_BYTES - 4)
+                for seq in range(-(-size // PROBE_FRAME_BYTES))]
+    dropped = reader.dropped
+    # Written from a thread of its own so the echoes are read while the probe is still going out
+    writer = threading.Thread(target=lambda: [send_frame(conn, FrameType.PROBE, p) for p in payloads], daemon=True)
+    started = time.monotonic()
+    writer.start()
+    try:
+        for expected in payloads:
+            while True:
+                if time.monotonic() >= deadline:
+                    return None
+                frame = reader.receive_frame()
+                if frame is not None and frame[0] == FrameType.PROBE:
+                    break
+            if frame[2] != expected or reader.dropped != dropped:
+                return None
+        return len(payloads) * PROBE_FRAME_BYTES / (time.monotonic() - started)
+    finally:
+        writer.join(timeout=max(0.0, deadline - time.monotonic()))
+
+def _try_baudrate(conn, reader, base, baudrate):
+    """Hub side of one trial; the probed bytes per second if both ends now run at baudrate, else None."""
+    size = _probe_size(baudrate)
+    trial = size * 10 / baudrate * 3 + TRIAL_MARGIN
+    if not send_framed(conn, {"type": MessageType.BAUD_SWITCH, "payload": {"baudrate": baudrate, "timeout": trial}}):
+        return None
+    ack = _wait_for(reader, MessageType.BAUD_SWITCH_ACK, time.monotonic() + ACK_TIMEOUT)
+    if ack is None:
+        # The agent may have switched with its ack lost on the way: wait out its trial
+        _revert(conn, reader, base, time.monotonic() + trial)
+        return None
+    if not ack.get("accepted"):
+        return None
+    # The agent switched as soon as its ack was out, so its trial ends no later than this one
+    deadline = time.monotonic() + trial
+    if _set_baudrate(conn, baudrate):
+        measured = _probe(conn, reader, size, deadline)
+        if measured and deadline - time.monotonic() > CONFIRM_MARGIN:
+            confirm = {"baudrate": baudrate, "bytes_per_second": measured}
+            if (send_framed(conn, {"type": MessageType.BAUD_CONFIRM, "payload": confirm})
+                    and _wait_for(reader, MessageType.BAUD_CONFIRM_ACK, deadline) is not None):
+                return measured
+    _revert(conn, reader, base, deadline + POLL_INTERVAL * 2)
+    return None
+
+def negotiate_baudrate(conn, reader, offered, agent_rates):
+    """
+    Hub side. Tries the rates in offered that the agent also supports,
+    fastest first, and keeps the first that passes its probe. Returns
+    (baudrate, bytes_per_second): the rate both ends now run at and the
+    throughput its probe measured (None when no faster rate was kept).
+    """
+    base = conn.baudrate
+    supported = set(parse_baudrates(agent_rates))
+    candidates = [rate for rate in parse_baudrates(offered) if rate in supported and rate > base]
+    timeout, conn.timeout = conn.timeout, POLL_INTERVAL
+    try:
+        for baudrate in candidates:
+            measured = _try_baudrate(conn, reader, base, baudrate)
+            if measured:
+                return baudrate, measured
+            print(f"{baudrate} baud failed its probe; trying the next rate")
+        send_framed(conn, {"type": MessageType.BAUD_DONE, "payload": {"baudrate": base}})
+        return base, None
+    finally:
+        conn.timeout = timeout
+
+def _serve_trial(conn, reader, baudrate, deadline):
+    """Agent side of one trial; the hub's BAUD_CONFIRM payload if it confirmed baudrate in time, else None."""
+    if not _set_baudrate(conn, baudrate):
+        return None
+    while time.monotonic() < deadline:
+        frame = reader.receive_frame()
+        if frame is None:
+            continue
+        frame_type, _, payload = frame
+        if frame_type == FrameType.PROBE:
+            send_frame(conn, FrameType.PROBE, payload)
+        elif frame_type == FrameType.CONTROL:
+            message = decode_control(payload)
+            confirm = (message or {}).get("payload") or {}
+            if (message or {}).get("type") == MessageType.BAUD_CONFIRM and confirm.get("baudrate") == baudrate:
+                send_framed(conn, {"type": MessageType.BAUD_CONFIRM_ACK, "payload": {"baudrate": baudrate}})
+                return confirm
+    return None
+
+def follow_baudrate_negotiation(conn, reader, supported, wait=2.0):
+    """
+    Agent side: switches to the rates the hub asks for, echoes its probes
+    and keeps the first rate it confirms. Returns (baudrate,
+    bytes_per_second) like negotiate_baudrate. Gives up waiting for the hub
+    after wait seconds without a request.
+    """
+    base = conn.baudrate
+    supported = set(parse_baudrates(supported))
+    timeout, conn.timeout = conn.timeout, POLL_INTERVAL
+    try:
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            message = reader.receive_framed()
+            if message is None:
+                continue
+            msg_type, payload = message.get("type"), message.get("payload") or {}
+            if msg_type == MessageType.BAUD_DONE:
+                break
+            if msg_type != MessageType.BAUD_SWITCH:
+                continue
+            baudrate = payload.get("baudrate")
+            accepted = baudrate in supported
+            send_framed(conn, {"type": MessageType.BAUD_SWITCH_ACK, "payload": {"accepted": accepted}})
+            if accepted:
+                conn.flush()  # The ack goes out at the old rate
+                trial_end = time.monotonic() + float(payload.get("timeout", TRIAL_MARGIN))
+                confirm = _serve_trial(conn, reader, baudrate, trial_end)
+                if confirm is not None:
+                    return baudrate, confirm.get("bytes_per_second")
+                _revert(conn, reader, base, trial_end)
+            deadline = time.monotonic() + wait
+        return base, None
+    finally:
+        conn.timeout = timeout
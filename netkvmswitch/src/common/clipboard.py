@@ -0,0 +1,552 @@
+# Clipboard sync between the hub and the active agent, over their control connection
+#
+# Each side polls its clipboard and announces a change by hash:
+#
+#   either  CLIPBOARD_EVENT {hash, size, mime[, text]}  ->  other side
+#   either  CLIPBOARD_REQUEST {request, hash}           ->  announcer      (at paste time)
+#   either  CLIPBOARD_DATA {request, offset, size} + chunk  ->  requester, repeatedly
+#
+# Text up to INLINE_LIMIT bytes travels inline and is set on arrival. Anything
+# larger (images, long text) is only announced; its content is requested when
+# the other side pastes, so switching the active agent sends at most a hash.
+# A connection never carries an announcement its other side already has: not
+# the one it last sent, nor one it received from there.
+#
+# Pastes are seen in the input the hub forwards (PasteKeys): the agent holds
+# the shortcut and everything after it until the content has arrived and is
+# on its clipboard (PasteHold). The hub cannot hold back its own keyboard, so
+# there the first paste of large agent content fetches it for the next one.
+#
+# Content chunks are file data as far as priority goes: they share the
+# connection's BacklogGate with file transfers, so input and video come first.
+
+import hashlib
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import uuid
+
+from .file_transfer import MAX_CHUNK
+from .protocol import MessageType, create_data_message, create_message
+
+TEXT = "text/plain"  # UTF-8
+IMAGE = "image/png"
+INLINE_LIMIT = 64 * 1024  # Text bytes sent along with the announcement
+MAX_SIZE = 32 * 1024 * 1024  # Larger clipboards are not synced
+FETCH_TIMEOUT = 10.0  # Seconds a paste waits for the content
+COMMAND_TIMEOUT = 2.0
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def describe(mime, data, digest=None):
+    """The CLIPBOARD_EVENT payload announcing some content."""
+    payload = {"hash": digest or content_hash(data), "size": len(data), "mime": mime}
+    if mime == TEXT and len(data) <= INLINE_LIMIT:
+        payload["text"] = data.decode('utf-8', errors='replace')
+    return payload
+
+def _run(args, data=None, detach=False):
+    """A clipboard tool's output, or None if it failed. Tools that set the clipboard keep serving it, so
+    their output is not waited for."""
+    try:
+        if detach:
+            result = subprocess.run(args, input=data, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                    timeout=COMMAND_TIMEOUT)
+        else:
+            result = subprocess.run(args, input=data, capture_output=True, timeout=COMMAND_TIMEOUT)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if result.returncode != 0:
+        return None
+    return b"" if detach else result.stdout
+
+class CommandClipboard:
+    """
+    wl-clipboard on Wayland, xclip on X11 and pbcopy/pbpaste (text only) on
+    macOS. X11 owners report when they took the clipboard (TIMESTAMP) and
+    wl-paste --watch reports changes, so content is only read after a change;
+    pbpaste has neither and is read on every poll.
+    """
+    def __init__(self):
+        self.watcher = None
+        self.changes = 0
+        if sys.platform == 'darwin' and shutil.which('pbpaste'):
+            self.kind = "mac"
+        elif os.environ.get('WAYLAND_DISPLAY') and shutil.which('wl-paste') and shutil.which('wl-copy'):
+            self.kind = "wayland"
+            self._watch()
+        elif os.environ.get('DISPLAY') and shutil.which('xclip'):
+            self.kind = "x11"
+        else:
+            raise RuntimeError("No clipboard tool found (wl-clipboard, xclip or pbpaste)")
+
+    def _watch(self):
+        try:
+            self.watcher = subprocess.Popen(['wl-paste', '--watch', 'echo'], stdout=subprocess.PIPE,
+                                            stderr=subprocess.DEVNULL)
+        except OSError:
+            return
+        threading.Thread(target=self._count_changes, daemon=True).start()
+
+    def _count_changes(self):
+        for _ in self.watcher.stdout:
+            self.changes += 1
+
+    def sequence(self):
+        """Changes with the clipboard; None where that cannot be told without reading it."""
+        if self.kind == "wayland":
+            return self.changes if self.watcher is not None and self.watcher.poll() is None else None
+        if self.kind == "x11":
+            stamp = _run(['xclip', '-selection', 'clipboard', '-o', '-t', 'TIMESTAMP'])
+            return stamp.strip() if stamp else None
+        return None
+
+    def read(self):
+        """(mime, data) of the clipboard, preferring an image; None if empty."""
+        if self.kind == "mac":
+            data = _run(['pbpaste'])
+            return (TEXT, data) if data else None
+        if self.kind == "wayland":
+            types = (_run(['wl-paste', '--list-types']) or b"").decode(errors='replace').split()
+            if IMAGE in types:
+                data = _run(['wl-paste', '--no-newline', '--type', IMAGE])
+            else:
+                data = _run(['wl-paste', '--no-newline', '--type', 'text']) if types else None
+        else:
+            targets = (_run(['xclip', '-selection', 'clipboard', '-o', '-t', 'TARGETS']) or b"")
+            targets = targets.decode(errors='replace').split()
+            if IMAGE in targets:
+                data = _run(['xclip', '-selection', 'clipboard', '-o', '-t', IMAGE])
+            else:
+                data = _run(['xclip', '-selection', 'clipboard', '-o', '-t', 'UTF8_STRING']) if targets else None
+        if not data:
+            return None
+        return (IMAGE if data.startswith(b'\x89PNG') else TEXT), data
+
+    def write(self, mime, data):
+        if self.kind == "mac":
+            if mime == TEXT:
+                _run(['pbcopy'], data, detach=True)
+        elif self.kind == "wayland":
+            _run(['wl-copy', '--type', mime if mime == IMAGE else 'text/plain;charset=utf-8'], data, detach=True)
+        else:
+            _run(['xclip', '-selection', 'clipboard', '-i', '-t', mime if mime == IMAGE else 'UTF8_STRING'],
+                 data, detach=True)
+
+class WindowsClipboard:
+    """
+    Unicode text and device-independent bitmaps, converted to and from PNG.
+    GetClipboardSequenceNumber changes with every change, so the clipboard is
+    only read when it has one.
+    """
+    CF_DIB = 8
+    CF_UNICODETEXT = 13
+    GMEM_MOVEABLE = 0x0002
+
+    def __init__(self):
+        import ctypes
+        from ctypes import wintypes
+        self.ctypes = ctypes
+        # Private instances: handles need 64-bit prototypes, which must not leak into pynput's windll
+        self.user32 = ctypes.WinDLL('user32')
+        self.kernel32 = ctypes.WinDLL('kernel32')
+        handle = wintypes.HANDLE
+        prototypes = {
+            (self.user32, 'GetClipboardSequenceNumber'): (wintypes.DWORD, []),
+            (self.user32, 'OpenClipboard'): (wintypes.BOOL, [wintypes.HWND]),
+            (self.user32, 'CloseClipboard'): (wintypes.BOOL, []),
+            (self.user32, 'EmptyClipboard'): (wintypes.BOOL, []),
+            (self.user32, 'IsClipboardFormatAvailable'): (wintypes.BOOL, [wintypes.UINT]),
+            (self.user32, 'GetClipboardData'): (handle, [wintypes.UINT]),
+            (self.user32, 'SetClipboardData'): (handle, [wintypes.UINT, handle]),
+            (self.kernel32, 'GlobalAlloc'): (handle, [wintypes.UINT, ctypes.c_size_t]),
+            (self.kernel32, 'GlobalFree'): (handle, [handle]),
+            (self.kernel32, 'GlobalLock'): (ctypes.c_void_p, [handle]),
+            (self.kernel32, 'GlobalUnlock'): (wintypes.BOOL, [handle]),
+            (self.kernel32, 'GlobalSize'): (ctypes.c_size_t, [handle]),
+        }
+        for (library, name), (restype, argtypes) in prototypes.items():
+            function = getattr(library, name)
+            function.restype, function.argtypes = restype, argtypes
+
+    def sequence(self):
+        return self.user32.GetClipboardSequenceNumber()
+
+    def read(self):
+        if not self.user32.OpenClipboard(None):
+            return None  # Another program has it open; the next poll tries again
+        try:
+            if self.user32.IsClipboardFormatAvailable(self.CF_DIB):
+                dib = self._get(self.CF_DIB)
+                return (IMAGE, _dib_to_png(dib)) if dib else None
+            if self.user32.IsClipboardFormatAvailable(self.CF_UNICODETEXT):
+                text = self._get(self.CF_UNICODETEXT)
+                if text:
+                    text = text.decode('utf-16-le', errors='replace').split('\0', 1)[0]
+                    return TEXT, text.encode('utf-8')
+            return None
+        finally:
+            self.user32.CloseClipboard()
+
+    def write(self, mime, data):
+        if mime == IMAGE:
+            fmt, data = self.CF_DIB, _png_to_dib(data)
+        else:
+            fmt, data = self.CF_UNICODETEXT, data.decode('utf-8', errors='replace').encode('utf-16-le') + b'\0\0'
+        memory = self.kernel32.GlobalAlloc(self.GMEM_MOVEABLE, len(data))
+        if not memory:
+            raise MemoryError("GlobalAlloc failed")
+        self.ctypes.memmove(self.kernel32.GlobalLock(memory), data, len(data))
+        self.kernel32.GlobalUnlock(memory)
+        if not self.user32.OpenClipboard(None):
+            self.kernel32.GlobalFree(memory)
+            raise OSError("Clipboard is open in another program")
+        try:
+            self.user32.EmptyClipboard()
+            if not self.user32.SetClipboardData(fmt, memory):
+                self.kernel32.GlobalFree(memory)  # Only owned by the clipboard once set
+        finally:
+            self.user32.CloseClipboard()
+
+    def _get(self, fmt):
+        memory = self.user32.GetClipboardData(fmt)
+        if not memory:
+            return None
+        pointer = self.kernel32.GlobalLock(memory)
+        if not pointer:
+            return None
+        try:
+            return self.ctypes.string_at(pointer, self.kernel32.GlobalSize(memory))
+        finally:
+            self.kernel32.GlobalUnlock(memory)
+
+def _dib_to_png(dib):
+    import cv2
+    import numpy as np
+    header_size, = struct.unpack_from('<I', dib, 0)
+    bit_count, compression = struct.unpack_from('<HI', dib, 14)
+    colors, = struct.unpack_from('<I', dib, 32)
+    if not colors and bit_count <= 8:
+        colors = 1 << bit_count
+    masks = 12 if compression == 3 and header_size == 40 else 0  # BI_BITFIELDS
+    offset = 14 + header_size + masks + colors * 4
+    file_header = struct.pack('<2sIHHI', b'BM', 14 + len(dib), 0, 0, offset)
+    image = cv2.imdecode(np.frombuffer(file_header + dib, np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError("Unsupported clipboard bitmap")
+    return cv2.imencode('.png', image)[1].tobytes()
+
+def _png_to_dib(png):
+    import cv2
+    import numpy as np
+    image = cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Not a PNG image")
+    return cv2.imencode('.bmp', image)[1].tobytes()[14:]  # Without the file header
+
+def create_clipboard():
+    """Clipboard backend for this platform; None where there is none."""
+    backend = WindowsClipboard if sys.platform == 'win32' else CommandClipboard
+    try:
+        return backend()
+    except Exception as e:
+        logging.warning(f"Clipboard backend {backend.__name__} unavailable: {e}")
+    return None
+
+class LocalClipboard:
+    """
+    This machine's clipboard: polled for changes, which are hashed so content
+    set here or seen before is never announced again. Keeps the current
+    content for the other side to request. Without a backend it only keeps
+    what is written to it.
+    """
+    def __init__(self, backend, on_change, interval=0.5):
+        self.backend = backend
+        self.on_change = on_change  # Called with the CLIPBOARD_EVENT payload of each change
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.mime = self.data = self.hash = None
+        self.token = None  # The backend's sequence when last read
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.backend is None or self.interval <= 0 or self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread = None
+
+    def poll(self):
+        """Reads the clipboard if it may have changed; the new content's announcement, or None."""
+        token = self.backend.sequence()
+        if token is not None and token == self.token:
+            return None
+        content = self.backend.read()
+        self.token = token
+        if content is None or len(content[1]) > MAX_SIZE:
+            return None
+        mime, data = content
+        digest = content_hash(data)
+        with self.lock:
+            if digest == self.hash:
+                return None
+            self.mime, self.data, self.hash = mime, data, digest
+        return describe(mime, data, digest)
+
+    def write(self, mime, data):
+        """Sets the clipboard to content from the other side, which is then not announced back."""
+        with self.lock:
+            self.mime, self.data, self.hash = mime, data, content_hash(data)
+        if self.backend is None:
+            return
+        try:
+            self.backend.write(mime, data)
+            self.token = self.backend.sequence()
+        except Exception as e:
+            logging.warning(f"Could not set the clipboard: {e}")
+
+    def content(self, digest):
+        """The current content if it has this hash, else None."""
+        with self.lock:
+            return self.data if digest is not None and digest == self.hash else None
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                payload = self.poll()
+                if payload is not None:
+                    self.on_change(payload)
+            except Exception as e:
+                logging.warning(f"Clipboard poll failed: {e}")
+
+class _Fetch:
+    def __init__(self, digest):
+        self.hash = digest
+        self.buffer = bytearray()
+        self.size = None
+        self.error = None
+        self.done = threading.Event()
+
+class ClipboardChannel:
+    """
+    One side of clipboard sync on a control connection. provide(hash) returns
+    the content with that hash for the other side to paste, or None; it is
+    called off the connection's reader thread, so it may fetch the content
+    from elsewhere first. announced(payload) is called with every announcement
+    from the other side.
+    """
+    def __init__(self, sock, send_lock, gate, provide, announced=None):
+        self.sock = sock
+        self.send_lock = send_lock
+        self.gate = gate  # Shared with the connection's file transfers
+        self.provide = provide
+        self.announced = announced
+        self.lock = threading.Lock()
+        self.sent = None  # Hash of the last announcement sent
+        self.remote = None  # The other side's last announcement
+        self.pending = None  # That announcement, while its content has not been fetched
+        self.fetches = {}  # Request id -> _Fetch
+        self.serving = set()  # Requests being answered; the other side may cancel them
+        self.closed = threading.Event()
+
+    def announce(self, payload):
+        """Announces this side's clipboard, unless the other side already has it; True if sent."""
+        with self.lock:
+            self.pending = None  # Whatever the other side had is no longer what a paste here gets
+            if payload["hash"] == self.sent or (self.remote is not None and payload["hash"] == self.remote["hash"]):
+                return False
+            self.sent = payload["hash"]
+        self._send(create_message(MessageType.CLIPBOARD_EVENT, payload))
+        return True
+
+    def fetch(self, digest, timeout=FETCH_TIMEOUT):
+        """The other side's content with this hash, or None if it could not be had in time."""
+        request = uuid.uuid4().hex[:12]
+        fetch = _Fetch(digest)
+        with self.lock:
+            self.fetches[request] = fetch
+        try:
+            self._send(create_message(MessageType.CLIPBOARD_REQUEST, {"request": request, "hash": digest}))
+            if not fetch.done.wait(timeout):
+                self._send(create_message(MessageType.CLIPBOARD_REQUEST, {"request": request, "cancel": True}))
+                logging.warning(f"Clipboard content {digest[:12]} did not arrive within {timeout} s")
+                return None
+        except OSError:
+            return None
+        finally:
+            with self.lock:
+                self.fetches.pop(request, None)
+        if fetch.error:
+            logging.warning(f"Clipboard content {digest[:12]} unavailable: {fetch.error}")
+            return None
+        with self.lock:
+            if self.pending is not None and self.pending["hash"] == digest:
+                self.pending = None
+        return bytes(fetch.buffer)
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            fetches = list(self.fetches.values())
+        for fetch in fetches:
+            fetch.error = "Connection lost"
+            fetch.done.set()
+
+    def handle(self, message):
+        """Handles a CLIPBOARD_* message; returns False for any other message."""
+        msg_type = message.get("type")
+        payload = message.get("payload") or {}
+        if msg_type == MessageType.CLIPBOARD_EVENT: self._on_event(payload)
+        elif msg_type == MessageType.CLIPBOARD_REQUEST: self._on_request(payload)
+        elif msg_type == MessageType.CLIPBOARD_DATA: self._on_data(payload, message.get("data", b""))
+        else:
+            return False
+        return True
+
+    def _on_event(self, payload):
+        if not payload.get("hash"):
+            return
+        with self.lock:
+            self.remote = payload
+            self.pending = None if "text" in payload else payload
+            self.sent = None  # The other side's clipboard moved on; ours is worth announcing again
+        if self.announced is not None:
+            self.announced(payload)
+
+    def _on_request(self, payload):
+        request = payload.get("request")
+        with self.lock:
+            if payload.get("cancel"):
+                self.serving.discard(request)
+                return
+            self.serving.add(request)
+        threading.Thread(target=self._serve, args=(request, payload.get("hash")), daemon=True).start()
+
+    def _serve(self, request, digest):
+        stopped = lambda: self.closed.is_set() or request not in self.serving
+        try:
+            data = self.provide(digest)
+            if data is None:
+                self._send(create_message(MessageType.CLIPBOARD_DATA, {"request": request,
+                                                                       "error": "Clipboard has changed"}))
+                return
+            view = memoryview(data)
+            offset = 0
+            while True:
+                size = min(self.gate.chunk_size(), MAX_CHUNK, len(data) - offset)
+                if not self.gate.wait(size, stopped):
+                    return
+                self._send(create_data_message(MessageType.CLIPBOARD_DATA, {"request": request, "offset": offset,
+                                                                            "size": len(data)}, size),
+                           view[offset:offset + size])
+                offset += size
+                if offset >= len(data):
+                    return
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.serving.discard(request)
+
+    def _on_data(self, payload, data):
+        with self.lock:
+            fetch = self.fetches.get(payload.get("request"))
+        if fetch is None:
+            return
+        if payload.get("error"):
+            fetch.error = payload["error"]
+            fetch.done.set()
+            return
+        if payload.get("offset") != len(fetch.buffer):
+            fetch.error = "Content arrived out of order"
+            fetch.done.set()
+            return
+        size = payload.get("size")
+        if not isinstance(size, int) or size > MAX_SIZE or len(fetch.buffer) + len(data) > size:
+            fetch.error = f"Content of {size} bytes is more than {MAX_SIZE} or than announced"
+            fetch.done.set()
+            return
+        fetch.buffer += data
+        if len(fetch.buffer) >= size:
+            if content_hash(fetch.buffer) != fetch.hash:
+                fetch.error = "Content does not match its hash"
+            fetch.done.set()
+
+    def _send(self, message, data=None):
+        with self.send_lock:
+            self.sock.sendall(message)
+            if data is not None:
+                self.sock.sendall(data)
+        self.gate.sent(len(message) + (len(data) if data is not None else 0))
+
+# Key names from the hub's pynput or evdev capture ("Key.ctrl_l", "v") and from the web UI ("Control", "v")
+PASTE_MODIFIERS = {"Key.ctrl", "Key.ctrl_l", "Key.ctrl_r", "Key.cmd", "Key.cmd_l", "Key.cmd_r", "Control", "Meta"}
+SHIFT_KEYS = {"Key.shift", "Key.shift_l", "Key.shift_r", "Shift"}
+PASTE_KEYS = {"v", "V", "\x16"}  # pynput reports Ctrl+V as a control character on some platforms
+INSERT_KEYS = {"Key.insert", "Insert"}
+
+class PasteKeys:
+    """Follows KEY_EVENT payloads and tells which press is a paste (Ctrl/Cmd+V or Shift+Insert)."""
+    def __init__(self):
+        self.held = set()
+
+    def feed(self, payload):
+        key = payload.get("key")
+        if payload.get("event_type") != "press":
+            self.held.discard(key)
+            return False
+        if key in PASTE_MODIFIERS or key in SHIFT_KEYS:
+            self.held.add(key)
+            return False
+        if key in PASTE_KEYS:
+            return bool(self.held & PASTE_MODIFIERS)
+        if key in INSERT_KEYS:
+            return bool(self.held & SHIFT_KEYS)
+        return False
+
+class PasteHold:
+    """
+    Passes input on to submit(msg_type, payload), except that a paste waits
+    until the clipboard it pastes is here. prepare() returns a function that
+    fetches it and sets the clipboard, or None if it is already here; input
+    after the paste waits with it, so the order is kept.
+    """
+    def __init__(self, submit, prepare):
+        self.submit_now = submit
+        self.prepare = prepare
+        self.keys = PasteKeys()
+        self.lock = threading.Lock()
+        self.held = None  # Input waiting for a fetch
+
+    def submit(self, msg_type, payload):
+        with self.lock:
+            paste = msg_type == MessageType.KEY_EVENT and self.keys.feed(payload)
+            if self.held is not None:
+                self.held.append((msg_type, payload))
+                return
+            fetch = self.prepare() if paste else None
+            if fetch is not None:
+                self.held = [(msg_type, payload)]
+                threading.Thread(target=self._release_after, args=(fetch,), daemon=True).start()
+                return
+        self.submit_now(msg_type, payload)
+
+    def _release_after(self, fetch):
+        try:
+            fetch()
+        except Exception as e:
+            logging.warning(f"Clipboard fetch for a paste failed: {e}")
+        with self.lock:
+            held, self.held = self.held, None
+            for msg_type, payload in held:
+                self.submit_now(msg_type, payload)
@@ -3,6 +3,10 @@ import json
 from dataclasses import dataclass
 from typing import Optional
 
+from .utils import user_data_path
+
+CLIENT_SETTINGS_FILE = 'client_settings.json'  # Settings the agent tunes itself, kept per user
+
 @dataclass
 class ServerConfig:
     host: str = '0.0.0.0'
@@ -11,6 +15,22 @@ class ServerConfig:
     ui_video_port: int = 12347
     ui_control_port: int = 12348
     max_clients: int = 10
+    keyframe_request_interval: float = 0.5  # Minimum seconds between IDR requests per source
+    active_stream_fps: int = 60  # Active or hovered client
+    thumbnail_stream_fps: int = 5  # Everyone else while the UI is watching
+    thumbnail_stream_scale: float = 0.25
+    input_backend: str = "pynput"  # "evdev" reads /dev/input directly on Linux hubs (needs python-evdev)
+    input_grab: bool = False  # evdev only: grab the devices while forwarding; Scroll Lock toggles
+    # USB agent discovery: which serial ports get a handshake
+    usb_ids: str = ""  # Comma-separated "vid:pid" in hex (pid "*" = any), e.g. "2e8a:000a"; empty = any USB device
+    usb_descriptions: str = ""  # Comma-separated description substrings to require; empty = any
+    usb_exclude: str = "modem,bluetooth"  # Description substrings never probed
+    usb_probe_workers: int = 4  # Concurrent handshakes
+    usb_negative_cache_ttl: float = 60.0  # Seconds before a port that failed a handshake is probed again
+    usb_baudrates: str = "12000000,6000000,3000000,2000000,1000000,921600,460800,230400"  # Tried fastest first
+    file_transfer_dir: str = ""  # Where files pulled from agents go; "" = ~/Downloads/NetKVMSwitch
+    file_transfer_rate: int = 0  # Bytes per second for pushes to agents; 0 = as fast as input leaves room for
+    clipboard_poll_interval: float = 0.5  # Seconds between clipboard checks; 0 disables clipboard sync
     
 @dataclass
 class ClientConfig:
@@ -21,6 +41,29 @@ class ClientConfig:
     video_quality: int = 50
     video_width: int = 800
     fps: int = 30
+    simulcast: bool = False  # Also encode a low-resolution thumbnail layer
+    monitors: str = "1"  # mss monitor indices to stream, e.g. "1,2" or "all"
+    capture_combined: bool = False  # Also stream the combined virtual screen
+    pipeline_backend: str = "auto"  # "auto" (benchmarked once), "python", "native" or e.g. "mss/i420/libx264"
+    # libx264 settings; the encoder auto-tuner (source_agent/encoder_tuning.py) saves them to ~/.netkvmswitch/client_settings.json
+    encoder_threads: int = 0  # 0 = libx264 decides
+    encoder_sliced_threads: bool = True
+    encoder_preset: str = "veryfast"
+    encoder_profile: str = ""  # "" = libx264 default
+    encoder_autotune: bool = True  # Tune at startup when not yet tuned for this resolution/fps
+    encoder_tuned_for: str = ""
+    cursor_rate: int = 60  # Pointer side-channel polls per second; 0 disables it
+    input_backend: str = "pynput"  # "uinput" injects through /dev/uinput on Linux (needs python-evdev)
+    reconnect_initial_delay: float = 0.05  # Backoff after losing the hub, doubling per attempt
+    reconnect_max_delay: float = 0.8  # Short enough that a restarted hub has a picture within a second
+    # USB serial agents: H.264 at a small size, capped to a share of the measured link throughput
+    usb_video_width: int = 320
+    usb_fps: int = 10
+    usb_link_share: float = 0.7  # Leaves room for framing, retransmitted keyframes and control messages
+    usb_baudrates: str = "12000000,6000000,3000000,2000000,1000000,921600,460800,230400"  # What this port supports
+    file_transfer_dir: str = ""  # Where files pushed by the hub go; "" = ~/Downloads/NetKVMSwitch
+    file_transfer_rate: int = 0  # Bytes per second for files the hub pulls; 0 = what input and video leave
+    clipboard_poll_interval: float = 0.5  # Seconds between clipboard checks; 0 disables clipboard sync
     
 @dataclass
 class SecurityConfig:
@@ -52,8 +95,8 @@ class AppConfig:
     debug: bool = False
     
     @classmethod
-    def load(cls, config_file: Optional[str] = None) -> 'AppConfig':
-        """Load configuration from file and environment variables."""
+    def load(cls, config_file: Optional[str] = None, settings_file: Optional[str] = None) -> 'AppConfig':
+        """Load configuration from file, the per-user tuned client settings and environment variables."""
         config_data = {}
         
         # Load from file if provided
@@ -61,6 +104,14 @@ class AppConfig:
             with open(config_file, 'r') as f:
                 config_data = json.load(f)
         
+        # Tuned client settings override the file's
+        if settings_file and os.path.exists(settings_file):
+            try:
+                with open(settings_file, 'r') as f:
+                    config_data.setdefault('client', {}).update(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable client settings {settings_file}: {e}")
+        
         # Override with environment variables
         env_overrides = {
             'debug': os.getenv('NETKVM_DEBUG', 'false').lower() == 'true',
@@ -128,4 +179,25 @@ class AppConfig:
 
 # Global configuration instance - load from default config file if it exists
 _default_config_path = os.path.join(os.path.dirname(__file__), '..', '..', 'config.json')
-config = AppConfig.load(_default_config_path if os.path.exists(_default_config_path) else None) 
\ No newline at end of file
+_settings_path = user_data_path(CLIENT_SETTINGS_FILE)
+config = AppConfig.load(_default_config_path if os.path.exists(_default_config_path) else None, _settings_path)
+
+def save_client_settings(values, settings_file=None):
+    """
+    Updates client settings in memory and in the per-user settings file,
+    which AppConfig.load overlays on config.json. config.json itself, in
+    the source tree or install directory, is never written.
+    """
+    settings_file = settings_file or _settings_path
+    for key, value in values.items():
+        setattr(config.client, key, value)
+    settings = {}
+    if os.path.exists(settings_file):
+        try:
+            with open(settings_file, 'r') as f:
+                settings = json.load(f)
+        except (OSError, ValueError):
+            pass  # Rewritten below
+    settings.update(values)
+    with open(settings_file, 'w') as f:
+        json.dump(settings, f, indent=2)
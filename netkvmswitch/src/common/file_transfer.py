@@ -0,0 +1,501 @@
+# File transfer between the hub and a network agent, over their control connection
+#
+# Either side can send, but only the hub starts transfers. The hub pushes a
+# file by offering it, and pulls one by asking the agent to offer it; the hub
+# turns down requests from agents and offers it did not ask for, so an agent
+# can neither read the hub's files nor fill its disk:
+#
+#   hub      FILE_REQUEST {transfer, path}          ->  agent     (pulls only)
+#   sender   FILE_OFFER {transfer, name, size}      ->  receiver
+#   receiver FILE_ACK {transfer, offset: 0}         ->  sender    (accepted)
+#   sender   FILE_DATA {transfer, offset} + chunk   ->  receiver, repeatedly
+#   receiver FILE_ACK {transfer, offset}            ->  sender, every ACK_INTERVAL bytes
+#   sender   FILE_END {transfer, size, sha256}      ->  receiver
+#   receiver FILE_DONE {transfer, sha256}           ->  sender    (size and hash checked)
+#
+# FILE_CANCEL {transfer, reason} ends a transfer from either side. Chunks are
+# messages with attached data (see create_data_message), read from the file
+# into one reused buffer and sent from a memoryview of it. The control
+# connection is TLS, so the kernel's sendfile cannot be used.
+#
+# Input and video come first; file data only gets what they leave:
+# - each chunk is sent under the connection's send lock, so an input message
+#   waits for at most one chunk to be handed to the kernel;
+# - a chunk is only queued while the bytes on the connection not yet
+#   acknowledged by the other side, whether still in the socket or already
+#   on the network, are fewer than the link carries in LATENCY_BUDGET; input
+#   never queues behind more file data than that (BacklogGate);
+# - the sender waits while a socket it yields to (the agent's video
+#   connection) has anything queued, so file data fills what video leaves;
+# - at most WINDOW bytes go unacknowledged, so a receiver slow to write stalls
+#   its sender instead of filling the socket buffers input also goes through;
+# - an optional rate limit (bytes per second) paces the rest.
+# The backlog checks need Linux; elsewhere only the window and rate limit apply.
+
+import hashlib
+import os
+import struct
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+    import termios
+except ImportError:  # Windows
+    fcntl = termios = None
+
+from .protocol import MessageType, create_data_message, create_message
+
+MIN_CHUNK = 4 * 1024
+MAX_CHUNK = 64 * 1024
+WINDOW = 4 * 1024 * 1024  # Unacknowledged bytes per transfer
+ACK_INTERVAL = 512 * 1024
+LATENCY_BUDGET = 0.004  # Seconds of file data input may queue behind
+MIN_BACKLOG = 16 * 1024
+INITIAL_BACKLOG = 64 * 1024
+MAX_BACKLOG = 4 * 1024 * 1024
+SAMPLE_PERIOD = 0.05  # Seconds over which the link's rate is measured
+POLL_INTERVAL = 0.001  # While a chunk waits for the backlog to shrink
+PROGRESS_INTERVAL = 0.25  # Seconds between progress reports per transfer
+MAX_FINISHED = 8  # Finished transfers kept for status queries
+PART_SUFFIX = ".part"
+
+# Directions, as seen from the side reporting them
+SEND = "send"
+RECEIVE = "receive"
+
+# Which end of the connection a channel is
+HUB = "hub"
+AGENT = "agent"
+
+class TransferState:
+    REQUESTED = "requested"  # A pull waiting for the agent's offer
+    OFFERED = "offered"
+    ACTIVE = "active"
+    DONE = "done"
+    FAILED = "failed"
+
+FINISHED = (TransferState.DONE, TransferState.FAILED)
+
+def queued_bytes(sock):
+    """Bytes written to a socket that the other side has not acknowledged (or read, for socketpairs); None where unknown."""
+    if fcntl is None or sock is None:
+        return None
+    try:
+        fileno = sock.fileno()
+    except OSError:
+        return None
+    if fileno < 0:
+        return None
+    try:
+        return struct.unpack('i', fcntl.ioctl(fileno, termios.TIOCOUTQ, b'\0' * 4))[0]
+    except OSError:
+        return None
+
+def transfer_directory(configured=""):
+    """Where received files go: the configured directory, or Downloads/NetKVMSwitch."""
+    return configured or os.path.join(os.path.expanduser('~'), 'Downloads', 'NetKVMSwitch')
+
+def safe_name(name):
+    """The file name part of a name from the other side, so it can only land in the transfer directory."""
+    name = str(name).replace('\\', '/').rsplit('/', 1)[-1].strip()
+    return name if name not in ('', '.', '..') else "file"
+
+def unique_path(directory, name):
+    """directory/name, or directory/name (1) etc. if that is taken."""
+    path = os.path.join(directory, name)
+    stem, ext = os.path.splitext(name)
+    count = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{stem} ({count}){ext}")
+        count += 1
+    return path
+
+class Throttle:
+    """Paces a transfer to a rate in bytes per second; 0 is unlimited."""
+    def __init__(self, rate=0, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.ready = None  # When the next chunk may go
+
+    def chunk_limit(self):
+        """Chunks of at most a tenth of a second, so pacing stays smooth at low rates."""
+        return max(1024, int(self.rate / 10)) if self.rate > 0 else MAX_CHUNK
+
+    def wait(self, size):
+        if self.rate <= 0:
+            return
+        now = self.clock()
+        self.ready = now if self.ready is None else max(self.ready, now)
+        delay = self.ready - now
+        self.ready += size / self.rate
+        if delay > 0:
+            self.sleep(delay)
+
+class BacklogGate:
+    """
+    Lets file data onto a socket only while its unacknowledged bytes stay
+    within what the link carries in LATENCY_BUDGET, and while the sockets it
+    yields to have nothing queued. The link's rate is measured from the bytes
+    acknowledged per SAMPLE_PERIOD; a limit too small to keep the link busy
+    measures as a higher rate, so it grows until it is not.
+    """
+    def __init__(self, sock, yield_to=None, budget=None, clock=time.monotonic, sleep=time.sleep):
+        self.sock = sock
+        self.yield_to = yield_to or (lambda: ())  # Returns the sockets to yield to
+        self.budget = LATENCY_BUDGET if budget is None else budget
+        self.clock = clock
+        self.sleep = sleep
+        self.limit = INITIAL_BACKLOG
+        self.rate = None  # Measured bytes per second
+        self.written = 0
+        self.sample = None  # (time, bytes acknowledged) at the start of the current sample
+        self.lock = threading.Lock()
+
+    def chunk_size(self):
+        return max(MIN_CHUNK, min(MAX_CHUNK, self.limit // 2))
+
+    def sent(self, size):
+        with self.lock:
+            self.written += size
+
+    def wait(self, size, cancelled):
+        """Blocks until size more bytes may be queued; False if cancelled first."""
+        while not cancelled():
+            if self._clear(size):
+                return True
+            self.sleep(POLL_INTERVAL)
+        return False
+
+    def _clear(self, size):
+        for sock in self.yield_to():
+            if queued_bytes(sock):
+                return False
+        queued = queued_bytes(self.sock)
+        if queued is None:
+            return True
+        with self.lock:
+            self._measure(queued)
+            # An empty queue always takes a chunk, however small the limit
+            return queued == 0 or queued + size <= self.limit
+
+    def _measure(self, queued):
+        now = self.clock()
+        acknowledged = self.written - queued
+        if self.sample is None or now - self.sample[0] > SAMPLE_PERIOD * 10:
+            self.sample = (now, acknowledged)  # Nothing was sent for a while: start over
+            return
+        started, acknowledged_before = self.sample
+        if now - started < SAMPLE_PERIOD:
+            return
+        self.sample = (now, acknowledged)
+        rate = (acknowledged - acknowledged_before) / (now - started)
+        if rate <= 0:
+            return
+        self.rate = rate if self.rate is None else (self.rate + rate) / 2
+        self.limit = int(max(MIN_BACKLOG, min(MAX_BACKLOG, self.rate * self.budget)))
+
+class Transfer:
+    def __init__(self, transfer_id, direction, name, size=None, path=None, rate=0,
+                 state=TransferState.OFFERED):
+        self.id = transfer_id
+        self.direction = direction
+        self.name = name
+        self.size = size
+        self.path = path  # The file sent, or where the received file ended up
+        self.state = state
+        self.error = None
+        self.done = 0  # Bytes sent or written
+        self.acked = 0  # Bytes acknowledged by the receiver, or acknowledged to the sender
+        self.throttle = Throttle(rate)
+        self.hash = hashlib.sha256()
+        self.file = None  # The .part file being received
+        self.started = time.monotonic()
+        self.finished = None
+        self.reported = 0.0
+
+    def part_path(self, directory):
+        return os.path.join(directory, f"{self.name}.{self.id}{PART_SUFFIX}")
+
+    def status(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return {"transfer": self.id, "direction": self.direction, "name": self.name, "size": self.size,
+                "bytes": self.done, "state": self.state, "error": self.error,
+                "rate": int(self.done / elapsed) if elapsed > 0 else 0}
+
+class FileTransferChannel:
+    """
+    The file transfers on one control connection. The connection's reader
+    passes every message to handle(), which takes the FILE_* ones; push()
+    and pull() start transfers from this side. progress(status) is called
+    as transfers advance, at most every PROGRESS_INTERVAL, and on every
+    state change. On the HUB side, only offers of files it pulls are accepted.
+    """
+    def __init__(self, sock, send_lock, directory, rate=0, yield_to=None, progress=None, role=AGENT):
+        self.sock = sock
+        self.role = role
+        self.send_lock = send_lock  # Shared with everything else sent on the connection
+        self.directory = directory
+        self.rate = rate  # Default for transfers sent from this side
+        self.progress = progress
+        self.gate = BacklogGate(sock, yield_to)
+        self.transfers = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def push(self, path, rate=None):
+        """Offers a local file to the other side; returns the transfer id. OSError if it cannot be read."""
+        size = os.path.getsize(path)
+        transfer = Transfer(uuid.uuid4().hex[:12], SEND, os.path.basename(path), size, path,
+                            self.rate if rate is None else rate)
+        self._add(transfer)
+        self._send(create_message(MessageType.FILE_OFFER, {"transfer": transfer.id, "name": transfer.name,
+                                                           "size": size}))
+        return transfer.id
+
+    def pull(self, remote_path, rate=None):
+        """Asks the other side to send one of its files; returns the transfer id."""
+        transfer = Transfer(uuid.uuid4().hex[:12], RECEIVE, safe_name(remote_path),
+                            state=TransferState.REQUESTED)
+        self._add(transfer)
+        payload = {"transfer": transfer.id, "path": remote_path}
+        if rate is not None:
+            payload["rate"] = rate
+        self._send(create_message(MessageType.FILE_REQUEST, payload))
+        return transfer.id
+
+    def cancel(self, transfer_id):
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None or transfer.state in FINISHED:
+            return False
+        self._fail(transfer, "Cancelled", notify=True)
+        return True
+
+    def close(self):
+        """The connection is gone: every unfinished transfer fails."""
+        for transfer in list(self.transfers.values()):
+            self._fail(transfer, "Connection lost")
+
+    def get_transfers(self):
+        return [transfer.status() for transfer in list(self.transfers.values())]
+
+    def handle(self, message):
+        """Handles a FILE_* message; returns False for any other message."""
+        msg_type = message.get("type")
+        payload = message.get("payload") or {}
+        if msg_type == MessageType.FILE_OFFER: self._on_offer(payload)
+        elif msg_type == MessageType.FILE_DATA: self._on_data(payload, message.get("data", b""))
+        elif msg_type == MessageType.FILE_END: self._on_end(payload)
+        elif msg_type == MessageType.FILE_REQUEST: self._on_request(payload)
+        elif msg_type == MessageType.FILE_ACK: self._on_ack(payload)
+        elif msg_type == MessageType.FILE_DONE: self._on_done(payload)
+        elif msg_type == MessageType.FILE_CANCEL: self._on_cancel(payload)
+        else:
+            return False
+        return True
+
+    # Receiving
+
+    def _on_offer(self, payload):
+        transfer = self.transfers.get(payload.get("transfer"))
+        if transfer is None and self.role == HUB:
+            self._refuse(payload.get("transfer"), "The hub only accepts files it asked for")
+            return
+        if transfer is None:
+            transfer = Transfer(payload.get("transfer"), RECEIVE, safe_name(payload.get("name")))
+            self._add(transfer)
+        elif transfer.direction != RECEIVE or transfer.state != TransferState.REQUESTED:
+            return
+        transfer.name = safe_name(payload.get("name", transfer.name))
+        transfer.size = int(payload.get("size", 0))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            transfer.file = open(transfer.part_path(self.directory), 'wb')
+        except OSError as e:
+            self._fail(transfer, f"Cannot write {transfer.name}: {e}", notify=True)
+            return
+        transfer.state = TransferState.ACTIVE
+        self._send(create_message(MessageType.FILE_ACK, {"transfer": transfer.id, "offset": 0}))
+        self._report(transfer, force=True)
+
+    def _on_data(self, payload, data):
+        transfer = self._find(payload.get("transfer"), RECEIVE)
+        if transfer is None:
+            return
+        if payload.get("offset") != transfer.done:
+            self._fail(transfer, f"Chunk at {payload.get('offset')} while expecting {transfer.done}", notify=True)
+            return
+        error = None
+        with self.changed:
+            # cancel() fails the transfer from another thread and then closes its file
+            if transfer.state != TransferState.ACTIVE:
+                return
+            try:
+                transfer.file.write(data)
+            except OSError as e:
+                error = e
+        if error is not None:
+            self._fail(transfer, f"Cannot write {transfer.name}: {error}", notify=True)
+            return
+        transfer.hash.update(data)
+        transfer.done += len(data)
+        if transfer.done - transfer.acked >= ACK_INTERVAL:
+            transfer.acked = transfer.done
+            self._send(create_message(MessageType.FILE_ACK, {"transfer": transfer.id, "offset": transfer.done}))
+        self._report(transfer)
+
+    def _on_end(self, payload):
+        transfer = self._find(payload.get("transfer"), RECEIVE)
+        if transfer is None:
+            return
+        transfer.file.close()
+        digest = transfer.hash.hexdigest()
+        if payload.get("size") != transfer.done or payload.get("sha256") != digest:
+            self._fail(transfer, f"Received {transfer.done} of {payload.get('size')} bytes or a wrong hash",
+                       notify=True)
+            return
+        try:
+            transfer.path = unique_path(self.directory, transfer.name)
+            os.replace(transfer.part_path(self.directory), transfer.path)
+        except OSError as e:
+            self._fail(transfer, f"Cannot save {transfer.name}: {e}", notify=True)
+            return
+        self._finish(transfer)
+        self._send(create_message(MessageType.FILE_DONE, {"transfer": transfer.id, "sha256": digest}))
+
+    # Sending
+
+    def _on_request(self, payload):
+        if self.role == HUB:
+            self._refuse(payload.get("transfer"), "The hub does not send files on request")
+            return
+        path = payload.get("path", "")
+        try:
+            size = os.path.getsize(path)
+        except (OSError, TypeError) as e:
+            self._send(create_message(MessageType.FILE_CANCEL, {"transfer": payload.get("transfer"),
+                                                                "reason": f"Cannot read {path}: {e}"}))
+            return
+        transfer = Transfer(payload.get("transfer"), SEND, os.path.basename(path), size, path,
+                            payload.get("rate", self.rate))
+        self._add(transfer)
+        self._send(create_message(MessageType.FILE_OFFER, {"transfer": transfer.id, "name": transfer.name,
+                                                           "size": size}))
+
+    def _on_ack(self, payload):
+        transfer = self.transfers.get(payload.get("transfer"))
+        if transfer is None or transfer.direction != SEND:
+            return
+        with self.changed:
+            transfer.acked = max(transfer.acked, int(payload.get("offset", 0)))
+            start = transfer.state == TransferState.OFFERED
+            if start:
+                transfer.state = TransferState.ACTIVE
+            self.changed.notify_all()
+        if start:
+            self._report(transfer, force=True)
+            threading.Thread(target=self._send_file, args=(transfer,), daemon=True).start()
+
+    def _on_done(self, payload):
+        transfer = self._find(payload.get("transfer"), SEND)
+        if transfer is not None:
+            self._finish(transfer)
+
+    def _send_file(self, transfer):
+        buffer = memoryview(bytearray(MAX_CHUNK))
+        stopped = lambda: transfer.state != TransferState.ACTIVE
+        try:
+            with open(transfer.path, 'rb') as f:
+                while transfer.done < transfer.size:
+                    with self.changed:
+                        while not stopped() and transfer.done - transfer.acked >= WINDOW:
+                            self.changed.wait(1.0)
+                    if stopped():
+                        return
+                    size = min(self.gate.chunk_size(), transfer.throttle.chunk_limit(), transfer.size - transfer.done)
+                    read = f.readinto(buffer[:size])
+                    if not read:
+                        raise OSError(f"{transfer.name} shrank while being sent")
+                    transfer.throttle.wait(read)
+                    if not self.gate.wait(read, stopped):
+                        return
+                    chunk = buffer[:read]
+                    transfer.hash.update(chunk)
+                    self._send(create_data_message(MessageType.FILE_DATA, {"transfer": transfer.id,
+                                                                           "offset": transfer.done}, read), chunk)
+                    transfer.done += read
+                    self._report(transfer)
+            self._send(create_message(MessageType.FILE_END, {"transfer": transfer.id, "size": transfer.done,
+                                                             "sha256": transfer.hash.hexdigest()}))
+        except OSError as e:
+            self._fail(transfer, str(e), notify=True)
+
+    # Both directions
+
+    def _on_cancel(self, payload):
+        transfer = self.transfers.get(payload.get("transfer"))
+        if transfer is not None:
+            self._fail(transfer, payload.get("reason") or "Cancelled by the other side")
+
+    def _refuse(self, transfer_id, reason):
+        print(f"Refused a file transfer from the other side: {reason}")
+        self._send(create_message(MessageType.FILE_CANCEL, {"transfer": transfer_id, "reason": reason}))
+
+    def _find(self, transfer_id, direction):
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None or transfer.direction != direction or transfer.state != TransferState.ACTIVE:
+            return None
+        return transfer
+
+    def _add(self, transfer):
+        with self.lock:
+            finished = [t.id for t in self.transfers.values() if t.state in FINISHED]
+            for transfer_id in finished[:max(0, len(finished) - MAX_FINISHED + 1)]:
+                del self.transfers[transfer_id]
+            self.transfers[transfer.id] = transfer
+        self._report(transfer, force=True)
+
+    def _finish(self, transfer):
+        with self.changed:
+            transfer.state = TransferState.DONE
+            transfer.finished = time.monotonic()
+            self.changed.notify_all()
+        self._report(transfer, force=True)
+
+    def _fail(self, transfer, reason, notify=False):
+        with self.changed:
+            if transfer.state in FINISHED:
+                return
+            transfer.state = TransferState.FAILED
+            transfer.error = reason
+            transfer.finished = time.monotonic()
+            self.changed.notify_all()
+        print(f"File transfer of {transfer.name} failed: {reason}")
+        if transfer.file is not None:
+            transfer.file.close()
+            try:
+                os.remove(transfer.part_path(self.directory))
+            except OSError:
+                pass
+        if notify:
+            try:
+                self._send(create_message(MessageType.FILE_CANCEL, {"transfer": transfer.id, "reason": reason}))
+            except OSError:
+                pass
+        self._report(transfer, force=True)
+
+    def _report(self, transfer, force=False):
+        now = time.monotonic()
+        if self.progress is None or (not force and now - transfer.reported < PROGRESS_INTERVAL):
+            return
+        transfer.reported = now
+        self.progress(transfer.status())
+
+    def _send(self, message, data=None):
+        with self.send_lock:
+            self.sock.sendall(message)
+            if data is not None:
+                self.sock.sendall(data)
+        self.gate.sent(len(message) + (len(data) if data is not None else 0))
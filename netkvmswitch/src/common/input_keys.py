@@ -0,0 +1,40 @@
+# Key and button names shared by input capture on the hub and injection on agents
+#
+# Names, not codes, so importing this needs no platform input library.
+
+# pynput Key names (the "Key.<name>" strings on the wire) to evdev key names
+NAMED_KEYS = {
+    "alt": "KEY_LEFTALT", "alt_l": "KEY_LEFTALT", "alt_r": "KEY_RIGHTALT", "alt_gr": "KEY_RIGHTALT",
+    "backspace": "KEY_BACKSPACE", "caps_lock": "KEY_CAPSLOCK",
+    "cmd": "KEY_LEFTMETA", "cmd_l": "KEY_LEFTMETA", "cmd_r": "KEY_RIGHTMETA",
+    "ctrl": "KEY_LEFTCTRL", "ctrl_l": "KEY_LEFTCTRL", "ctrl_r": "KEY_RIGHTCTRL",
+    "delete": "KEY_DELETE", "down": "KEY_DOWN", "end": "KEY_END", "enter": "KEY_ENTER", "esc": "KEY_ESC",
+    "home": "KEY_HOME", "left": "KEY_LEFT", "page_down": "KEY_PAGEDOWN", "page_up": "KEY_PAGEUP",
+    "right": "KEY_RIGHT", "shift": "KEY_LEFTSHIFT", "shift_l": "KEY_LEFTSHIFT", "shift_r": "KEY_RIGHTSHIFT",
+    "space": "KEY_SPACE", "tab": "KEY_TAB", "up": "KEY_UP", "insert": "KEY_INSERT", "menu": "KEY_COMPOSE",
+    "num_lock": "KEY_NUMLOCK", "pause": "KEY_PAUSE", "print_screen": "KEY_SYSRQ", "scroll_lock": "KEY_SCROLLLOCK",
+    "media_play_pause": "KEY_PLAYPAUSE", "media_volume_mute": "KEY_MUTE",
+    "media_volume_down": "KEY_VOLUMEDOWN", "media_volume_up": "KEY_VOLUMEUP",
+    "media_previous": "KEY_PREVIOUSSONG", "media_next": "KEY_NEXTSONG",
+}
+NAMED_KEYS.update({f"f{i}": f"KEY_F{i}" for i in range(1, 25)})
+
+# Characters to the US-layout key producing them. Shift travels as its own
+# key event, so shifted characters map to their unshifted key
+CHARACTER_KEYS = {
+    "-": "KEY_MINUS", "_": "KEY_MINUS", "=": "KEY_EQUAL", "+": "KEY_EQUAL",
+    "[": "KEY_LEFTBRACE", "{": "KEY_LEFTBRACE", "]": "KEY_RIGHTBRACE", "}": "KEY_RIGHTBRACE",
+    "\\": "KEY_BACKSLASH", "|": "KEY_BACKSLASH", ";": "KEY_SEMICOLON", ":": "KEY_SEMICOLON",
+    "'": "KEY_APOSTROPHE", '"': "KEY_APOSTROPHE", "`": "KEY_GRAVE", "~": "KEY_GRAVE",
+    ",": "KEY_COMMA", "<": "KEY_COMMA", ".": "KEY_DOT", ">": "KEY_DOT", "/": "KEY_SLASH", "?": "KEY_SLASH",
+    " ": "KEY_SPACE", "\t": "KEY_TAB", "\n": "KEY_ENTER", "\r": "KEY_ENTER",
+}
+CHARACTER_KEYS.update({c: f"KEY_{c.upper()}" for c in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"})
+CHARACTER_KEYS.update({c: f"KEY_{c}" for c in "0123456789"})
+CHARACTER_KEYS.update({c: f"KEY_{d}" for c, d in zip(")!@#$%^&*(", "0123456789")})
+
+# pynput button strings to evdev button names
+BUTTONS = {"Button.left": "BTN_LEFT", "Button.right": "BTN_RIGHT", "Button.middle": "BTN_MIDDLE"}
+
+# The character each key sends on the wire when captured on the hub
+UNSHIFTED_CHARACTERS = "abcdefghijklmnopqrstuvwxyz0123456789-=[]\\;'`,./"
@@ -1,5 +1,6 @@
 # Message definitions, serialization
 import json
+import struct
 
 class MessageType:
     KEY_EVENT = "key_event"
@@ -12,9 +13,111 @@ class MessageType:
     VIDEO_FRAME = "video_frame"
     SHUTDOWN = "shutdown"
     RESTART = "restart"
+    REQUEST_KEYFRAME = "request_keyframe"
+    STREAM_RECONFIGURE = "stream_reconfigure"
+    CURSOR_SHAPE = "cursor_shape"
+    CURSOR_POSITION = "cursor_position"
+    # Baud rate negotiation with USB agents (common/baud_negotiation.py)
+    BAUD_SWITCH = "baud_switch"
+    BAUD_SWITCH_ACK = "baud_switch_ack"
+    BAUD_CONFIRM = "baud_confirm"
+    BAUD_CONFIRM_ACK = "baud_confirm_ack"
+    BAUD_DONE = "baud_done"
+    # File transfer over a network agent's control connection (common/file_transfer.py)
+    FILE_OFFER = "file_offer"
+    FILE_REQUEST = "file_request"
+    FILE_DATA = "file_data"
+    FILE_ACK = "file_ack"
+    FILE_END = "file_end"
+    FILE_DONE = "file_done"
+    FILE_CANCEL = "file_cancel"
+    FILE_PROGRESS = "file_progress"
+    # Clipboard content fetched at paste time (common/clipboard.py); announced with CLIPBOARD_EVENT
+    CLIPBOARD_REQUEST = "clipboard_request"
+    CLIPBOARD_DATA = "clipboard_data"
+
+class StreamProfile:
+    """Stream profiles the hub assigns to agents through STREAM_STATUS."""
+    FULL = "full"
+    THUMBNAIL = "thumbnail"
+    PAUSED = "paused"
+
+class VideoLayer:
+    """Layer ids carried in each framed video packet, after the stream id."""
+    MAIN = 0
+    THUMBNAIL = 1
+    # Not video: a STREAM_RECONFIGURE message sent in-band, so it reaches the
+    # hub and UI ahead of the first packet encoded at the new resolution
+    RECONFIGURE = 255
+    # Not video: CURSOR_SHAPE / CURSOR_POSITION messages the hub relays to the UI
+    CURSOR = 254
+    # Not video: FILE_PROGRESS messages about the hub's file transfers
+    TRANSFER = 253
+
+# Video streams are identified by the agent's mss monitor index
+DEFAULT_STREAM_ID = 1
+# mss monitor 0: the whole virtual desktop, spanning every monitor
+DESKTOP_STREAM_ID = 0
+
+# Positions in MOUSE_EVENT and CURSOR_POSITION payloads that name a "stream"
+# are normalized (0-1) within that stream's monitor; positions without one
+# are desktop pixels of the machine receiving them.
 
 def create_message(msg_type, payload):
-    return json.dumps({"type": msg_type, "payload": payload}).encode('utf-8')
+    # json.dumps never emits a raw newline, so it doubles as the message delimiter
+    return json.dumps({"type": msg_type, "payload": payload}).encode('utf-8') + b'\n'
+
+# A message with binary data attached (file chunks): a zero byte, which no
+# JSON message starts with, the 4-byte big-endian sizes of the JSON and of the
+# data, the JSON, then the data itself. MessageReader returns the data as the
+# message's "data".
+DATA_MARKER = 0
+DATA_HEADER = struct.Struct('>BII')
+
+def create_data_message(msg_type, payload, size):
+    """Everything that precedes `size` bytes of attached data."""
+    body = json.dumps({"type": msg_type, "payload": payload}).encode('utf-8')
+    return DATA_HEADER.pack(DATA_MARKER, len(body), size) + body
 
 def parse_message(data):
     return json.loads(data.decode('utf-8'))
+
+class MessageReader:
+    """
+    Splits a TCP byte stream back into messages. Several small control
+    messages (e.g. a burst of mouse moves) can arrive in a single recv().
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Adds received bytes and returns the list of complete messages."""
+        self.buffer.extend(data)
+        messages = []
+        while True:
+            if self.buffer and self.buffer[0] == DATA_MARKER:
+                message = self._take_data_message()
+                if message is None:
+                    break
+                messages.append(message)
+                continue
+            end = self.buffer.find(b'\n')
+            if end < 0:
+                break
+            line = bytes(self.buffer[:end])
+            del self.buffer[:end + 1]
+            if line.strip():
+                messages.append(parse_message(line))
+        return messages
+
+    def _take_data_message(self):
+        if len(self.buffer) < DATA_HEADER.size:
+            return None
+        _, body_size, data_size = DATA_HEADER.unpack_from(self.buffer)
+        end = DATA_HEADER.size + body_size + data_size
+        if len(self.buffer) < end:
+            return None
+        message = parse_message(bytes(self.buffer[DATA_HEADER.size:DATA_HEADER.size + body_size]))
+        message["data"] = bytes(self.buffer[DATA_HEADER.size + body_size:end])
+        del self.buffer[:end]
+        return message
@@ -1,43 +1,227 @@
 import struct
 import json
+import threading
+import weakref
+import zlib
+from collections import deque
 
-def send_framed(serial_conn, message_data):
+# Every frame: [1B type][1B flags][payload][4B CRC32 of everything before it],
+# COBS-encoded so it contains no zero bytes, between two zero delimiters.
+# Control messages are JSON; video frames carry the encoded bytes as they are.
+# A corrupted frame fails its CRC and is dropped, and the reader picks up again
+# at the next delimiter instead of trusting a length that may itself be corrupt.
+FRAME_HEADER = struct.Struct('>BB')
+FRAME_CRC = struct.Struct('>I')
+DELIMITER = b'\x00'
+MAX_FRAME_SIZE = 1 << 20  # Decoded bytes; anything longer is noise
+
+class FrameType:
+    CONTROL = 0  # UTF-8 JSON message {"type": ..., "payload": ...}
+    VIDEO = 1    # One JPEG video frame
+    H264 = 2     # H.264 access units of the agent's main stream
+    PROBE = 3    # Test data the agent echoes back while a baud rate is negotiated
+
+class FrameFlags:
+    KEYFRAME = 0x01  # The video frame decodes on its own
+
+class LinkMeter:
     """
-    Sends a framed message over a serial connection.
-    Each message is prefixed with a 4-byte length (big-endian).
+    Estimates what a serial link actually carries, from writes timed until
+    the port drained them, over the most recent writes. Until the first
+    measurement it assumes the rate a baud rate probe measured, if any, or
+    else the nominal rate of the baud rate (10 bits per byte with 8N1). USB
+    CDC links often run far faster than their nominal baud rate, which the
+    measurement picks up.
     """
+    def __init__(self, baudrate=115200, window=16, measured=None):
+        self.nominal = measured or baudrate / 10
+        self.samples = deque(maxlen=window)  # (bytes, seconds)
+
+    def record(self, size, elapsed):
+        if size > 0 and elapsed > 0:
+            self.samples.append((size, elapsed))
+
+    def bytes_per_second(self):
+        if not self.samples:
+            return self.nominal
+        return sum(size for size, _ in self.samples) / sum(elapsed for _, elapsed in self.samples)
+
+def cobs_encode(data):
+    """Consistent Overhead Byte Stuffing: data without zero bytes, at most 1 extra byte per 254."""
+    out = bytearray()
+    for block in bytes(data).split(DELIMITER):
+        # Each block is followed by an implied zero, except after a full 254-byte run
+        while len(block) >= 254:
+            out.append(0xFF)
+            out += block[:254]
+            block = block[254:]
+        out.append(len(block) + 1)
+        out += block
+    return bytes(out)
+
+def cobs_decode(data):
+    """Inverse of cobs_encode. Raises ValueError on input that cobs_encode cannot produce."""
+    out = bytearray()
+    i, n = 0, len(data)
+    while i < n:
+        code = data[i]
+        end = i + code
+        if code == 0 or end > n:
+            raise ValueError("invalid COBS block")
+        out += data[i + 1:end]
+        i = end
+        if code != 0xFF and i < n:
+            out.append(0)
+    return bytes(out)
+
+def encode_frame(frame_type, payload, flags=0):
+    """The bytes on the wire for one frame, delimiters included."""
+    body = FRAME_HEADER.pack(frame_type, flags) + bytes(payload)
+    return DELIMITER + cobs_encode(body + FRAME_CRC.pack(zlib.crc32(body))) + DELIMITER
+
+_write_locks = weakref.WeakKeyDictionary()  # Serial connection -> its write lock
+_write_locks_lock = threading.Lock()
+
+def write_lock(serial_conn):
+    """
+    The lock every frame written to serial_conn is sent under. pyserial may
+    split a write() into several OS writes, so without it frames written by
+    different threads (input, keyframe requests, file data, video) could
+    interleave on the wire.
+    """
+    with _write_locks_lock:
+        lock = _write_locks.get(serial_conn)
+        if lock is None:
+            lock = _write_locks[serial_conn] = threading.Lock()
+        return lock
+
+def send_frame(serial_conn, frame_type, payload, flags=0):
+    """Sends one typed frame over a serial connection, whole, under its write lock."""
+    wire = encode_frame(frame_type, payload, flags)
     try:
-        encoded_message = json.dumps(message_data).encode('utf-8')
-        frame = struct.pack('>I', len(encoded_message)) + encoded_message
-        serial_conn.write(frame)
+        with write_lock(serial_conn):
+            serial_conn.write(wire)
         return True
     except Exception as e:
-        print(f"Error sending framed message: {e}")
+        print(f"Error sending frame: {e}")
         return False
 
-def receive_framed(serial_conn):
-    """
-    Receives a framed message from a serial connection.
-    Returns the parsed message data (dict) or None on error.
-    """
+def send_framed(serial_conn, message_data):
+    """Sends a JSON control message as a CONTROL frame."""
+    try:
+        encoded_message = json.dumps(message_data).encode('utf-8')
+    except (TypeError, ValueError) as e:
+        print(f"Error encoding message: {e}")
+        return False
+    return send_frame(serial_conn, FrameType.CONTROL, encoded_message)
+
+def decode_control(payload):
+    """The message dict of a CONTROL frame's payload, or None if it is not valid JSON."""
     try:
-        # Read the 4-byte length prefix
-        len_prefix = serial_conn.read(4)
-        if not len_prefix or len(len_prefix) < 4:
-            return None # Connection closed or invalid data
-            
-        msg_len = struct.unpack('>I', len_prefix)[0]
-        
-        # Read the full message
-        encoded_message = serial_conn.read(msg_len)
-        if not encoded_message or len(encoded_message) < msg_len:
-            return None # Connection closed prematurely
-
-        return json.loads(encoded_message.decode('utf-8'))
-    except (struct.error, json.JSONDecodeError) as e:
+        return json.loads(payload.decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
         print(f"Error decoding message: {e}")
-        # Potentially clear the buffer or handle the error more gracefully
         return None
-    except Exception as e:
-        print(f"Error receiving framed message: {e}")
-        return None 
\ No newline at end of file
+
+class FrameReader:
+    """
+    Reads frames from a serial connection through a buffer. Each read takes
+    whatever the port has waiting (pyserial's in_waiting) rather than a
+    fixed count, so one read usually brings in several frames or a large
+    part of one. Frames that fail to decode or their CRC are counted in
+    dropped and skipped.
+    """
+    def __init__(self, serial_conn, max_frame_size=MAX_FRAME_SIZE):
+        self.conn = serial_conn
+        # Worst-case COBS growth, plus header and CRC
+        self.max_encoded = max_frame_size + max_frame_size // 254 + 16
+        self.buffer = bytearray()
+        self.scanned = 0  # Bytes of buffer known to hold no delimiter
+        self.discarding = False  # Inside an oversized run; drop up to the next delimiter
+        self.dropped = 0
+
+    def _fill(self):
+        waiting = getattr(self.conn, 'in_waiting', None)
+        size = 65536 if waiting is None else max(1, waiting)
+        chunk = self.conn.read(size)
+        if not chunk:
+            return False  # Timed out with nothing, or closed
+        self.buffer += chunk
+        return True
+
+    def _next_encoded(self):
+        """The next delimited run of bytes, or None when the connection has nothing more."""
+        while True:
+            end = self.buffer.find(DELIMITER, self.scanned)
+            if end >= 0:
+                encoded = bytes(self.buffer[:end])
+                del self.buffer[:end + 1]
+                self.scanned = 0
+                if self.discarding:
+                    self.discarding = False
+                    continue
+                return encoded
+            if len(self.buffer) > self.max_encoded:
+                # No delimiter where one must have been: drop it all and resync
+                if not self.discarding:
+                    self.dropped += 1
+                    print(f"Dropped an oversized serial frame ({len(self.buffer)}+ bytes)")
+                self.discarding = True
+                self.buffer.clear()
+            self.scanned = len(self.buffer)
+            try:
+                if not self._fill():
+                    return None
+            except Exception as e:
+                print(f"Error reading from serial port: {e}")
+                return None
+
+    def receive_frame(self):
+        """
+        Receives the next intact frame. Returns (frame_type, flags, payload
+        bytes), or None when the connection is closed or goes quiet.
+        """
+        while True:
+            encoded = self._next_encoded()
+            if encoded is None:
+                return None
+            if not encoded:
+                continue  # Between back-to-back delimiters
+            try:
+                frame = cobs_decode(encoded)
+            except ValueError:
+                frame = b''
+            if len(frame) < FRAME_HEADER.size + FRAME_CRC.size:
+                self._drop("undecodable")
+                continue
+            body, (crc,) = frame[:-FRAME_CRC.size], FRAME_CRC.unpack(frame[-FRAME_CRC.size:])
+            if zlib.crc32(body) != crc:
+                self._drop("CRC mismatch")
+                continue
+            frame_type, flags = FRAME_HEADER.unpack_from(body)
+            return frame_type, flags, body[FRAME_HEADER.size:]
+
+    def receive_framed(self):
+        """
+        Receives the next control message, skipping frames of other types.
+        Returns the parsed message data (dict) or None on error.
+        """
+        while True:
+            frame = self.receive_frame()
+            if frame is None:
+                return None
+            frame_type, _, payload = frame
+            if frame_type == FrameType.CONTROL:
+                message = decode_control(payload)
+                if message is not None:
+                    return message
+
+    def reset(self):
+        """Forgets buffered bytes, e.g. garbage received while the two ends ran at different baud rates."""
+        self.buffer.clear()
+        self.scanned = 0
+        self.discarding = False
+
+    def _drop(self, reason):
+        self.dropped += 1
+        print(f"Dropped a corrupt serial frame ({reason}); {self.dropped} so far")
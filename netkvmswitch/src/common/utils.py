@@ -1,5 +1,6 @@
 # Shared utilities
 import os
+import random
 import sys
 
 def resource_path(relative_path):
@@ -12,3 +13,14 @@ def resource_path(relative_path):
         base_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
     return os.path.join(base_path, relative_path)
+
+def user_data_path(filename):
+    """ Path to a per-user data file (cached benchmarks etc.), outside the install directory """
+    base_path = os.path.join(os.path.expanduser('~'), '.netkvmswitch')
+    os.makedirs(base_path, exist_ok=True)
+    return os.path.join(base_path, filename)
+
+def backoff_delay(attempt, initial, maximum, rand=random.random):
+    """ Exponential backoff with equal jitter: half the capped delay, plus up to as much again at random """
+    delay = min(maximum, initial * 2 ** min(attempt, 32))
+    return delay / 2 + rand() * delay / 2
@@ -16,9 +16,9 @@ logging.basicConfig(level=logging.INFO,
 from .client import SourceAgentClient
 from common.config import config
 
-def main(port=None, network_accessible=False):
+def main(port=None, network_accessible=False, backend=None):
     """Starts the source agent."""
-    agent = SourceAgentClient(server_port=port, network_accessible=network_accessible)
+    agent = SourceAgentClient(server_port=port, network_accessible=network_accessible, backend=backend)
     
     try:
         agent.start()
@@ -43,5 +43,8 @@ if __name__ == "__main__":
         parser = argparse.ArgumentParser()
         parser.add_argument("--port", type=int, default=config.client.server_port)
         parser.add_argument("--network-accessible", action="store_true")
+        parser.add_argument("--backend", default=None,
+                            help='Video pipeline backend: "auto", "python", "native" or capture/convert/encode, '
+                                 'e.g. "mss/i420/libx264" (default: client.pipeline_backend)')
         args = parser.parse_args()
-        main(port=args.port, network_accessible=args.network_accessible)
+        main(port=args.port, network_accessible=args.network_accessible, backend=args.backend)
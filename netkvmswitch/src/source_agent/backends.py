@@ -0,0 +1,369 @@
+# Capture / convert / encode backends for the agent's video pipeline
+
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+import av
+import cv2
+import numpy as np
+
+from source_agent.screen_capture import ScreenCapturer, DamageCapturer
+from common.utils import user_data_path
+from source_agent.encoder_tuning import x264_options, configured_settings
+
+# Stage registries, in order of preference: the first available entry is the
+# fallback whenever a requested stage cannot be used
+CAPTURERS = {}
+CONVERTERS = {}
+ENCODERS = {}
+
+BACKEND_CACHE_FILE = "pipeline_backend.json"
+
+def register(registry, name):
+    def decorator(cls):
+        cls.name = name
+        registry[name] = cls
+        return cls
+    return decorator
+
+def _native_module():
+    import kvmstream_native
+    return kvmstream_native
+
+# --- Capture: create(monitor_index) returns a ScreenCapturer-compatible object ---
+
+@register(CAPTURERS, "xdamage")
+class XDamageCapture:
+    @staticmethod
+    def available():
+        if not sys.platform.startswith('linux'):
+            return False
+        DamageCapturer().close()
+        return True
+
+    @staticmethod
+    def create(monitor_index):
+        return DamageCapturer(monitor_index)
+
+@register(CAPTURERS, "mss")
+class MssCapture:
+    @staticmethod
+    def available():
+        return True
+
+    @staticmethod
+    def create(monitor_index):
+        return ScreenCapturer(monitor_index)
+
+class NativeScreenCapturer(ScreenCapturer):
+    """kvmstream_native grabs the primary output; mss still reports geometry."""
+    def __init__(self, monitor_index=None):
+        super().__init__(monitor_index)
+        self.native = _native_module().ScreenCapturer()
+
+    def capture_frame(self):
+        try:
+            frame = np.asarray(self.native.capture_frame())
+            return frame[:, :, :3] if frame.ndim == 3 and frame.shape[2] == 4 else frame
+        except Exception as e:
+            print(f"Native screen capture error: {e}")
+            return None
+
+@register(CAPTURERS, "native")
+class NativeCapture:
+    @staticmethod
+    def available():
+        return NativeScreenCapturer().capture_frame() is not None
+
+    @staticmethod
+    def create(monitor_index):
+        # The native capturer only knows the primary output
+        if monitor_index not in (None, 1):
+            return ScreenCapturer(monitor_index)
+        return NativeScreenCapturer(monitor_index)
+
+# --- Convert: RGB frame -> encoder input at the output size ---
+
+@register(CONVERTERS, "i420")
+class I420Converter:
+    """Scales and converts to planar YUV 4:2:0 with OpenCV, so the encoder skips swscale."""
+    pixel_format = 'yuv420p'
+
+    @staticmethod
+    def available():
+        return True
+
+    def convert(self, frame, width, height):
+        if (frame.shape[1], frame.shape[0]) != (width, height):
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(frame, cv2.COLOR_RGB2YUV_I420)
+
+@register(CONVERTERS, "rgb")
+class RGBConverter:
+    """Scales only; the encoder converts RGB itself."""
+    pixel_format = 'rgb24'
+
+    @staticmethod
+    def available():
+        return True
+
+    def convert(self, frame, width, height):
+        if (frame.shape[1], frame.shape[0]) != (width, height):
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        return frame
+
+# --- Encode: Encoder(width, height, fps).encode(image, pixel_format, keyframe) -> H.264 bytes ---
+
+class PyAVEncoder:
+    codec = 'libx264'
+    options = {'crf': '23', 'preset': 'veryfast', 'tune': 'zerolatency'}
+    input_formats = ('yuv420p', 'rgb24')
+
+    def __init__(self, width, height, fps, bitrate=None):
+        container = av.open('dummy', mode='w', format='h264')
+        self.stream = container.add_stream(self.codec, rate=fps)
+        self.stream.width, self.stream.height = width, height
+        self.stream.pix_fmt = 'yuv420p'
+        options = self.encoder_options()
+        if bitrate:
+            # Capped rate instead of constant quality, for links that cannot carry more
+            options.pop('crf', None)
+            self.stream.bit_rate = bitrate
+            options.update({'maxrate': str(bitrate), 'bufsize': str(bitrate // 2)})
+        self.stream.options = options
+
+    def encoder_options(self):
+        return dict(self.options)
+
+    def encode(self, image, pixel_format, keyframe=False):
+        av_frame = av.VideoFrame.from_ndarray(image, format=pixel_format)
+        if keyframe:
+            av_frame.pict_type = av.video.frame.PictureType.I
+        return b"".join(bytes(p) for p in self.stream.encode(av_frame))
+
+    @classmethod
+    def available(cls):
+        # Hardware encoders are compiled into FFmpeg builds without the hardware
+        encoder = cls(64, 64, 30)
+        return encoder.encode(np.zeros((96, 64), dtype=np.uint8), 'yuv420p', keyframe=True) is not None
+
+@register(ENCODERS, "libx264")
+class X264Encoder(PyAVEncoder):
+    def encoder_options(self):
+        # Threading, preset and profile come from the auto-tuner via config
+        return x264_options(**configured_settings())
+
+@register(ENCODERS, "nvenc")
+class NvencEncoder(PyAVEncoder):
+    codec = 'h264_nvenc'
+    options = {'preset': 'p1', 'tune': 'ull', 'zerolatency': '1'}
+
+@register(ENCODERS, "qsv")
+class QsvEncoder(PyAVEncoder):
+    codec = 'h264_qsv'
+    options = {'preset': 'veryfast', 'low_power': '1'}
+
+@register(ENCODERS, "amf")
+class AmfEncoder(PyAVEncoder):
+    codec = 'h264_amf'
+    options = {'usage': 'ultralowlatency', 'quality': 'speed'}
+
+@register(ENCODERS, "native")
+class NativeEncoder:
+    """kvmstream_native.H264Encoder, configured through its StreamConfig."""
+    input_formats = ('rgb24',)
+
+    def __init__(self, width, height, fps):
+        native = _native_module()
+        self.config = native.StreamConfig()
+        self.config.width, self.config.height, self.config.fps = width, height, fps
+        self.config.tune = "zerolatency"
+        self.encoder = native.H264Encoder()
+        self.encoder.initialize(self.config)
+
+    def encode(self, image, pixel_format, keyframe=False):
+        if keyframe:
+            self.encoder.force_keyframe()
+        return bytes(self.encoder.encode(np.ascontiguousarray(image)))
+
+    @classmethod
+    def available(cls):
+        encoder = cls(64, 64, 30)
+        return encoder.encode(np.zeros((64, 64, 3), dtype=np.uint8), 'rgb24', keyframe=True) is not None
+
+# --- Selection ---
+
+class PipelineBackend:
+    """A capture/convert/encode combination, written as e.g. "mss/i420/libx264"."""
+    def __init__(self, capture, convert, encode):
+        self.capture, self.convert, self.encode = capture, convert, encode
+
+    @classmethod
+    def parse(cls, spec):
+        parts = spec.split("/")
+        if len(parts) != 3:
+            raise ValueError(f"Backend must be capture/convert/encode, got {spec!r}")
+        return cls(*parts)
+
+    def compatible(self):
+        return CONVERTERS[self.convert].pixel_format in ENCODERS[self.encode].input_formats
+
+    def create_capturer(self, monitor_index):
+        return CAPTURERS[self.capture].create(monitor_index)
+
+    def create_converter(self):
+        return CONVERTERS[self.convert]()
+
+    def create_encoder(self, width, height, fps):
+        return ENCODERS[self.encode](width, height, fps)
+
+    def __str__(self):
+        return f"{self.capture}/{self.convert}/{self.encode}"
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+# Named shortcuts for --backend
+ALIASES = {
+    "python": "xdamage/i420/libx264",
+    "native": "native/rgb/native",
+}
+
+_availability = {}
+
+def stage_available(registry, name):
+    """Probes a stage once per process; failures only mean "not available"."""
+    key = (id(registry), name)
+    if key not in _availability:
+        try:
+            _availability[key] = name in registry and bool(registry[name].available())
+        except Exception as e:
+            logging.info(f"Pipeline stage {name} unavailable: {e}")
+            _availability[key] = False
+    return _availability[key]
+
+def available_stages(registry):
+    return [name for name in registry if stage_available(registry, name)]
+
+def resolve_backend(spec):
+    """
+    Turns a backend spec or alias into a usable PipelineBackend. Stages that
+    are not available here fall back to the most preferred available one.
+    """
+    backend = PipelineBackend.parse(ALIASES.get(spec, spec))
+    for stage, registry in (("capture", CAPTURERS), ("convert", CONVERTERS), ("encode", ENCODERS)):
+        name = getattr(backend, stage)
+        if not stage_available(registry, name):
+            fallback = available_stages(registry)[0]
+            logging.warning(f"{stage} backend {name!r} unavailable, using {fallback!r}")
+            setattr(backend, stage, fallback)
+    if not backend.compatible():
+        backend.convert = next(name for name in available_stages(CONVERTERS)
+                               if CONVERTERS[name].pixel_format in ENCODERS[backend.encode].input_formats)
+    return backend
+
+def benchmark_backends(monitor_index=1, frames=30, tolerance=0.1):
+    """
+    Times every available capturer and every compatible convert/encode pair on
+    real screen content and returns (fastest backend, {stage: ms per frame}).
+    Within `tolerance` of the fastest, the more preferred entry wins.
+    """
+    results = {}
+
+    def fastest(timings):
+        best = min(timings.values())
+        return next(name for name, ms in timings.items() if ms <= best * (1 + tolerance))
+
+    capture_ms = {}
+    frame = None
+    for name in available_stages(CAPTURERS):
+        capturer = CAPTURERS[name].create(monitor_index)
+        started = time.perf_counter()
+        for _ in range(max(1, frames // 3)):
+            if isinstance(capturer, DamageCapturer):
+                capturer.frame = None  # Time a full grab, the worst case
+            grabbed = capturer.capture_frame()
+            if grabbed is not None and frame is None:
+                frame = grabbed.copy()
+        capture_ms[name] = (time.perf_counter() - started) * 1000 / max(1, frames // 3)
+        if hasattr(capturer, 'close'):
+            capturer.close()
+    results.update({f"capture:{name}": ms for name, ms in capture_ms.items()})
+
+    if frame is None:
+        frame = np.zeros((1080, 1920, 3), dtype=np.uint8)
+    height, width = frame.shape[0] & ~1, frame.shape[1] & ~1
+    frame = np.ascontiguousarray(frame[:height, :width])
+
+    pair_ms = {}
+    for convert, encode in itertools.product(available_stages(CONVERTERS), available_stages(ENCODERS)):
+        if not PipelineBackend(None, convert, encode).compatible():
+            continue
+        converter, encoder = CONVERTERS[convert](), ENCODERS[encode](width, height, 60)
+        started = time.perf_counter()
+        for i in range(frames):
+            # Change a strip each frame so the encoder sees motion
+            moving = frame.copy()
+            moving[(i * 16) % height:(i * 16) % height + 16] ^= 0xFF
+            encoder.encode(converter.convert(moving, width, height), converter.pixel_format, keyframe=(i == 0))
+        pair_ms[(convert, encode)] = (time.perf_counter() - started) * 1000 / frames
+    results.update({f"encode:{convert}/{encode}": ms for (convert, encode), ms in pair_ms.items()})
+
+    convert, encode = fastest(pair_ms)
+    return PipelineBackend(fastest(capture_ms), convert, encode), results
+
+def _fingerprint():
+    # A cached choice is only valid for the same machine and libraries
+    return {
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "av": av.__version__,
+        "stages": [available_stages(CAPTURERS), available_stages(CONVERTERS), available_stages(ENCODERS)],
+    }
+
+def select_backend(spec="auto", monitor_index=1, cache_file=None):
+    """
+    Backend for the pipeline. "auto" benchmarks on first run and caches the
+    fastest combination; anything else is an alias or an explicit spec.
+    """
+    if spec and spec != "auto":
+        return resolve_backend(spec)
+
+    cache_file = cache_file or user_data_path(BACKEND_CACHE_FILE)
+    fingerprint = _fingerprint()
+    try:
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        if cached.get("fingerprint") == fingerprint:
+            return resolve_backend(cached["backend"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    print("Benchmarking video pipeline backends (first run)...")
+    backend, results = benchmark_backends(monitor_index)
+    for stage, ms in sorted(results.items()):
+        print(f"  {stage:<28} {ms:7.2f} ms/frame")
+    print(f"Selected video pipeline backend: {backend}")
+    try:
+        with open(cache_file, 'w') as f:
+            json.dump({"fingerprint": fingerprint, "backend": str(backend), "results": results}, f, indent=2)
+    except OSError as e:
+        logging.warning(f"Could not cache backend choice: {e}")
+    return backend
+
+if __name__ == "__main__":
+    # Re-run the benchmark and refresh the cached choice
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the agent's video pipeline backends")
+    parser.add_argument("--monitor", type=int, default=1)
+    args = parser.parse_args()
+    cache = user_data_path(BACKEND_CACHE_FILE)
+    if os.path.exists(cache):
+        os.remove(cache)
+    select_backend("auto", args.monitor)
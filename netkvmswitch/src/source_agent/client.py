@@ -3,7 +3,6 @@
 import socket
 import threading
 import time
-import cv2
 import numpy as np
 from pynput.keyboard import Controller as KeyboardController, Key
 from pynput.mouse import Controller as MouseController, Button
@@ -12,98 +11,206 @@ import sys
 import os
 import logging
 import platform
-import av
+import uuid
 from multiprocessing import Process, Queue, shared_memory, Value
 
 from mss import mss
-from source_agent.screen_capture import ScreenCapturer
+from source_agent.screen_capture import CaptureScheduler, select_monitors
+from source_agent.backends import PipelineBackend, select_backend
+from source_agent.encoder_tuning import autotune
+from source_agent.stream_control import StreamControl
+from source_agent.cursor import create_cursor_tracker, encode_cursor_shape, map_to_stream
+from source_agent.input_injector import InputInjector, create_input_backend
 
 # Add the 'src' directory to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from common.protocol import create_message, parse_message, MessageType
+from common.protocol import create_message, parse_message, MessageType, MessageReader, VideoLayer, StreamProfile
 from common.config import config
-from common.utils import resource_path
+from common.file_transfer import FileTransferChannel, transfer_directory
+from common.clipboard import TEXT, ClipboardChannel, LocalClipboard, PasteHold, create_clipboard
+from common.utils import resource_path, backoff_delay
 from pynput import mouse, keyboard
 
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def video_pipeline_process(running_flag, encoded_packet_queue, shm_name, frame_shape, frame_dtype):
+# How often the capture thread re-reads monitor geometry (seconds)
+GEOMETRY_CHECK_INTERVAL = 2.0
+
+def video_pipeline_process(running_flag, encoded_packet_queue, streams, backend="mss/rgb/libx264"):
     """
     A separate process to handle the entire video pipeline (capture, encode)
     to bypass the GIL and improve performance.
+
+    streams is a list of dicts describing each captured monitor: its stream
+    id, mss monitor index, shared-memory buffer name, frame shape and the
+    StreamControl carrying the hub's profile and keyframe requests. Every
+    stream has its own buffer and encoder; a single capture thread grabs
+    changed monitors first and skips idle ones. Encoded packets are queued
+    as (stream_id, layer, data) tuples. backend names the capture/convert/
+    encode stages (see source_agent.backends), already resolved by the agent.
+
+    When a monitor changes resolution, its buffer is reallocated, its encoders
+    are rebuilt at the new size and a STREAM_RECONFIGURE message is queued
+    (layer VideoLayer.RECONFIGURE) ahead of the first packet at that size.
     """
     import queue
-    
-    # Attach to the shared memory block
-    existing_shm = shared_memory.SharedMemory(name=shm_name)
-    frame_buffer = np.ndarray(frame_shape, dtype=frame_dtype, buffer=existing_shm.buf)
+
+    backend = PipelineBackend.parse(backend)
+
+    # Attach to the shared memory blocks
+    shms = []
+    buffers = {}
+    frame_ready = {}
+    encode_locks = {}
+    for stream in streams:
+        existing_shm = shared_memory.SharedMemory(name=stream["shm_name"])
+        shms.append(existing_shm)
+        buffers[stream["id"]] = np.ndarray(stream["frame_shape"], dtype=np.uint8, buffer=existing_shm.buf)
+        frame_ready[stream["id"]] = threading.Event()
+        encode_locks[stream["id"]] = threading.Lock()
+
+    def reallocate_buffer(stream_id, frame_shape):
+        # Capture and encode share this process, so a plain array will do; the
+        # old buffer is freed once the encode thread (holding the lock) lets go
+        frame_buffer = np.empty(frame_shape, dtype=np.uint8)
+        buffers[stream_id] = frame_buffer
+        return frame_buffer
 
     # --- Inner functions for capture and encode ---
     def capture_frames():
-        capturer = ScreenCapturer()
-        frame_interval = 1.0 / 60.0
+        capturers = {stream["id"]: backend.create_capturer(stream["monitor"]) for stream in streams}
+        controls = {stream["id"]: stream["control"] for stream in streams}
+        scheduler = CaptureScheduler(capturers.keys(), max_idle_skip=4)
+        next_geometry_check = time.monotonic() + GEOMETRY_CHECK_INTERVAL
 
         while running_flag.value:
             try:
-                frame = capturer.capture_frame()
-                if frame is None: continue
-                
-                # Write directly to shared memory, resizing if necessary
-                if frame.shape != frame_shape:
-                    # This should only happen if the screen resolution changes
-                    # We need to resize to fit the shared memory buffer
-                    frame = cv2.resize(frame, (frame_shape[1], frame_shape[0]), interpolation=cv2.INTER_LINEAR)
-
-                np.copyto(frame_buffer, frame)
-
-                time.sleep(frame_interval)
+                intervals = {sid: control.frame_interval() for sid, control in controls.items()}
+                live = {sid for sid, interval in intervals.items() if interval is not None}
+                for sid in capturers.keys() - live:
+                    capturers[sid].discard_damage()
+                if not live:
+                    # Paused: nobody is watching this source
+                    time.sleep(0.1)
+                    continue
+
+                started = time.monotonic()
+                if started >= next_geometry_check:
+                    next_geometry_check = started + GEOMETRY_CHECK_INTERVAL
+                    for sid, capturer in capturers.items():
+                        if capturer.refresh_geometry():
+                            logging.warning(f"Monitor geometry changed (stream {sid}): {capturer.geometry()}")
+
+                for sid in scheduler.due_streams():
+                    if sid not in live:
+                        continue
+                    keyframe_pending = controls[sid].keyframe_pending()
+                    if keyframe_pending:
+                        scheduler.wake(sid)
+                    if not capturers[sid].poll_damage() and not keyframe_pending:
+                        continue  # Nothing was redrawn; the encoder keeps sleeping
+                    frame = capturers[sid].capture_frame()
+                    if frame is None: continue
+
+                    frame_buffer = buffers[sid]
+                    if frame.shape != frame_buffer.shape:
+                        # Buffers hold the even-sized area yuv420p can encode
+                        frame_shape = (frame.shape[0] & ~1, frame.shape[1] & ~1, 3)
+                        if frame_shape != frame_buffer.shape:
+                            # Resolution change: reconfigure the stream in place
+                            with encode_locks[sid]:
+                                frame_buffer = reallocate_buffer(sid, frame_shape)
+                                left, top, width, height = capturers[sid].geometry()
+                                encoded_packet_queue.put((sid, VideoLayer.RECONFIGURE, create_message(
+                                    MessageType.STREAM_RECONFIGURE,
+                                    {"stream": sid, "left": left, "top": top, "width": width, "height": height})))
+                            scheduler.wake(sid)
+                        frame = frame[:frame_shape[0], :frame_shape[1]]
+
+                    # Unchanged monitors are neither copied nor re-encoded
+                    changed = not np.array_equal(frame_buffer, frame)
+                    # Damage-driven capturers are cheap to poll, so they never back off
+                    scheduler.record(sid, changed or capturers[sid].tracks_damage)
+                    if changed:
+                        np.copyto(frame_buffer, frame)
+                    if changed or keyframe_pending:
+                        frame_ready[sid].set()
+
+                frame_interval = min(intervals[sid] for sid in live)
+                time.sleep(max(0.0, frame_interval - (time.monotonic() - started)))
             except Exception as e:
                 logging.error(f"[CaptureProcess] Error: {e}")
                 time.sleep(0.1)
 
-    def encode_frames():
-        encoder_name = 'libx264'
-        logging.warning(f"Using encoder: {encoder_name}")
+    def encode_frames(stream):
+        stream_id = stream["id"]
+        stream_control = stream["control"]
+        logging.warning(f"Using pipeline backend: {backend} (stream {stream_id})")
 
-        try:
-            container = av.open('dummy', mode='w', format='h264')
-            stream = container.add_stream(encoder_name, rate=60)
-            stream.width, stream.height = frame_shape[1], frame_shape[0]
-            stream.pix_fmt = 'yuv420p'
-            stream.options = {'crf': '23', 'preset': 'veryfast', 'tune': 'zerolatency'}
+        converter = backend.create_converter()
+        encoders = {}  # layer -> (width, height, fps, encoder)
+        last_encoded = {}
+        while running_flag.value:
+            try:
+                # Only encode frames the capture thread actually produced,
+                # or the unchanged buffer again when a viewer needs an IDR
+                if not frame_ready[stream_id].wait(timeout=0.1) and not stream_control.keyframe_pending():
+                    continue
+                frame_ready[stream_id].clear()
+                with encode_locks[stream_id]:
+                    encode_layers(stream_id, stream_control, converter, encoders, last_encoded)
+            except Exception as e:
+                logging.error(f"[EncodeProcess] Error: {e}")
+                time.sleep(0.1)
 
-            while running_flag.value:
-                try:
-                    # Read from shared memory
-                    frame = np.copy(frame_buffer)
-                    av_frame = av.VideoFrame.from_ndarray(frame, format='rgb24')
-                    
-                    packets = stream.encode(av_frame)
-                    if packets:
-                        packet_data = b"".join(bytes(p) for p in packets)
-                        if packet_data:
-                            encoded_packet_queue.put(packet_data)
-                    
-                    time.sleep(0.001) # Yield
-                except Exception as e:
-                    logging.error(f"[EncodeProcess] Error: {e}")
-                    time.sleep(0.1)
-        except Exception as e:
-            logging.error(f"[EncodeProcess] Initialization failed: {e}")
-
-    # Start capture and encode threads within the process
-    capture_thread = threading.Thread(target=capture_frames, daemon=True)
-    encode_thread = threading.Thread(target=encode_frames, daemon=True)
-    capture_thread.start()
-    encode_thread.start()
-    capture_thread.join()
-    encode_thread.join()
-    
-    existing_shm.close()
+    def encode_layers(stream_id, stream_control, converter, encoders, last_encoded):
+        # Read from shared memory; the buffer is replaced on resolution changes
+        frame = np.copy(buffers[stream_id])
+        frame_shape = frame.shape
+        # Converted frames are shared by every layer encoding at that size
+        converted_frames = {}
+        now = time.monotonic()
+
+        for layer, fps, scale in stream_control.layers():
+            # Capture runs at the fastest layer's rate; slower layers skip frames
+            if now - last_encoded.get(layer, 0) < 0.9 / fps and not stream_control.keyframe_pending(layer):
+                continue
+            last_encoded[layer] = now
+
+            out_w, out_h = stream_control.output_size(frame_shape[1], frame_shape[0], scale)
+            encoder = encoders.get(layer)
+            if encoder is None or encoder[:3] != (out_w, out_h, fps):
+                # Profile switch or resolution change: a fresh encoder
+                # starts with an IDR at the new size
+                encoder = (out_w, out_h, fps, backend.create_encoder(out_w, out_h, fps))
+                encoders[layer] = encoder
+
+            layer_image = converted_frames.get((out_w, out_h))
+            if layer_image is None:
+                layer_image = converter.convert(frame, out_w, out_h)
+                converted_frames[(out_w, out_h)] = layer_image
+
+            packet_data = encoder[3].encode(layer_image, converter.pixel_format,
+                                            keyframe=stream_control.take_keyframe_request(layer))
+            if packet_data:
+                encoded_packet_queue.put((stream_id, layer, packet_data))
+
+    # Start capture and per-stream encode threads within the process
+    threads = [threading.Thread(target=capture_frames, daemon=True)]
+    threads += [threading.Thread(target=encode_frames, args=(stream,), daemon=True) for stream in streams]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    buffers.clear()  # Drop the views so the blocks can be closed
+    for existing_shm in shms:
+        existing_shm.close()
 
 class SourceAgentClient:
-    def __init__(self, server_host=None, server_port=None, video_port=None, client_name=None, network_accessible=False):
+    def __init__(self, server_host=None, server_port=None, video_port=None, client_name=None, network_accessible=False,
+                 backend=None):
         self.server_host = "0.0.0.0" if network_accessible else (server_host or config.client.server_host)
         self.server_port = server_port or config.client.server_port
         self.video_port = video_port or config.client.video_port
@@ -112,62 +219,164 @@ class SourceAgentClient:
         self.control_socket = None
         self.video_socket = None
         self.video_process = None
-        self.shared_memory = None
+        self.shared_memories = []
         self.running_flag = None
+        self.streams = []  # One entry per captured monitor
+        self.stream_controls = {}
+        self.backend_spec = backend or config.client.pipeline_backend
+        self.pipeline_backend = None  # Resolved (and benchmarked) once per agent
+        self.control_send_lock = threading.Lock()
+        self.connection_id = 0  # Incremented on every connect; per-connection state resets with it
+        self.reconnect_started = None
+        self.last_reconnect_latency = None  # Seconds from reconnect to first frame sent
+        # Sent in every CLIENT_HELLO so the hub gives a reconnecting agent its slot back
+        self.session_id = uuid.uuid4().hex
+        self.ssl_context = None
+        self.tls_session = None  # Resumed on reconnect when the hub still accepts it
+        self.reconnect_lock = threading.Lock()
+        self.stop_requested = threading.Event()
+        self.supervisor_thread = None
 
         self.keyboard_controller = KeyboardController()
         self.mouse_controller = MouseController()
+        self.input_injector = InputInjector(create_input_backend(
+            config.client.input_backend, self.keyboard_controller, self.mouse_controller, Key, Button))
+        # Clipboard sync with the hub; a paste of content not yet here waits for it
+        interval = config.client.clipboard_poll_interval
+        self.clipboard = LocalClipboard(create_clipboard() if interval > 0 else None, self._on_local_clipboard,
+                                        interval)
+        self.clipboard_channel = None  # The current connection's
+        self.paste_hold = PasteHold(self.input_injector.submit, self._prepare_paste)
 
     def start(self):
-        self.running = True
+        self.stop_requested.clear()
         server_ip = self.server_host
-        
-        if not self._connect_to_server(server_ip):
-            return
 
-        self._start_streaming()
-        self._start_message_handler()
-        logging.info("Source Agent started and connected to server.")
+        if not self.streams:
+            self.streams = self._discover_streams()
+        self.input_injector.set_geometry(self.streams, self._desktop_geometry())
+        self.input_injector.start()
+        self.clipboard.start()
+        if self._connect_to_server(server_ip):
+            self.running = True
+            self._ensure_pipeline()
+            self._start_message_handler()
+            logging.info("Source Agent started and connected to server.")
+        else:
+            logging.warning("Hub not reachable yet; retrying in the background.")
+
+        if self.supervisor_thread is None or not self.supervisor_thread.is_alive():
+            self.supervisor_thread = threading.Thread(target=self._supervise_connection, daemon=True)
+            self.supervisor_thread.start()
+
+    def _ensure_pipeline(self):
+        if not self.pipeline_running():
+            self._start_streaming()
+            if config.client.cursor_rate > 0:
+                threading.Thread(target=self._track_cursor, daemon=True).start()
 
     def stop(self):
+        self.stop_requested.set()
         self.running = False
+        self.input_injector.stop()
+        self.clipboard.stop()
+        logging.info(f"Input injection: {self.input_injector.stats()}")
         if self.running_flag:
             self.running_flag.value = False
         if self.video_process:
             self.video_process.join(timeout=2)
             if self.video_process.is_alive():
                 self.video_process.terminate()
-        if self.shared_memory:
-            self.shared_memory.close()
-            self.shared_memory.unlink()
-        if self.control_socket: self.control_socket.close()
-        if self.video_socket: self.video_socket.close()
+        self.video_process = None
+        for shm in self.shared_memories:
+            shm.close()
+            shm.unlink()
+        self.shared_memories = []
+        self._close_connections()
         logging.info("Source Agent stopped.")
 
+    def pipeline_running(self):
+        return self.video_process is not None and self.video_process.is_alive()
+
+    def reconnect(self, delay=1.0):
+        """
+        Re-establishes the hub connections while the capture/encode process
+        keeps running: streams pause while disconnected, and the first frame
+        after reconnecting is an IDR from the already warm encoder.
+        """
+        with self.reconnect_lock:
+            self.reconnect_started = time.monotonic()
+            self._close_connections()
+            for control in self.stream_controls.values():
+                control.apply_status({"profile": StreamProfile.PAUSED})
+            if self.stop_requested.wait(delay) or not self._connect_to_server(self.server_host):
+                self.running = False  # The supervisor takes over
+                return False
+            self.running = True
+            self._ensure_pipeline()
+            # Owed before the hub's STREAM_STATUS resumes the streams
+            self.request_keyframe()
+            self._start_message_handler()
+            logging.info("Reconnected to server; video pipeline kept running.")
+            return True
+
+    def _supervise_connection(self):
+        """Reconnects with jittered exponential backoff whenever the hub connection is lost."""
+        attempt = 0
+        while not self.stop_requested.wait(0.05):
+            if self.running:
+                attempt = 0
+                continue
+            delay = backoff_delay(attempt, config.client.reconnect_initial_delay, config.client.reconnect_max_delay)
+            attempt += 1
+            logging.warning(f"Not connected to the hub; reconnect attempt {attempt} in {delay:.2f}s")
+            if self.reconnect(delay=delay):
+                logging.warning(f"Reconnected to the hub after {attempt} attempt(s)")
+
+    def _close_connections(self):
+        control_socket, video_socket = self.control_socket, self.video_socket
+        self.control_socket = self.video_socket = None
+        if control_socket is not None:
+            try:
+                # Available once the hub's session ticket arrived
+                self.tls_session = control_socket.session or self.tls_session
+            except (AttributeError, ValueError):
+                pass
+        for sock in (control_socket, video_socket):
+            if sock:
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+
     def _connect_to_server(self, server_ip):
         try:
-            context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-            context.load_cert_chain(
-                certfile=resource_path(os.path.join('certs', config.security.client_cert)), 
-                keyfile=resource_path(os.path.join('certs', config.security.client_key))
-            )
-            if server_ip in ['127.0.0.1', 'localhost']:
-                context.check_hostname = False
-                context.verify_mode = ssl.CERT_NONE
-            else:
-                context.load_verify_locations(resource_path(os.path.join('certs', config.security.ca_cert)))
-            
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.control_socket = context.wrap_socket(sock, server_hostname=server_ip)
-            self.control_socket.connect((server_ip, self.server_port))
-            logging.info(f"Control connection established with {server_ip}:{self.server_port}")
+            # One context for the agent's lifetime: session tickets are only resumable within it
+            if self.ssl_context is None:
+                self.ssl_context = self._create_ssl_context(server_ip)
 
-            hello_msg = create_message(MessageType.CLIENT_HELLO, {"name": self.client_name, "video_port": self.video_port})
-            self.control_socket.sendall(hello_msg)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Small control messages (handshake, hello, input) must not wait on Nagle
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            control_socket = self.ssl_context.wrap_socket(sock, server_hostname=server_ip, session=self.tls_session)
+            control_socket.connect((server_ip, self.server_port))
+            self.control_socket = control_socket
+            self.connection_id += 1
+            logging.info(f"Control connection established with {server_ip}:{self.server_port} "
+                         f"(TLS session resumed: {control_socket.session_reused})")
+
+            hello_msg = create_message(MessageType.CLIENT_HELLO, {
+                "name": self.client_name,
+                "session": self.session_id,
+                "video_port": self.video_port,
+                "simulcast": config.client.simulcast,
+                "streams": [{key: stream[key] for key in ("id", "monitor", "left", "top", "width", "height")}
+                            for stream in self.streams],
+            })
+            self._send_control(hello_msg)
             logging.info(f"Sent CLIENT_HELLO to server with name: {self.client_name}")
-            
-            time.sleep(0.5)
-            
+
+            # The hub waits for the hello before associating the video connection
             self.video_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.video_socket.connect((server_ip, self.video_port))
             logging.info(f"Video connection established with {server_ip}:{self.video_port}")
@@ -175,30 +384,83 @@ class SourceAgentClient:
             return True
         except Exception as e:
             logging.error(f"Failed to connect to server: {e}")
+            self._close_connections()
             return False
 
-    def _start_streaming(self):
+    def _create_ssl_context(self, server_ip):
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        context.load_cert_chain(
+            certfile=resource_path(os.path.join('certs', config.security.client_cert)),
+            keyfile=resource_path(os.path.join('certs', config.security.client_key))
+        )
+        if server_ip in ['127.0.0.1', 'localhost']:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        else:
+            context.load_verify_locations(resource_path(os.path.join('certs', config.security.ca_cert)))
+        return context
+
+    def _discover_streams(self):
+        """Describes each monitor selected in config as a separate stream."""
         with mss() as sct:
-            monitor = sct.monitors[1]
-            width, height = monitor['width'], monitor['height']
-
-        width = width if width % 2 == 0 else width - 1
-        height = height if height % 2 == 0 else height - 1
-        
-        frame_shape = (height, width, 3)
-        frame_dtype = np.uint8
-        frame_size = int(np.prod(frame_shape) * np.dtype(frame_dtype).itemsize)
-        
-        shm_name = f'netkvm_frame_buffer_{os.getpid()}_{time.time()}'
+            monitors = sct.monitors
+            indices = select_monitors(monitors, config.client.monitors, config.client.capture_combined)
+            streams = []
+            for index in indices:
+                monitor = monitors[index]
+                streams.append({
+                    "id": index,
+                    "monitor": index,
+                    "left": monitor['left'],
+                    "top": monitor['top'],
+                    "width": monitor['width'],
+                    "height": monitor['height'],
+                })
+        return streams
+
+    def _desktop_geometry(self):
+        """The whole virtual desktop (mss monitor 0) as left, top, width, height."""
+        with mss() as sct:
+            desktop = sct.monitors[0]
+        return desktop['left'], desktop['top'], desktop['width'], desktop['height']
 
-        self.shared_memory = shared_memory.SharedMemory(name=shm_name, create=True, size=frame_size)
+    def _start_streaming(self):
+        pipeline_streams = []
+        self.stream_controls = {}
+        for stream in self.streams:
+            width, height = stream['width'], stream['height']
+            width = width if width % 2 == 0 else width - 1
+            height = height if height % 2 == 0 else height - 1
+
+            frame_shape = (height, width, 3)
+            frame_dtype = np.uint8
+            frame_size = int(np.prod(frame_shape) * np.dtype(frame_dtype).itemsize)
+
+            shm_name = f'netkvm_frame_buffer_{os.getpid()}_{stream["id"]}_{time.time()}'
+            shm = shared_memory.SharedMemory(name=shm_name, create=True, size=frame_size)
+            self.shared_memories.append(shm)
+
+            control = StreamControl()
+            self.stream_controls[stream["id"]] = control
+            pipeline_streams.append({
+                "id": stream["id"],
+                "monitor": stream["monitor"],
+                "shm_name": shm.name,
+                "frame_shape": frame_shape,
+                "control": control,
+            })
+
+        if self.pipeline_backend is None:
+            self.pipeline_backend = select_backend(self.backend_spec, self.streams[0]["monitor"])
+            if self.pipeline_backend.encode == "libx264" and config.client.encoder_autotune:
+                self._autotune_encoder()
 
         encoded_packet_queue = Queue()
         self.running_flag = Value('b', True)
 
         self.video_process = Process(
             target=video_pipeline_process,
-            args=(self.running_flag, encoded_packet_queue, self.shared_memory.name, frame_shape, frame_dtype)
+            args=(self.running_flag, encoded_packet_queue, pipeline_streams, str(self.pipeline_backend))
         )
         self.video_process.daemon = True
         self.video_process.start()
@@ -206,76 +468,202 @@ class SourceAgentClient:
         network_thread = threading.Thread(target=self._network_sender, args=(encoded_packet_queue,), daemon=True)
         network_thread.start()
 
+    def _autotune_encoder(self):
+        """Tunes libx264 for the primary stream's resolution, once per resolution/fps/core count."""
+        stream = self.streams[0]
+        try:
+            sample = self.pipeline_backend.create_capturer(stream["monitor"]).capture_frame()
+            settings = autotune(stream["width"], stream["height"], config.server.active_stream_fps, sample)
+            logging.info(f"libx264 settings: {settings}")
+        except Exception as e:
+            logging.warning(f"Encoder auto-tuning failed, keeping configured settings: {e}")
+
     def _network_sender(self, encoded_packet_queue):
+        """Lives as long as the pipeline and sends over whichever video connection is current."""
         import queue
-        while self.running:
+        while self.running_flag.value:
             try:
-                packet_data = encoded_packet_queue.get(timeout=1.0)
-                if packet_data:
-                    frame_size = len(packet_data)
-                    self.video_socket.sendall(frame_size.to_bytes(4, 'big'))
-                    self.video_socket.sendall(packet_data)
+                stream_id, layer, packet_data = encoded_packet_queue.get(timeout=1.0)
             except queue.Empty:
                 continue
+            if layer == VideoLayer.RECONFIGURE:
+                self._update_stream_geometry(parse_message(packet_data)["payload"])
+            video_socket = self.video_socket
+            if video_socket is None or not packet_data:
+                continue  # Reconnecting; the new connection starts at an IDR anyway
+            try:
+                # Size covers the stream and layer bytes and the H.264 data
+                frame_size = len(packet_data) + 2
+                video_socket.sendall(frame_size.to_bytes(4, 'big') + bytes([stream_id, layer]))
+                video_socket.sendall(packet_data)
+                if self.reconnect_started is not None:
+                    self.last_reconnect_latency = time.monotonic() - self.reconnect_started
+                    self.reconnect_started = None
+                    logging.warning(f"First frame sent {self.last_reconnect_latency * 1000:.0f} ms after reconnecting")
             except (ConnectionResetError, BrokenPipeError):
-                logging.warning("Video connection lost.")
-                self.running = False
-                break
+                if video_socket is self.video_socket:
+                    logging.warning("Video connection lost.")
+                    self.running = False
             except Exception as e:
-                logging.error(f"Network sender error: {e}")
-                self.running = False
-                break
+                if video_socket is self.video_socket:
+                    logging.error(f"Network sender error: {e}")
+                    self.running = False
+
+    def _update_stream_geometry(self, geometry):
+        """Keeps the stream list (sent again in CLIENT_HELLO) in sync with a resolution change."""
+        for stream in self.streams:
+            if stream["id"] == geometry["stream"]:
+                stream.update({key: geometry[key] for key in ("left", "top", "width", "height")})
+        self.input_injector.set_geometry(self.streams, self._desktop_geometry())
+        logging.warning(f"Stream {geometry['stream']} reconfigured to {geometry['width']}x{geometry['height']}")
+
+    def _send_control(self, message):
+        # Several threads send on the control connection
+        with self.control_send_lock:
+            if self.control_socket is None:
+                raise ConnectionError("Not connected to the hub")
+            self.control_socket.sendall(message)
+
+    def _track_cursor(self):
+        """
+        Sends the pointer as a side channel to the video: its position on
+        every change and each shape once, keyed by hash. The browser draws it
+        as an overlay, so pointer motion never needs an encoded frame.
+        """
+        tracker = create_cursor_tracker()
+        if tracker is None:
+            return
+        interval = 1.0 / config.client.cursor_rate
+        shape_hashes = {}  # Backend shape key -> hash
+        sent_shapes = set()
+        last_position = None
+        connection_id = self.connection_id
+        while self.running_flag.value:
+            time.sleep(interval)
+            if connection_id != self.connection_id:
+                # A new hub connection has seen none of our shapes
+                connection_id = self.connection_id
+                sent_shapes.clear()
+                last_position = None
+            if all(control.paused for control in self.stream_controls.values()):
+                last_position = None  # Resend once someone watches again
+                continue
+            try:
+                x, y, visible, shape_key = tracker.poll()
+                shape_hash = None
+                if visible and shape_key is not None:
+                    shape_hash = shape_hashes.get(shape_key)
+                    if shape_hash is None:
+                        shape = tracker.shape()
+                        payload = encode_cursor_shape(*shape) if shape else None
+                        if payload:
+                            shape_hash = payload["hash"]
+                            if len(shape_hashes) > 256:
+                                shape_hashes.clear()
+                            shape_hashes[shape_key] = shape_hash
+                            if shape_hash not in sent_shapes:
+                                self._send_control(create_message(MessageType.CURSOR_SHAPE, payload))
+                                sent_shapes.add(shape_hash)
+
+                stream_id, fx, fy = map_to_stream(self.streams, x, y) if visible else (None, None, None)
+                position = {"stream": stream_id, "shape": shape_hash,
+                            "x": round(fx, 4) if fx is not None else None,
+                            "y": round(fy, 4) if fy is not None else None}
+                if position != last_position:
+                    self._send_control(create_message(MessageType.CURSOR_POSITION, position))
+                    last_position = position
+            except OSError:
+                # Disconnected; resend everything on the next connection
+                last_position = None
+            except Exception as e:
+                logging.error(f"Cursor tracking error: {e}")
+                time.sleep(1)
 
     def _start_message_handler(self):
         handler_thread = threading.Thread(target=self._handle_server_messages, daemon=True)
         handler_thread.start()
 
     def _handle_server_messages(self):
-        while self.running:
+        # Each handler serves one connection; a reconnect starts a new handler
+        sock = self.control_socket
+        reader = MessageReader()
+        # Files the hub pushes or pulls; pulled file data yields to the video connection
+        files = FileTransferChannel(sock, self.control_send_lock, transfer_directory(config.client.file_transfer_dir),
+                                    config.client.file_transfer_rate, yield_to=lambda: [self.video_socket])
+        clipboard = ClipboardChannel(sock, self.control_send_lock, files.gate, self.clipboard.content,
+                                     self._on_hub_clipboard)
+        self.clipboard_channel = clipboard
+        while self.running and sock is self.control_socket:
             try:
-                data = self.control_socket.recv(4096)
+                data = sock.recv(65536)  # File chunks arrive here too
                 if not data:
                     logging.warning("Server closed the connection.")
                     break
-                message = parse_message(data)
-                self._handle_command(message)
+                for message in reader.feed(data):
+                    if not files.handle(message) and not clipboard.handle(message):
+                        self._handle_command(message)
             except (ConnectionResetError, BrokenPipeError):
                 logging.warning("Connection to server was reset.")
                 break
             except Exception as e:
-                if self.running: logging.error(f"Error handling server message: {e}")
+                if self.running and sock is self.control_socket:
+                    logging.error(f"Error handling server message: {e}")
                 break
-        self.running = False
+        files.close()
+        clipboard.close()
+        if sock is self.control_socket:
+            self.running = False
 
     def _handle_command(self, message):
         msg_type = message.get("type")
         payload = message.get("payload")
-        if msg_type == MessageType.KEY_EVENT: self._inject_key_event(payload)
-        elif msg_type == MessageType.MOUSE_EVENT: self._inject_mouse_event(payload)
+        if msg_type in (MessageType.KEY_EVENT, MessageType.MOUSE_EVENT): self.paste_hold.submit(msg_type, payload)
+        elif msg_type == MessageType.REQUEST_KEYFRAME: self.request_keyframe((payload or {}).get("stream"))
+        elif msg_type == MessageType.STREAM_STATUS: self._apply_stream_status(payload)
         elif msg_type == MessageType.RESTART:
+            # Only the connections restart; the capture/encode process stays warm
             logging.warning("Restart command received from hub.")
-            self.stop()
-            time.sleep(1)
-            self.start()
+            self.reconnect()
 
-    def _inject_key_event(self, payload):
-        event_type, key_str = payload["event_type"], payload["key"]
+    def _on_local_clipboard(self, payload):
+        channel = self.clipboard_channel
+        if channel is None:
+            return
         try:
-            key = getattr(Key, key_str.split('.')[-1]) if key_str.startswith('Key.') else key_str
-            if event_type == "press": self.keyboard_controller.press(key)
-            elif event_type == "release": self.keyboard_controller.release(key)
-        except Exception as e:
-            logging.error(f"Error injecting key event {key_str}: {e}")
-
-    def _inject_mouse_event(self, payload):
-        event_type = payload["event_type"]
-        if event_type == "click":
-            button = getattr(Button, payload["button"].split('.')[-1])
-            self.mouse_controller.position = (payload["x"], payload["y"])
-            if payload["pressed"]: self.mouse_controller.press(button)
-            else: self.mouse_controller.release(button)
-        elif event_type == "scroll": self.mouse_controller.scroll(payload["dx"], payload["dy"])
-        elif event_type == "move": self.mouse_controller.position = (payload["x"], payload["y"])
+            channel.announce(payload)
+        except OSError:
+            pass  # Disconnected; the next change is announced on the next connection
+
+    def _on_hub_clipboard(self, payload):
+        """Text is set at once; larger content is fetched when it is pasted (_prepare_paste)."""
+        if "text" in payload:
+            self.clipboard.write(TEXT, payload["text"].encode('utf-8'))
+
+    def _prepare_paste(self):
+        channel = self.clipboard_channel
+        announced = channel.pending if channel is not None else None
+        if announced is None or self.clipboard.content(announced["hash"]) is not None:
+            return None
+
+        def fetch():
+            data = channel.fetch(announced["hash"])
+            if data is not None:
+                self.clipboard.write(announced["mime"], data)
+        return fetch
+
+    def request_keyframe(self, stream_id=None):
+        """Makes the video pipeline encode its next frame as an IDR (all streams by default)."""
+        for sid, control in self.stream_controls.items():
+            if stream_id is None or sid == stream_id:
+                control.request_keyframe()
+
+    def _apply_stream_status(self, payload):
+        # A status without a stream id applies to every monitor
+        stream_id = payload.get("stream")
+        for sid, control in self.stream_controls.items():
+            if stream_id is None or sid == stream_id:
+                control.apply_status(payload)
+        logging.info(f"Stream profile set to {payload.get('profile')}")
 
 def main():
     if sys.platform == 'win32':
@@ -285,8 +673,9 @@ def main():
     client = SourceAgentClient()
     try:
         client.start()
-        while client.running:
-            time.sleep(1)
+        # Not client.running: that drops whenever the hub goes away, and the supervisor reconnects
+        while not client.stop_requested.wait(1):
+            pass
     except KeyboardInterrupt:
         print("Shutting down client...")
     finally:
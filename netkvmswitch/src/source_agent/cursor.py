@@ -0,0 +1,204 @@
+# Pointer position and shape, sent to the hub as a side channel to the video
+
+import base64
+import hashlib
+import logging
+import sys
+
+import cv2
+import numpy as np
+
+def _unpremultiply(rgb, alpha):
+    """Straight-alpha RGBA from premultiplied colour, as PNG expects."""
+    rgb = rgb.astype(np.uint32)
+    a = alpha.astype(np.uint32)[:, :, None]
+    straight = np.where(a > 0, np.minimum(rgb * 255 // np.maximum(a, 1), 255), 0)
+    return np.dstack([straight, alpha]).astype(np.uint8)
+
+class PynputCursor:
+    """Position only; the browser draws a default pointer."""
+    def __init__(self):
+        from pynput.mouse import Controller
+        self.mouse = Controller()
+
+    def poll(self):
+        x, y = self.mouse.position
+        return int(x), int(y), True, None
+
+    def shape(self):
+        return None
+
+class X11Cursor:
+    """
+    XFixes reports position, shape and a serial that changes with the
+    shape, so the image is only converted when the serial is new.
+    """
+    def __init__(self):
+        from Xlib import display
+        self.display = display.Display()
+        if not self.display.has_extension('XFIXES'):
+            raise RuntimeError("XFIXES extension not available")
+        self.display.xfixes_query_version()
+        self.root = self.display.screen().root
+        self.image = None
+
+    def poll(self):
+        self.image = self.display.xfixes_get_cursor_image(self.root)
+        return self.image.x, self.image.y, True, self.image.cursor_serial
+
+    def shape(self):
+        image = self.image
+        if image is None or not image.width or not image.height:
+            return None
+        # Premultiplied 32-bit ARGB per pixel, i.e. BGRA in little-endian byte order
+        argb = np.array(image.cursor_image, dtype='<u4').reshape(image.height, image.width)
+        bgra = argb.view(np.uint8).reshape(image.height, image.width, 4)
+        return _unpremultiply(bgra[:, :, 2::-1], bgra[:, :, 3]), image.xhot, image.yhot
+
+class WindowsCursor:
+    """
+    GetCursorInfo gives position, visibility and the cursor handle. Shapes are
+    rendered with DrawIconEx over black and over white; the difference yields
+    alpha for colour, monochrome and animated cursors alike.
+    """
+    def __init__(self):
+        import ctypes
+        from ctypes import wintypes
+        self.ctypes = ctypes
+        # Private instances: handles need 64-bit prototypes, which must not leak into pynput's windll
+        self.user32 = ctypes.WinDLL('user32')
+        self.gdi32 = ctypes.WinDLL('gdi32')
+        handle, hdc, hbitmap = wintypes.HANDLE, wintypes.HDC, wintypes.HBITMAP
+        prototypes = {
+            (self.user32, 'GetCursorInfo'): (wintypes.BOOL, [ctypes.c_void_p]),
+            (self.user32, 'GetIconInfo'): (wintypes.BOOL, [handle, ctypes.c_void_p]),
+            (self.user32, 'GetSystemMetrics'): (ctypes.c_int, [ctypes.c_int]),
+            (self.user32, 'GetDC'): (hdc, [wintypes.HWND]),
+            (self.user32, 'ReleaseDC'): (ctypes.c_int, [wintypes.HWND, hdc]),
+            (self.user32, 'DrawIconEx'): (wintypes.BOOL, [hdc, ctypes.c_int, ctypes.c_int, handle, ctypes.c_int,
+                                                          ctypes.c_int, wintypes.UINT, handle, wintypes.UINT]),
+            (self.gdi32, 'CreateCompatibleDC'): (hdc, [hdc]),
+            (self.gdi32, 'CreateCompatibleBitmap'): (hbitmap, [hdc, ctypes.c_int, ctypes.c_int]),
+            (self.gdi32, 'SelectObject'): (handle, [hdc, handle]),
+            (self.gdi32, 'DeleteObject'): (wintypes.BOOL, [handle]),
+            (self.gdi32, 'DeleteDC'): (wintypes.BOOL, [hdc]),
+            (self.gdi32, 'PatBlt'): (wintypes.BOOL, [hdc, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                                     wintypes.DWORD]),
+            (self.gdi32, 'GetDIBits'): (ctypes.c_int, [hdc, hbitmap, wintypes.UINT, wintypes.UINT, ctypes.c_void_p,
+                                                       ctypes.c_void_p, wintypes.UINT]),
+        }
+        for (library, name), (restype, argtypes) in prototypes.items():
+            function = getattr(library, name)
+            function.restype, function.argtypes = restype, argtypes
+
+        class CURSORINFO(ctypes.Structure):
+            _fields_ = [("cbSize", wintypes.DWORD), ("flags", wintypes.DWORD),
+                        ("hCursor", wintypes.HANDLE), ("ptScreenPos", wintypes.POINT)]
+
+        class ICONINFO(ctypes.Structure):
+            _fields_ = [("fIcon", wintypes.BOOL), ("xHotspot", wintypes.DWORD), ("yHotspot", wintypes.DWORD),
+                        ("hbmMask", wintypes.HBITMAP), ("hbmColor", wintypes.HBITMAP)]
+
+        self.CURSORINFO = CURSORINFO
+        self.ICONINFO = ICONINFO
+        self.handle = None
+
+    def poll(self):
+        info = self.CURSORINFO(cbSize=self.ctypes.sizeof(self.CURSORINFO))
+        if not self.user32.GetCursorInfo(self.ctypes.byref(info)):
+            raise RuntimeError("GetCursorInfo failed")
+        self.handle = info.hCursor
+        visible = bool(info.flags & 0x1) and bool(info.hCursor)  # CURSOR_SHOWING
+        return info.ptScreenPos.x, info.ptScreenPos.y, visible, info.hCursor
+
+    def shape(self):
+        if not self.handle:
+            return None
+        ctypes = self.ctypes
+        icon_info = self.ICONINFO()
+        if not self.user32.GetIconInfo(self.handle, ctypes.byref(icon_info)):
+            return None
+        for bitmap in (icon_info.hbmMask, icon_info.hbmColor):
+            if bitmap:
+                self.gdi32.DeleteObject(bitmap)
+
+        width = self.user32.GetSystemMetrics(13)   # SM_CXCURSOR
+        height = self.user32.GetSystemMetrics(14)  # SM_CYCURSOR
+        screen_dc = self.user32.GetDC(None)
+        mem_dc = self.gdi32.CreateCompatibleDC(screen_dc)
+        bitmap = self.gdi32.CreateCompatibleBitmap(screen_dc, width, height)
+        previous = self.gdi32.SelectObject(mem_dc, bitmap)
+        try:
+            renders = []
+            for rop in (0x00000042, 0x00FF0062):  # BLACKNESS, WHITENESS
+                self.gdi32.PatBlt(mem_dc, 0, 0, width, height, rop)
+                self.user32.DrawIconEx(mem_dc, 0, 0, self.handle, width, height, 0, None, 0x0003)  # DI_NORMAL
+                renders.append(self._read_bitmap(mem_dc, bitmap, width, height))
+        finally:
+            self.gdi32.SelectObject(mem_dc, previous)
+            self.gdi32.DeleteObject(bitmap)
+            self.gdi32.DeleteDC(mem_dc)
+            self.user32.ReleaseDC(None, screen_dc)
+
+        on_black, on_white = (render[:, :, :3].astype(np.int16) for render in renders)
+        alpha = 255 - np.clip((on_white - on_black).max(axis=2), 0, 255)
+        # Over black, the composite is the premultiplied colour
+        return _unpremultiply(on_black[:, :, ::-1], alpha), icon_info.xHotspot, icon_info.yHotspot
+
+    def _read_bitmap(self, dc, bitmap, width, height):
+        ctypes = self.ctypes
+        header = (ctypes.c_uint32 * 10)()
+        header[0] = 40  # sizeof(BITMAPINFOHEADER)
+        header[1] = width
+        header[2] = ctypes.c_uint32(-height).value  # Top-down rows
+        header[3] = 1 | (32 << 16)  # biPlanes, biBitCount
+        pixels = ctypes.create_string_buffer(width * height * 4)
+        self.gdi32.GetDIBits(dc, bitmap, 0, height, pixels, header, 0)  # DIB_RGB_COLORS
+        return np.frombuffer(pixels.raw, dtype=np.uint8).reshape(height, width, 4)  # BGRA
+
+def create_cursor_tracker():
+    """Best available backend for this platform; position-only as a fallback."""
+    backends = []
+    if sys.platform == 'win32':
+        backends.append(WindowsCursor)
+    elif sys.platform.startswith('linux'):
+        backends.append(X11Cursor)
+    backends.append(PynputCursor)
+    for backend in backends:
+        try:
+            return backend()
+        except Exception as e:
+            logging.warning(f"Cursor backend {backend.__name__} unavailable: {e}")
+    return None
+
+def encode_cursor_shape(rgba, hot_x, hot_y):
+    """CURSOR_SHAPE payload: the image as a PNG, keyed by a hash of its pixels."""
+    digest = hashlib.sha1(rgba.tobytes())
+    digest.update(f"{rgba.shape}:{hot_x}:{hot_y}".encode('utf-8'))
+    ok, png = cv2.imencode('.png', cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA))
+    if not ok:
+        return None
+    return {
+        "hash": digest.hexdigest()[:16],
+        "width": int(rgba.shape[1]),
+        "height": int(rgba.shape[0]),
+        "hot_x": int(hot_x),
+        "hot_y": int(hot_y),
+        "png": base64.b64encode(png.tobytes()).decode('ascii'),
+    }
+
+def map_to_stream(streams, x, y):
+    """
+    Finds the stream (monitor) containing desktop point x, y and returns
+    (stream_id, fx, fy) with fx, fy normalized to that stream, or
+    (None, None, None) when the pointer is on no captured monitor. Physical
+    monitors win over the combined virtual screen (stream 0).
+    """
+    for stream in sorted(streams, key=lambda s: s["id"] == 0):
+        left, top = stream.get("left", 0), stream.get("top", 0)
+        width, height = stream.get("width"), stream.get("height")
+        if not width or not height:
+            continue
+        if left <= x < left + width and top <= y < top + height:
+            return stream["id"], (x - left) / width, (y - top) / height
+    return None, None, None
@@ -0,0 +1,156 @@
+# libx264 threading / preset / profile auto-tuning for the agent's machine
+
+import os
+import time
+
+import av
+import cv2
+import numpy as np
+
+from common.config import config, save_client_settings
+
+PRESETS = ("ultrafast", "superfast", "veryfast")
+PROFILES = ("baseline", "main", "high")
+
+def x264_options(threads=0, sliced_threads=True, preset="veryfast", profile=""):
+    """libx264 options for a set of tuned settings (threads 0 = libx264's own choice)."""
+    options = {'crf': '23', 'preset': preset, 'tune': 'zerolatency'}
+    if threads:
+        options['threads'] = str(threads)
+    if not sliced_threads:
+        # zerolatency implies sliced threads; frame threads trade latency for throughput
+        options['x264-params'] = 'sliced-threads=0'
+    if profile:
+        options['profile'] = profile
+    return options
+
+def configured_settings(client_config=None):
+    client_config = client_config or config.client
+    return {
+        "threads": client_config.encoder_threads,
+        "sliced_threads": client_config.encoder_sliced_threads,
+        "preset": client_config.encoder_preset,
+        "profile": client_config.encoder_profile,
+    }
+
+def tuning_key(width, height, fps):
+    """What a tuning result is valid for; re-tuned when any of it changes."""
+    return f"{width}x{height}@{fps} on {os.cpu_count()} cores"
+
+def thread_candidates(cores=None):
+    cores = cores or os.cpu_count() or 1
+    return sorted({0, 1, 2, max(1, cores // 2), cores} if cores > 1 else {0, 1})
+
+def motion_frames(sample, width, height, count):
+    """I420 frames of the sample with a moving band, so the encoder sees motion."""
+    base = cv2.resize(sample, (width, height), interpolation=cv2.INTER_AREA) if sample is not None \
+        else cv2.GaussianBlur(np.random.randint(0, 255, (height, width, 3), dtype=np.uint8), (31, 31), 0)
+    frames = []
+    for i in range(count):
+        moving = base.copy()
+        row = (i * 16) % max(1, height - 16)
+        moving[row:row + 16] ^= 0xFF
+        frames.append(cv2.cvtColor(moving, cv2.COLOR_RGB2YUV_I420))
+    return frames
+
+def measure(settings, frames, width, height, fps):
+    """Encodes the frames with the given settings and reports speed, CPU and latency."""
+    container = av.open('dummy', mode='w', format='h264')
+    stream = container.add_stream('libx264', rate=fps)
+    stream.width, stream.height = width, height
+    stream.pix_fmt = 'yuv420p'
+    stream.options = x264_options(**settings)
+
+    first_output = None
+    total_bytes = 0
+    started, cpu_started = time.perf_counter(), time.process_time()
+    for i, image in enumerate(frames):
+        packets = stream.encode(av.VideoFrame.from_ndarray(image, format='yuv420p'))
+        if packets and first_output is None:
+            first_output = i
+        total_bytes += sum(p.size for p in packets)
+    wall, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+
+    ms_per_frame = wall * 1000 / len(frames)
+    # Frame threading holds frames back; each one held costs a frame interval
+    delay_frames = first_output if first_output is not None else len(frames)
+    return {
+        "settings": dict(settings),
+        "ms_per_frame": ms_per_frame,
+        "cpu_percent": cpu / wall * 100 if wall else 0.0,
+        "cpu_ms_per_frame": cpu * 1000 / len(frames),
+        "latency_ms": ms_per_frame + delay_frames * 1000 / fps,
+        "bytes_per_frame": total_bytes / len(frames),
+    }
+
+def tune_encoder(width, height, fps, sample=None, frames=30, max_bitrate_ratio=1.25, report=print):
+    """
+    Searches threads, sliced threads, preset and profile one dimension at a
+    time, starting from the configured settings. A candidate qualifies when
+    its latency stays under 80% of the frame interval and its bitrate under
+    max_bitrate_ratio times the starting point's; the qualifying candidate
+    using the least CPU per frame wins. Returns (settings, results).
+    """
+    width, height = width & ~1, height & ~1
+    images = motion_frames(sample, width, height, frames)
+    budget_ms = 0.8 * 1000 / fps
+    baseline = measure(configured_settings(), images, width, height, fps)
+    results = [baseline]
+
+    def rank(result):
+        qualifies = (result["latency_ms"] <= budget_ms
+                     and result["bytes_per_frame"] <= baseline["bytes_per_frame"] * max_bitrate_ratio)
+        return (not qualifies, result["cpu_ms_per_frame"] if qualifies else result["latency_ms"])
+
+    best = baseline
+    dimensions = (("threads", thread_candidates()), ("sliced_threads", (True, False)),
+                  ("preset", PRESETS), ("profile", PROFILES))
+    for key, values in dimensions:
+        for value in values:
+            settings = dict(best["settings"], **{key: value})
+            if any(result["settings"] == settings for result in results):
+                continue
+            result = measure(settings, images, width, height, fps)
+            results.append(result)
+            if rank(result) < rank(best):
+                best = result
+
+    if report:
+        report(f"Encoder tuning at {width}x{height}@{fps} (budget {budget_ms:.1f} ms):")
+        report(f"  {'threads':>7} {'sliced':>6} {'preset':>9} {'profile':>8} {'ms/frame':>9} "
+               f"{'CPU%':>6} {'latency':>8} {'KB/frame':>9}")
+        for result in results:
+            s = result["settings"]
+            marker = " *" if result is best else ""
+            report(f"  {s['threads'] or 'auto':>7} {str(s['sliced_threads']):>6} {s['preset']:>9} "
+                   f"{s['profile'] or 'default':>8} {result['ms_per_frame']:9.2f} {result['cpu_percent']:6.0f} "
+                   f"{result['latency_ms']:8.2f} {result['bytes_per_frame'] / 1024:9.1f}{marker}")
+    return best["settings"], results
+
+def autotune(width, height, fps, sample=None, force=False):
+    """Tunes once per resolution/fps/core count and persists the result in config."""
+    key = tuning_key(width, height, fps)
+    if not force and config.client.encoder_tuned_for == key:
+        return configured_settings()
+    settings, _ = tune_encoder(width, height, fps, sample)
+    save_client_settings({
+        "encoder_threads": settings["threads"],
+        "encoder_sliced_threads": settings["sliced_threads"],
+        "encoder_preset": settings["preset"],
+        "encoder_profile": settings["profile"],
+        "encoder_tuned_for": key,
+    })
+    return settings
+
+if __name__ == "__main__":
+    # Re-tune on demand, e.g. after changing the monitor resolution
+    import argparse
+    from mss import mss
+    parser = argparse.ArgumentParser(description="Tune libx264 threading and preset for this machine")
+    parser.add_argument("--monitor", type=int, default=1)
+    parser.add_argument("--fps", type=int, default=60)
+    args = parser.parse_args()
+    with mss() as sct:
+        monitor = sct.monitors[min(args.monitor, len(sct.monitors) - 1)]
+        sample = cv2.cvtColor(np.array(sct.grab(monitor)), cv2.COLOR_BGRA2RGB)
+    print(autotune(monitor["width"], monitor["height"], args.fps, sample, force=True))
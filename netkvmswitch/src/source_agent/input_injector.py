@@ -1 +1,222 @@
-# Injects K/M events
\ No newline at end of file
+# Keyboard and mouse injection on the agent, off the network thread
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from common.protocol import MessageType, DESKTOP_STREAM_ID
+
+def build_key_table(key_enum):
+    """Maps the hub's "Key.<name>" strings to pynput keys once, instead of per event."""
+    return {f"Key.{key.name}": key for key in key_enum}
+
+def build_button_table(button_enum):
+    return {f"Button.{button.name}": button for button in button_enum}
+
+def coalesce(events):
+    """
+    Collapses each run of consecutive mouse moves to its last move. Other
+    events keep their order, so a move before a click still lands first.
+    Returns the events to inject and the number dropped.
+    """
+    result = []
+    for event in events:
+        _, msg_type, payload = event
+        if (msg_type == MessageType.MOUSE_EVENT and payload.get("event_type") == "move" and result
+                and result[-1][1] == MessageType.MOUSE_EVENT and result[-1][2].get("event_type") == "move"):
+            result[-1] = event
+        else:
+            result.append(event)
+    return result, len(events) - len(result)
+
+class CoordinateMapper:
+    """
+    Maps stream-normalized pointer positions to desktop pixels. The
+    per-stream offset and scale are precomputed whenever the geometry
+    changes, so mapping an event is a multiply-add. Monitors keep their
+    desktop offsets, so a position on a secondary monitor lands there.
+    """
+    def __init__(self):
+        self.transforms = {}  # Stream id -> (left, top, x scale, y scale)
+
+    def update(self, streams, desktop):
+        """streams: dicts with id, left, top, width, height; desktop: (left, top, width, height)."""
+        transforms = {DESKTOP_STREAM_ID: self._transform(*desktop)}
+        for stream in streams:
+            if stream.get("width") and stream.get("height"):
+                transforms[stream["id"]] = self._transform(stream.get("left", 0), stream.get("top", 0),
+                                                           stream["width"], stream["height"])
+        self.transforms = transforms
+
+    def _transform(self, left, top, width, height):
+        # The last pixel, not one past it, is at 1.0
+        return left, top, max(0, width - 1), max(0, height - 1)
+
+    def map(self, payload):
+        """The payload with x, y in desktop pixels; payloads without a stream already are."""
+        stream_id = payload.get("stream")
+        if stream_id is None or "x" not in payload:
+            return payload
+        transform = self.transforms.get(stream_id)
+        if transform is None:
+            raise ValueError(f"Unknown stream {stream_id}")
+        left, top, scale_x, scale_y = transform
+        x = min(1.0, max(0.0, float(payload["x"])))
+        y = min(1.0, max(0.0, float(payload["y"])))
+        mapped = dict(payload, x=round(left + x * scale_x), y=round(top + y * scale_y))
+        del mapped["stream"]
+        return mapped
+
+class PynputBackend:
+    """Injects through pynput's controllers (Xlib, Win32 or Quartz calls per event)."""
+    name = "pynput"
+
+    def __init__(self, keyboard_controller, mouse_controller, key_enum, button_enum):
+        self.keyboard_controller = keyboard_controller
+        self.mouse_controller = mouse_controller
+        self.keys = build_key_table(key_enum)
+        self.buttons = build_button_table(button_enum)
+
+    def inject_key(self, payload):
+        key_str = payload.get("key")
+        if not key_str:
+            return  # Keys without a character or name (e.g. some media keys)
+        key = self.keys.get(key_str) if key_str.startswith('Key.') else key_str
+        if key is None:
+            logging.warning(f"Unknown key {key_str}")
+            return
+        if payload["event_type"] == "press": self.keyboard_controller.press(key)
+        elif payload["event_type"] == "release": self.keyboard_controller.release(key)
+
+    def inject_mouse(self, payload):
+        event_type = payload["event_type"]
+        if event_type == "click":
+            button = self.buttons.get(payload["button"])
+            if button is None:
+                logging.warning(f"Unknown mouse button {payload['button']}")
+                return
+            self.mouse_controller.position = (payload["x"], payload["y"])
+            if payload["pressed"]: self.mouse_controller.press(button)
+            else: self.mouse_controller.release(button)
+        elif event_type == "scroll": self.mouse_controller.scroll(payload["dx"], payload["dy"])
+        elif event_type == "move": self.mouse_controller.position = (payload["x"], payload["y"])
+
+    def set_geometry(self, left, top, width, height):
+        pass  # pynput positions in desktop pixels already
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def create_input_backend(name, keyboard_controller, mouse_controller, key_enum, button_enum):
+    """
+    The configured injection backend ("pynput" or "uinput"), falling back
+    to pynput when uinput is unavailable (no python-evdev, or no write
+    access to /dev/uinput).
+    """
+    if name == "uinput":
+        try:
+            from source_agent.uinput_injection import UInputBackend
+            return UInputBackend()
+        except Exception as e:
+            logging.warning(f"uinput injection unavailable, using pynput: {e}")
+    elif name != "pynput":
+        logging.warning(f"Unknown input backend {name!r}, using pynput")
+    return PynputBackend(keyboard_controller, mouse_controller, key_enum, button_enum)
+
+class InputInjector:
+    """
+    Injects KEY_EVENT and MOUSE_EVENT payloads on a thread of its own. Each
+    pass drains everything received so far and collapses runs of mouse
+    moves, so a burst costs one cursor warp rather than one per event and
+    the pointer never trails behind the hub. Batching backends flush once
+    per pass. Latency from receipt to injection is recorded per injected
+    event.
+    """
+    def __init__(self, backend, history=1000):
+        self.backend = backend
+        self.mapper = CoordinateMapper()
+        self.events = queue.SimpleQueue()
+        self.latencies = deque(maxlen=history)  # Seconds from receipt to injection
+        self.injected = 0
+        self.coalesced = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.events.put(None)  # Events submitted before it are still injected
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+        self.thread = None
+
+    def submit(self, msg_type, payload):
+        """Called from the network thread; never blocks."""
+        self.events.put((time.perf_counter(), msg_type, payload))
+
+    def drain(self, timeout=None):
+        """Blocks for the first pending event, then takes everything else without waiting."""
+        try:
+            events = [self.events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        if None in events:
+            self.running = False
+        return [event for event in events if event is not None]
+
+    def _run(self):
+        while self.running:
+            self.process(self.drain(timeout=0.5))
+
+    def process(self, events):
+        if not events:
+            return
+        events, dropped = coalesce(events)
+        self.coalesced += dropped
+        injected = []
+        for event in events:
+            _, msg_type, payload = event
+            try:
+                if msg_type == MessageType.KEY_EVENT:
+                    self.backend.inject_key(payload)
+                else:
+                    self.backend.inject_mouse(self.mapper.map(payload))
+                injected.append(event)
+            except Exception as e:
+                logging.error(f"Error injecting {msg_type} {payload}: {e}")
+        try:
+            self.backend.flush()
+        except Exception as e:
+            logging.error(f"Error flushing injected input: {e}")
+            return
+        done = time.perf_counter()
+        self.injected += len(injected)
+        self.latencies.extend(done - received for received, _, _ in injected)
+
+    def set_geometry(self, streams, desktop):
+        """Streams and the whole desktop (left, top, width, height) that positions map onto."""
+        self.mapper.update(streams, desktop)
+        self.backend.set_geometry(*desktop)
+
+    def stats(self):
+        """Injection latency percentiles (ms) over recent events, plus counters."""
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else None
+        return {"injected": self.injected, "coalesced": self.coalesced,
+                "p50_ms": percentile(0.5), "p99_ms": percentile(0.99), "max_ms": percentile(1.0)}
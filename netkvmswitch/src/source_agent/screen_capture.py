@@ -6,13 +6,24 @@ import time
 import cv2
 
 class ScreenCapturer:
-    def __init__(self):
+    # Polling capturers cannot tell whether the screen changed without grabbing it
+    tracks_damage = False
+
+    def __init__(self, monitor_index=None):
+        self.monitor_index = monitor_index
         self.sct = mss.mss()
+        self._select_monitor()
+
+    def _select_monitor(self):
+        monitor_index = self.monitor_index
+        if monitor_index is not None and monitor_index < len(self.sct.monitors):
+            # Explicit monitor (0 is the combined virtual screen)
+            self.monitor = self.sct.monitors[monitor_index]
         # Capture the primary monitor (index 1 for individual monitors, 0 for all combined)
         # On some systems, monitors[0] might be the combined virtual screen, and actual monitors start from monitors[1]
         # Let's try to iterate and find a suitable monitor or default to the first one that has 'id'
         # Or, more simply, use the first actual monitor if it exists.
-        if len(self.sct.monitors) > 1:
+        elif len(self.sct.monitors) > 1:
             self.monitor = self.sct.monitors[1] # Use the first actual monitor
         else:
             # Fallback if only one monitor entry (might be combined virtual screen)
@@ -29,6 +40,29 @@ class ScreenCapturer:
         if "id" in self.monitor:
             self.capture_area["mon"] = self.monitor["id"]
 
+    def geometry(self):
+        """The captured area as (left, top, width, height)."""
+        area = self.capture_area
+        return area["left"], area["top"], area["width"], area["height"]
+
+    def refresh_geometry(self):
+        """
+        Re-reads the monitor layout, which mss caches per instance, and returns
+        True when this monitor was resized or moved (e.g. a resolution change).
+        """
+        previous = self.geometry()
+        self.sct.close()
+        self.sct = mss.mss()
+        self._select_monitor()
+        return self.geometry() != previous
+
+    def poll_damage(self):
+        """Whether the monitor may have changed since the last capture_frame()."""
+        return True
+
+    def discard_damage(self):
+        """While the stream is paused: forget changes, and grab the whole monitor on resume."""
+
     def capture_frame(self):
         """Captures a single frame from the screen."""
         try:
@@ -45,6 +79,155 @@ class ScreenCapturer:
             print(f"An unexpected error occurred during screen capture: {e}")
             return None
 
+class DamageCapturer(ScreenCapturer):
+    """
+    Linux capturer driven by the X DAMAGE extension. The X server reports
+    which rectangles changed; only those are grabbed (mss uses XShmGetImage
+    where available) and patched into a persistent frame, so an idle or
+    text-editing desktop costs next to nothing to capture.
+    """
+    tracks_damage = True
+    max_rects = 16  # More damaged rectangles than this are grabbed as their bounding box
+
+    def __init__(self, monitor_index=None):
+        super().__init__(monitor_index)
+        from Xlib import display
+        from Xlib.ext import damage
+        self.display = display.Display()
+        if not self.display.has_extension('DAMAGE'):
+            self.display.close()
+            raise RuntimeError("DAMAGE extension not available")
+        self.display.damage_query_version(1, 1)
+        self.notify_event = damage.DamageNotify
+        self.damage = self.display.screen().root.damage_create(damage.DamageReportDeltaRectangles)
+        self.display.flush()
+        self.frame = None  # Persistent RGB frame, patched in place
+        self.damaged = []  # Pending (x, y, w, h) rectangles relative to the monitor
+
+    def refresh_geometry(self):
+        changed = super().refresh_geometry()
+        if changed:
+            self.frame = None
+        return changed
+
+    def poll_damage(self):
+        """Collects damage events without blocking; True when there is something to grab."""
+        left, top, width, height = self.geometry()
+        events = 0
+        while self.display.pending_events():
+            event = self.display.next_event()
+            if not isinstance(event, self.notify_event):
+                continue
+            events += 1
+            area = event.area
+            # Clip to this monitor
+            x0, y0 = max(area.x, left), max(area.y, top)
+            x1, y1 = min(area.x + area.width, left + width), min(area.y + area.height, top + height)
+            if x1 > x0 and y1 > y0:
+                self.damaged.append((x0 - left, y0 - top, x1 - x0, y1 - y0))
+        if events:
+            # Reset the damage region so only new changes are reported
+            self.display.damage_subtract(self.damage)
+            self.display.flush()
+        return self.frame is None or bool(self.damaged)
+
+    def discard_damage(self):
+        # The X server keeps reporting redraws while nobody watches; read them so they do not pile up
+        events = 0
+        while self.display.pending_events():
+            self.display.next_event()
+            events += 1
+        if events:
+            self.display.damage_subtract(self.damage)
+            self.display.flush()
+            self.damaged = []
+            self.frame = None  # What changed meanwhile is not known any more
+
+    def capture_frame(self):
+        """Returns the persistent frame after grabbing the damaged rectangles."""
+        if self.frame is None:
+            self.damaged = []
+            self.frame = super().capture_frame()
+            return self.frame
+
+        rects, self.damaged = self.damaged, []
+        if len(rects) > self.max_rects:
+            x0, y0 = min(r[0] for r in rects), min(r[1] for r in rects)
+            x1, y1 = max(r[0] + r[2] for r in rects), max(r[1] + r[3] for r in rects)
+            rects = [(x0, y0, x1 - x0, y1 - y0)]
+        left, top, _, _ = self.geometry()
+        try:
+            for x, y, w, h in rects:
+                sct_img = self.sct.grab({"left": left + x, "top": top + y, "width": w, "height": h})
+                self.frame[y:y + h, x:x + w] = cv2.cvtColor(np.array(sct_img), cv2.COLOR_BGRA2RGB)
+        except Exception as e:
+            print(f"Damage capture error, grabbing the full monitor: {e}")
+            self.frame = None
+            return self.capture_frame()
+        return self.frame
+
+    def close(self):
+        self.display.damage_destroy(self.damage)
+        self.display.close()
+
+def select_monitors(monitors, selection="1", include_combined=False):
+    """
+    Resolves the configured monitor selection ("1", "1,2" or "all") against
+    mss' monitor list and returns the monitor indices to stream. Index 0 is
+    mss' combined virtual screen and is only added when include_combined is set.
+    """
+    physical = list(range(1, len(monitors))) or [0]
+    if str(selection).strip().lower() == "all":
+        selected = physical
+    else:
+        selected = []
+        for part in str(selection).split(","):
+            part = part.strip()
+            if part.isdigit() and 0 < int(part) < len(monitors) and int(part) not in selected:
+                selected.append(int(part))
+        selected = selected or physical[:1]
+    if include_combined and len(monitors) > 2 and 0 not in selected:
+        selected.append(0)
+    return selected
+
+class CaptureScheduler:
+    """
+    Decides which monitors to grab on each capture tick. Monitors that changed
+    recently are grabbed first; monitors whose content stays the same are
+    skipped for a growing number of ticks (up to max_idle_skip).
+    """
+    def __init__(self, stream_ids, max_idle_skip=8):
+        self.stream_ids = list(stream_ids)
+        self.max_idle_skip = max_idle_skip
+        self.last_change = {sid: 0.0 for sid in self.stream_ids}
+        self.idle_streak = {sid: 0 for sid in self.stream_ids}
+        self.skip = {sid: 0 for sid in self.stream_ids}
+
+    def due_streams(self):
+        """Streams to grab this tick, most recently changed first."""
+        due = []
+        for sid in self.stream_ids:
+            if self.skip[sid] > 0:
+                self.skip[sid] -= 1
+            else:
+                due.append(sid)
+        return sorted(due, key=lambda sid: self.last_change[sid], reverse=True)
+
+    def record(self, stream_id, changed):
+        """Records whether the last grab of a stream differed from the previous one."""
+        if changed:
+            self.last_change[stream_id] = time.monotonic()
+            self.idle_streak[stream_id] = 0
+            self.skip[stream_id] = 0
+        else:
+            self.idle_streak[stream_id] += 1
+            self.skip[stream_id] = min(self.idle_streak[stream_id], self.max_idle_skip)
+
+    def wake(self, stream_id):
+        """Grabs the stream on the next tick regardless of its idle streak."""
+        self.idle_streak[stream_id] = 0
+        self.skip[stream_id] = 0
+
 # Example usage (for testing)
 if __name__ == "__main__":
     capturer = ScreenCapturer()
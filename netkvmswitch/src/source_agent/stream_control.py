@@ -0,0 +1,86 @@
+# Stream settings shared between the agent and its video pipeline process
+
+from multiprocessing import Value
+
+from common.protocol import StreamProfile, VideoLayer
+
+class StreamControl:
+    """
+    Stream settings the video pipeline process reads on every frame. The hub
+    changes them at runtime through STREAM_STATUS, so switching profile never
+    restarts the pipeline process.
+
+    The main layer follows the hub's profile. With simulcast, a second
+    low-resolution thumbnail layer is encoded from the same captured frame.
+    """
+    def __init__(self, fps=60, scale=1.0):
+        self.fps = Value('i', fps)
+        self.scale = Value('d', scale)
+        self.thumbnail_fps = Value('i', 0)  # 0 = thumbnail layer off
+        self.thumbnail_scale = Value('d', 0.25)
+        self.keyframe = Value('i', 0)  # Bitmask of layers owing an IDR
+
+    def apply_status(self, payload):
+        """Applies a STREAM_STATUS payload from the hub."""
+        profile = payload.get("profile", StreamProfile.FULL)
+        if profile == StreamProfile.PAUSED:
+            self.fps.value = 0
+        else:
+            self.fps.value = max(1, int(payload.get("fps", self.fps.value)))
+        self.scale.value = self._clamp_scale(payload.get("scale", self.scale.value))
+
+        thumbnail = payload.get("thumbnail")
+        if thumbnail:
+            self.thumbnail_fps.value = max(1, int(thumbnail.get("fps", 5)))
+            self.thumbnail_scale.value = self._clamp_scale(thumbnail.get("scale", self.thumbnail_scale.value))
+        else:
+            self.thumbnail_fps.value = 0
+
+    def _clamp_scale(self, scale):
+        return min(1.0, max(0.05, float(scale)))
+
+    def request_keyframe(self):
+        with self.keyframe.get_lock():
+            self.keyframe.value = (1 << VideoLayer.MAIN) | (1 << VideoLayer.THUMBNAIL)
+
+    def take_keyframe_request(self, layer=VideoLayer.MAIN):
+        """Returns True once per keyframe request for the given layer."""
+        bit = 1 << layer
+        with self.keyframe.get_lock():
+            if self.keyframe.value & bit:
+                self.keyframe.value &= ~bit
+                return True
+        return False
+
+    def keyframe_pending(self, layer=None):
+        """Whether an IDR is owed on the given layer, or on any enabled layer."""
+        mask = self.keyframe.value
+        if layer is not None:
+            return bool(mask & (1 << layer))
+        return any(mask & (1 << enabled) for enabled, _, _ in self.layers())
+
+    def layers(self):
+        """Enabled layers as (layer, fps, scale) tuples."""
+        layers = []
+        if self.fps.value > 0:
+            layers.append((VideoLayer.MAIN, self.fps.value, self.scale.value))
+        if self.thumbnail_fps.value > 0:
+            layers.append((VideoLayer.THUMBNAIL, self.thumbnail_fps.value, self.thumbnail_scale.value))
+        return layers
+
+    @property
+    def paused(self):
+        return not self.layers()
+
+    def frame_interval(self):
+        """Capture interval for the fastest enabled layer, or None when paused."""
+        fps = max((layer_fps for _, layer_fps, _ in self.layers()), default=0)
+        return 1.0 / fps if fps > 0 else None
+
+    def output_size(self, width, height, scale=None):
+        """Encoder size for a captured width/height, rounded down to even for yuv420p."""
+        if scale is None:
+            scale = self.scale.value
+        out_w = max(2, int(width * scale)) & ~1
+        out_h = max(2, int(height * scale)) & ~1
+        return out_w, out_h
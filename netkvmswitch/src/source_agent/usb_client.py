@@ -1,29 +1,33 @@
 import time
 import sys
 import os
-import cv2
-import numpy as np
 import serial
 import serial.tools.list_ports
 import threading
-import base64
 from pynput.keyboard import Controller as KeyboardController, Key
 from pynput.mouse import Controller as MouseController, Button
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from common.config import config
-from common.protocol import MessageType
-from common.serial_protocol import send_framed, receive_framed
+from common.protocol import MessageType, DEFAULT_STREAM_ID
+from common.serial_protocol import FrameReader, LinkMeter, send_framed
+from common.baud_negotiation import follow_baudrate_negotiation, parse_baudrates
 from source_agent.screen_capture import ScreenCapturer
+from source_agent.input_injector import CoordinateMapper
+from source_agent.usb_video import SerialVideoStream
 
 class USBSourceAgent:
     def __init__(self, port=None):
         self.port = port
         self.conn = None
+        self.reader = None
+        self.video_stream = None
+        self.link_rate = None  # Bytes per second the baud rate probe measured
         self.running = False
         self.keyboard_controller = KeyboardController()
         self.mouse_controller = MouseController()
+        self.coordinate_mapper = CoordinateMapper()
 
     def start(self):
         """Find and connect to the server over a serial port."""
@@ -39,18 +43,25 @@ class USBSourceAgent:
                 conn = serial.Serial(port, baudrate=115200, timeout=2)
                 
                 # Wait for server hello
-                message = receive_framed(conn)
+                reader = FrameReader(conn)
+                message = reader.receive_framed()
                 if message and message.get("payload", {}).get("magic") == "NETKVM_SERVER_HELLO":
                     print(f"[USB Client] Server found on {port}. Sending client hello.")
                     client_hello = {
                         "type": "handshake",
                         "payload": {
                             "magic": "NETKVM_CLIENT_HELLO",
-                            "name": config.client.client_name
+                            "name": config.client.client_name,
+                            "baudrates": parse_baudrates(config.client.usb_baudrates)
                         }
                     }
                     if send_framed(conn, client_hello):
+                        if "baudrates" in message["payload"]:
+                            baudrate, self.link_rate = follow_baudrate_negotiation(
+                                conn, reader, config.client.usb_baudrates)
+                            print(f"[USB Client] Link runs at {baudrate} baud.")
                         self.conn = conn
+                        self.reader = reader
                         self.running = True
                         print("[USB Client] Connection successful!")
                         break # Exit loop once connected
@@ -69,7 +80,7 @@ class USBSourceAgent:
         """Listen for I/O commands from the server."""
         while self.running:
             try:
-                message = receive_framed(self.conn)
+                message = self.reader.receive_framed()
                 if message is None:
                     print("[USB Client] Server disconnected.")
                     break
@@ -80,32 +91,29 @@ class USBSourceAgent:
         self.running = False
         
     def _stream_video(self):
-        """Capture and stream video frames to the server."""
+        """Capture and stream H.264 video to the server, capped to the link's throughput."""
         capturer = ScreenCapturer()
-        encode_param = [cv2.IMWRITE_JPEG_QUALITY, config.client.video_quality]
-        fps_delay = 1.0 / config.client.fps
+        left, top, width, height = capturer.geometry()
+        desktop = capturer.sct.monitors[0]
+        self.coordinate_mapper.update(
+            [{"id": DEFAULT_STREAM_ID, "left": left, "top": top, "width": width, "height": height}],
+            (desktop["left"], desktop["top"], desktop["width"], desktop["height"]))
+        self.video_stream = SerialVideoStream(self.conn, width=config.client.usb_video_width,
+                                              fps=config.client.usb_fps, link_share=config.client.usb_link_share,
+                                              link_meter=LinkMeter(self.conn.baudrate, measured=self.link_rate),
+                                              jpeg_quality=config.client.video_quality)
+        self.video_stream.send_geometry(left, top, width, height)
+        fps_delay = 1.0 / config.client.usb_fps
 
         while self.running:
             try:
+                started = time.monotonic()
                 frame = capturer.capture_frame()
-                if frame is not None:
-                    target_width = config.client.video_width
-                    aspect_ratio = frame.shape[1] / frame.shape[0]
-                    target_height = int(target_width / aspect_ratio)
-                    resized = cv2.resize(frame, (target_width, target_height), interpolation=cv2.INTER_AREA)
-                    
-                    _, encoded_frame = cv2.imencode('.jpg', resized, encode_param)
-                    frame_data = base64.b64encode(encoded_frame.tobytes()).decode('utf-8')
-                    
-                    video_message = {
-                        "type": MessageType.VIDEO_FRAME,
-                        "payload": {"frame": frame_data}
-                    }
-                    if not send_framed(self.conn, video_message):
-                        print("[USB Client] Failed to send video frame.")
-                        break # Stop streaming on error
-                
-                time.sleep(fps_delay)
+                if frame is not None and not self.video_stream.send(frame):
+                    print("[USB Client] Failed to send video frame.")
+                    break # Stop streaming on error
+                # Sending blocks while the link is busy, which already paces slow links
+                time.sleep(max(0.0, fps_delay - (time.monotonic() - started)))
             except Exception as e:
                 print(f"[USB Client] Error streaming video: {e}")
                 break
@@ -118,6 +126,8 @@ class USBSourceAgent:
             self._inject_key_event(payload)
         elif msg_type == MessageType.MOUSE_EVENT:
             self._inject_mouse_event(payload)
+        elif msg_type == MessageType.REQUEST_KEYFRAME and self.video_stream:
+            self.video_stream.request_keyframe()
 
     def _inject_key_event(self, payload):
         # (This is identical to the TCP client's implementation)
@@ -133,7 +143,7 @@ class USBSourceAgent:
             print(f"Error injecting key event {key_str}: {e}")
 
     def _inject_mouse_event(self, payload):
-        # (This is identical to the TCP client's implementation)
+        payload = self.coordinate_mapper.map(payload)
         event_type = payload["event_type"]
         if event_type == "click":
             button = getattr(Button, payload["button"].split('.')[-1])
@@ -0,0 +1,119 @@
+# H.264 video for USB serial agents, sized to what the link carries
+
+import logging
+import threading
+import time
+
+import cv2
+
+from common.protocol import MessageType, DEFAULT_STREAM_ID
+from common.serial_protocol import FrameFlags, FrameType, LinkMeter, encode_frame, send_framed, write_lock
+
+# Encoder bitrate bounds (bits/s); the floor keeps a picture on a crawling link
+MIN_BITRATE = 16_000
+MAX_BITRATE = 2_000_000
+# Relative change in the measured throughput before the encoder is rebuilt
+# (a rebuild starts with an IDR, which is expensive on the link)
+REBUILD_THRESHOLD = 0.25
+
+def output_size(frame_width, frame_height, width):
+    """The even-sized output at the given width, keeping the aspect ratio."""
+    width = min(width, frame_width) & ~1
+    height = int(width * frame_height / frame_width) & ~1
+    return max(2, width), max(2, height)
+
+class SerialVideoStream:
+    """
+    Encodes captured frames for one serial connection and writes them as
+    H264 frames. Each write is timed until the port has drained it, and the
+    LinkMeter's estimate sets the encoder's bitrate cap: link_share of the
+    measured throughput. As writes block while the link is busy, capture
+    never runs ahead of what the link carries.
+
+    Falls back to one JPEG per frame when no H.264 encoder can be created.
+    """
+    def __init__(self, conn, width=320, fps=10, link_share=0.7, link_meter=None, encoder_factory=None,
+                 jpeg_quality=50):
+        self.conn = conn
+        self.width = width
+        self.fps = fps
+        self.link_share = link_share
+        self.link_meter = link_meter or LinkMeter(getattr(conn, 'baudrate', None) or 115200)
+        self.encoder_factory = encoder_factory
+        self.jpeg_quality = jpeg_quality
+        self.encoder = None
+        self.encoder_key = None  # (width, height, bitrate) the encoder was built for
+        self.use_jpeg = False
+        self.keyframe_requested = threading.Event()
+        self.bytes_sent = 0
+        self.frames_sent = 0
+
+    def bitrate_cap(self):
+        bitrate = int(self.link_meter.bytes_per_second() * 8 * self.link_share)
+        return min(MAX_BITRATE, max(MIN_BITRATE, bitrate))
+
+    def request_keyframe(self):
+        """Called from the command thread when the hub lost sync (e.g. a dropped frame)."""
+        self.keyframe_requested.set()
+
+    def send_geometry(self, left, top, width, height):
+        """Tells the hub the captured area, as TCP agents do with STREAM_RECONFIGURE."""
+        return send_framed(self.conn, {"type": MessageType.STREAM_RECONFIGURE,
+                                       "payload": {"stream": DEFAULT_STREAM_ID, "left": left, "top": top,
+                                                   "width": width, "height": height}})
+
+    def _update_encoder(self, width, height):
+        """Rebuilds the encoder after a size change or a large throughput change; True if it did."""
+        bitrate = self.bitrate_cap()
+        if self.encoder is not None:
+            built_width, built_height, built_bitrate = self.encoder_key
+            if (built_width, built_height) == (width, height) and \
+                    abs(bitrate - built_bitrate) <= REBUILD_THRESHOLD * built_bitrate:
+                return False
+        if self.encoder_factory is None:
+            from source_agent.backends import X264Encoder
+            self.encoder_factory = X264Encoder
+        self.encoder = self.encoder_factory(width, height, self.fps, bitrate=bitrate)
+        self.encoder_key = (width, height, bitrate)
+        print(f"[USB Client] H.264 {width}x{height}@{self.fps} capped at {bitrate // 1000} kbit/s")
+        return True
+
+    def send(self, frame):
+        """Encodes and sends one RGB frame. Returns False when the connection failed."""
+        width, height = output_size(frame.shape[1], frame.shape[0], self.width)
+        if (frame.shape[1], frame.shape[0]) != (width, height):
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+        if not self.use_jpeg:
+            try:
+                # A new encoder starts with an IDR anyway
+                keyframe = self._update_encoder(width, height) or self.keyframe_requested.is_set()
+                self.keyframe_requested.clear()
+                packet = self.encoder.encode(frame, 'rgb24', keyframe=keyframe)
+            except Exception as e:
+                logging.warning(f"H.264 unavailable for the USB link, sending JPEG: {e}")
+                self.use_jpeg = True
+            else:
+                if not packet:
+                    return True  # The encoder buffered the frame
+                return self._write(FrameType.H264, packet, FrameFlags.KEYFRAME if keyframe else 0)
+
+        # cv2 encodes BGR
+        _, encoded = cv2.imencode('.jpg', cv2.cvtColor(frame, cv2.COLOR_RGB2BGR),
+                                  [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        return self._write(FrameType.VIDEO, encoded.data, FrameFlags.KEYFRAME)
+
+    def _write(self, frame_type, payload, flags):
+        wire = encode_frame(frame_type, payload, flags)
+        started = time.perf_counter()
+        try:
+            with write_lock(self.conn):
+                self.conn.write(wire)
+            self.conn.flush()  # Waits until the port has sent it
+        except Exception as e:
+            print(f"[USB Client] Error sending video frame: {e}")
+            return False
+        self.link_meter.record(len(wire), time.perf_counter() - started)
+        self.bytes_sent += len(wire)
+        self.frames_sent += 1
+        return True
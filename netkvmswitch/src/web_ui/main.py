@@ -9,11 +9,12 @@ from fastapi.staticfiles import StaticFiles
 from starlette.responses import FileResponse
 import os
 import sys
+import json
 
 # Add the src directory to the path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from common.protocol import create_message, parse_message
+from common.protocol import create_message, MessageReader, VideoLayer, DEFAULT_STREAM_ID
 from common.config import config
 from common.utils import resource_path
 
@@ -24,6 +25,8 @@ app = FastAPI()
 
 # --- Global State ---
 agent_process = None
+# Cursor shapes kept per source for browsers that connect later, least recently used dropped first
+MAX_CURSOR_SHAPES = 16
 
 # --- Hub Connection ---
 class HubConnector:
@@ -31,11 +34,14 @@ class HubConnector:
         self.control_socket = None
         self.video_socket = None
         self.connected = False
+        self.command_lock = threading.Lock()  # One command and its reply at a time
+        self.replies = MessageReader()
 
     def connect(self):
         try:
             self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.control_socket.connect((config.ui.server_host, config.server.ui_control_port))
+            self.replies = MessageReader()
             self.video_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.video_socket.connect((config.ui.server_host, config.server.ui_video_port))
             self.connected = True
@@ -49,9 +55,17 @@ class HubConnector:
         if not self.connected: return None
         try:
             message = create_message(command_type, payload or {})
-            self.control_socket.sendall(message)
-            data = self.control_socket.recv(4096)
-            return parse_message(data).get('payload', {}) if data else None
+            with self.command_lock:
+                self.control_socket.sendall(message)
+                # Replies such as get_clients or get_transfers can span many recv()s
+                replies = []
+                while not replies:
+                    data = self.control_socket.recv(65536)
+                    if not data:
+                        self.connected = False
+                        return None
+                    replies = self.replies.feed(data)
+            return replies[0].get('payload', {})
         except Exception:
             self.connected = False
             return None
@@ -62,17 +76,73 @@ hub_connector = HubConnector()
 class ConnectionManager:
     def __init__(self):
         self.active_connections: list[WebSocket] = []
+        # Per-browser tile subscriptions: {websocket: {(address, stream): {"layer": int, "large": bool}}}
+        self.subscriptions: dict = {}
+        # Latest cursor messages per source, replayed to browsers that connect later:
+        # {address: {"shapes": {hash: message}, "position": message}}, shapes in least recently used order
+        self.cursor_state: dict = {}
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
         self.active_connections.append(websocket)
+        self.subscriptions[websocket] = {}
+        self.report_viewers()
+        for state in list(self.cursor_state.values()):
+            for message in list(state["shapes"].values()) + [state["position"]]:
+                if message is not None:
+                    await websocket.send_bytes(message)
+
+    def remember_cursor(self, address: str, message: bytes):
+        message = bytes(message)
+        cursor = json.loads(message[42:])
+        state = self.cursor_state.setdefault(address, {"shapes": {}, "position": None})
+        shapes = state["shapes"]
+        if cursor["type"] == "cursor_shape":
+            shapes.pop(cursor["payload"]["hash"], None)
+            shapes[cursor["payload"]["hash"]] = message
+            while len(shapes) > MAX_CURSOR_SHAPES:
+                del shapes[next(iter(shapes))]
+        else:
+            state["position"] = message
+            if cursor["payload"].get("shape") in shapes:
+                shapes[cursor["payload"]["shape"]] = shapes.pop(cursor["payload"]["shape"])
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
+        if self.subscriptions.pop(websocket, None):
+            self.report_layer_demand()
+        self.report_viewers()
+
+    def subscribe(self, websocket: WebSocket, address: str, stream_id: int, layer: int, large: bool):
+        self.subscriptions.setdefault(websocket, {})[(address, stream_id)] = {"layer": layer, "large": large}
+        self.report_layer_demand()
+        # The tile's decoder restarts and needs an IDR on its new layer
+        hub_connector.send_command("request_keyframe", {"address": address, "stream": stream_id})
+
+    def report_layer_demand(self):
+        large = {address for subs in self.subscriptions.values()
+                 for (address, _), sub in subs.items() if sub["large"]}
+        hub_connector.send_command("set_layer_demand", {"main": sorted(large)})
+
+    def report_viewers(self):
+        # The hub pauses every agent's stream while nobody is watching
+        hub_connector.send_command("set_viewer_count", {"count": len(self.active_connections)})
 
     async def broadcast(self, message: bytes):
+        # Message layout: 40-byte padded address, stream id, layer, H.264 data
+        address = bytes(message[:40]).decode('utf-8').strip()
+        stream_id, layer = message[40], message[41]
+        if layer == VideoLayer.CURSOR:
+            self.remember_cursor(address, message)
         dead_connections = []
         for connection in self.active_connections:
+            subscription = self.subscriptions.get(connection, {}).get((address, stream_id))
+            wanted_layer = subscription["layer"] if subscription else VideoLayer.MAIN
+            # Stream reconfigure, cursor and file transfer messages go to every viewer of the source
+            if layer != wanted_layer and layer not in (VideoLayer.RECONFIGURE, VideoLayer.CURSOR,
+                                                       VideoLayer.TRANSFER):
+                continue
             try:
                 await connection.send_bytes(message)
             except Exception:
@@ -80,6 +150,10 @@ class ConnectionManager:
         
         for connection in dead_connections:
             self.active_connections.remove(connection)
+            self.subscriptions.pop(connection, None)
+        if dead_connections:
+            self.report_layer_demand()
+            self.report_viewers()
 
 manager = ConnectionManager()
 
@@ -151,6 +225,37 @@ async def forward_io_event(payload: dict):
     response = hub_connector.send_command("forward_io_event", payload)
     return response or {"success": False, "message": "Failed to forward I/O event"}
 
+@app.post("/api/video/focus")
+async def set_focused_client(payload: dict):
+    response = hub_connector.send_command("set_focused_client", {"address": payload.get("address")})
+    return response or {"success": False, "message": "Failed to set focused client"}
+
+@app.post("/api/video/keyframe")
+async def request_keyframe(payload: dict):
+    response = hub_connector.send_command("request_keyframe", {"address": payload.get("address"),
+                                                               "stream": payload.get("stream")})
+    return response or {"success": False, "message": "Failed to request keyframe"}
+
+@app.post("/api/files/push")
+async def push_file(payload: dict):
+    response = hub_connector.send_command("push_file", payload)
+    return response or {"success": False, "message": "Failed to start the transfer"}
+
+@app.post("/api/files/pull")
+async def pull_file(payload: dict):
+    response = hub_connector.send_command("pull_file", payload)
+    return response or {"success": False, "message": "Failed to start the transfer"}
+
+@app.get("/api/files/transfers")
+async def get_transfers():
+    response = hub_connector.send_command("get_transfers")
+    return response or {"transfers": []}
+
+@app.post("/api/files/cancel")
+async def cancel_transfer(payload: dict):
+    response = hub_connector.send_command("cancel_transfer", payload)
+    return response or {"success": False, "message": "Failed to cancel the transfer"}
+
 @app.post("/api/hub/shutdown")
 async def shutdown_hub():
     logging.warning("Shutdown command received from UI. Shutting down.")
@@ -169,9 +274,19 @@ async def set_network_accessible(payload: dict):
 @app.websocket("/ws/video")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
+    # New viewers need an IDR before they can decode anything
+    hub_connector.send_command("request_keyframe")
     try:
         while True:
-            await asyncio.sleep(3600) # Keep connection open
+            # Browsers tell us which simulcast layer each tile needs
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+                if message.get("type") == "subscribe":
+                    manager.subscribe(websocket, message["address"], int(message.get("stream", DEFAULT_STREAM_ID)),
+                                      int(message.get("layer", VideoLayer.MAIN)), bool(message.get("large")))
+            except (ValueError, KeyError) as e:
+                logging.warning(f"Ignoring malformed message from browser: {e}")
     except WebSocketDisconnect:
         manager.disconnect(websocket)
         logging.info("Client disconnected from video websocket.")
@@ -11,15 +11,32 @@ document.addEventListener('DOMContentLoaded', () => {
     const shutdownHubBtn = document.getElementById('shutdown-hub-btn');
     const hubIpInput = document.getElementById('hub-ip');
     const networkAccessibleCheckbox = document.getElementById('network-accessible');
-
+    const transferPathInput = document.getElementById('transfer-path');
+    const pushFileBtn = document.getElementById('push-file-btn');
+    const pullFileBtn = document.getElementById('pull-file-btn');
+    const transferList = document.getElementById('transfer-list');
+
+    // Simulcast layer ids, see VideoLayer in common/protocol.py
+    const LAYER_MAIN = 0;
+    const LAYER_THUMBNAIL = 1;
+    const LAYER_RECONFIGURE = 255; // JSON stream_reconfigure message, not H.264
+    const LAYER_CURSOR = 254; // JSON cursor_shape / cursor_position message
+    const LAYER_TRANSFER = 253; // JSON file_progress message
+    const RECOVERY_INTERVAL_MS = 250; // At most one decoder reset per this long; the hub rate-limits IDRs too
+    const cursorShapes = {}; // `${address}|${hash}` -> cursor_shape payload
+
+    // One player per (client address, monitor stream), keyed by streamKey()
     let players = {};
+    let videoSocket = null;
     let activeIOClient = null;
+    let activeClientAddress = null;
+    const transferItems = {}; // transfer id -> <li>
     let refreshTimer = null;
 
     function destroyAllPlayers() {
-        for (const addr in players) {
-            if (players[addr].jmuxer) players[addr].jmuxer.destroy();
-            if (players[addr].wrapper) players[addr].wrapper.remove();
+        for (const key in players) {
+            if (players[key].jmuxer) players[key].jmuxer.destroy();
+            if (players[key].wrapper) players[key].wrapper.remove();
         }
         players = {};
     }
@@ -32,18 +49,50 @@ document.addEventListener('DOMContentLoaded', () => {
         const wsUrl = `${wsProtocol}//${window.location.host}/ws/video`;
         const ws = new WebSocket(wsUrl);
         ws.binaryType = 'arraybuffer';
+        videoSocket = ws;
 
-        ws.onopen = () => console.log('Video WebSocket connected');
+        ws.onopen = () => {
+            console.log('Video WebSocket connected');
+            fetchClients(); // Sends tile subscriptions now that the socket is open
+        };
         ws.onmessage = (event) => {
             const data = new Uint8Array(event.data);
             const addrBytes = data.slice(0, 40);
-            const h264Data = data.slice(40);
+            const stream = data[40];
+            const layer = data[41];
+            const packet = data.slice(42); // H.264, a JPEG for MJPEG streams, or JSON
             const decoder = new TextDecoder();
             const address = decoder.decode(addrBytes).trim();
-
-            if (players[address] && players[address].jmuxer) {
-                players[address].jmuxer.feed({ video: h264Data });
-                players[address].frameCount++;
+            const player = players[streamKey(address, stream)];
+
+            if (layer === LAYER_CURSOR) {
+                handleCursorMessage(address, JSON.parse(decoder.decode(packet)));
+            } else if (layer === LAYER_TRANSFER) {
+                showTransfer(JSON.parse(decoder.decode(packet)).payload);
+            } else if (player && layer === LAYER_RECONFIGURE) {
+                // The source changed resolution; the next packet is an IDR at the new size
+                const geometry = JSON.parse(decoder.decode(packet)).payload;
+                console.log(`Stream ${streamKey(address, stream)} reconfigured to ${geometry.width}x${geometry.height}`);
+                player.geometry = geometry;
+                player.sps = null;
+                player.cursor.style.display = 'none';
+                if (player.jmuxer) resetPlayer(player);
+            } else if (player && player.codec === 'mjpeg' && player.layer === layer) {
+                showJPEG(player, packet);
+                player.frameCount++;
+            } else if (player && player.jmuxer && player.layer === layer) {
+                // A new SPS means the agent switched stream profile (resolution)
+                const sps = extractSPS(packet);
+                if (player.awaitingKeyframe) {
+                    if (!sps) return; // Frames before the IDR would only fail to decode again
+                    player.awaitingKeyframe = false;
+                }
+                if (sps && player.sps && !bytesEqual(sps, player.sps)) {
+                    resetPlayer(player);
+                }
+                if (sps) player.sps = sps;
+                player.jmuxer.feed({ video: packet });
+                player.frameCount++;
             }
         };
         ws.onclose = () => {
@@ -56,6 +105,177 @@ document.addEventListener('DOMContentLoaded', () => {
         };
     }
 
+    function showJPEG(player, jpeg) {
+        // MJPEG streams (USB agents without H.264) show each frame as it arrives
+        const url = URL.createObjectURL(new Blob([jpeg], { type: 'image/jpeg' }));
+        const previous = player.video.src;
+        player.video.onload = () => { if (previous) URL.revokeObjectURL(previous); };
+        player.video.src = url;
+    }
+
+    function extractSPS(data) {
+        // libx264 puts SPS first in an IDR access unit: 00 00 00 01 <nal type 7>
+        if (data.length < 5 || data[0] !== 0 || data[1] !== 0 || data[2] !== 0 || data[3] !== 1) return null;
+        if ((data[4] & 0x1f) !== 7) return null;
+        for (let i = 5; i + 3 < data.length; i++) {
+            if (data[i] === 0 && data[i + 1] === 0 && (data[i + 2] === 1 || (data[i + 2] === 0 && data[i + 3] === 1))) {
+                return data.slice(4, i);
+            }
+        }
+        return data.slice(4);
+    }
+
+    function bytesEqual(a, b) {
+        if (a.length !== b.length) return false;
+        for (let i = 0; i < a.length; i++) {
+            if (a[i] !== b[i]) return false;
+        }
+        return true;
+    }
+
+    function createJMuxer(player) {
+        return new JMuxer({
+            node: player.video,
+            mode: 'video',
+            flushingTime: 0,
+            fps: 60,
+            debug: false,
+            onError: () => recoverPlayer(player, 'decode error'),
+            onMissingVideoFrames: () => recoverPlayer(player, 'unreadable frame'),
+        });
+    }
+
+    function recoverPlayer(player, reason) {
+        // The decoder is lost until the next IDR; ask for one now rather than waiting out the GOP
+        const now = performance.now();
+        if (player.codec === 'mjpeg' || now - player.recoveredAt < RECOVERY_INTERVAL_MS) return;
+        player.recoveredAt = now;
+        console.warn(`Stream ${streamKey(player.address, player.stream)}: ${reason}; requesting a keyframe`);
+        player.sps = null;
+        player.awaitingKeyframe = true;
+        resetPlayer(player);
+        requestKeyframe(player.address, player.stream);
+    }
+
+    function streamKey(address, stream) {
+        return `${address}#${stream}`;
+    }
+
+    function handleCursorMessage(address, message) {
+        const payload = message.payload;
+        if (message.type === 'cursor_shape') {
+            payload.url = `url(data:image/png;base64,${payload.png})`;
+            cursorShapes[`${address}|${payload.hash}`] = payload;
+            return;
+        }
+        // The pointer is on at most one monitor of the source
+        for (const key in players) {
+            const player = players[key];
+            if (player.address !== address) continue;
+            if (payload.stream === player.stream && payload.x !== null) {
+                drawCursor(player, payload, payload.shape ? cursorShapes[`${address}|${payload.shape}`] : null);
+            } else {
+                player.cursor.style.display = 'none';
+            }
+        }
+    }
+
+    function showTransfer(status) {
+        let li = transferItems[status.transfer];
+        if (!li) {
+            li = document.createElement('li');
+            transferItems[status.transfer] = li;
+            transferList.prepend(li);
+        }
+        const verb = status.direction === 'send' ? 'To' : 'From';
+        const percent = status.size ? Math.floor(100 * status.bytes / status.size) : 0;
+        let text = `${status.name}: ${verb} ${status.address}, `;
+        if (status.state === 'active') {
+            text += `${percent}% at ${(status.rate / 1e6).toFixed(1)} MB/s`;
+        } else {
+            text += status.error ? `${status.state} (${status.error})` : status.state;
+        }
+        li.textContent = text;
+        li.className = `transfer ${status.state}`;
+    }
+
+    async function transferFile(command) {
+        const path = transferPathInput.value.trim();
+        if (!path || !activeClientAddress) return;
+        try {
+            const response = await fetch(`/api/files/${command}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ address: activeClientAddress, path }),
+            });
+            const result = await response.json();
+            if (!result.success) alert(`File transfer failed: ${result.message}`);
+        } catch (error) {
+            console.error('Error starting file transfer:', error);
+        }
+    }
+
+    function videoContentRect(video) {
+        // Area of the tile showing the picture (object-fit: contain letterboxes it)
+        const width = video.clientWidth;
+        const height = video.clientHeight;
+        // <video> tiles, or <img> tiles of MJPEG streams
+        const sourceWidth = video.videoWidth || video.naturalWidth;
+        const sourceHeight = video.videoHeight || video.naturalHeight;
+        if (!sourceWidth || !sourceHeight) return { left: video.offsetLeft, top: video.offsetTop, width, height };
+        const scale = Math.min(width / sourceWidth, height / sourceHeight);
+        const contentWidth = sourceWidth * scale;
+        const contentHeight = sourceHeight * scale;
+        return {
+            left: video.offsetLeft + (width - contentWidth) / 2,
+            top: video.offsetTop + (height - contentHeight) / 2,
+            width: contentWidth,
+            height: contentHeight,
+        };
+    }
+
+    function streamPosition(event, video) {
+        // Pointer position normalized within the picture, letterbox excluded;
+        // the agent maps it through its own monitor geometry
+        const bounds = video.getBoundingClientRect();
+        const content = videoContentRect(video);
+        const x = (event.clientX - bounds.left - (content.left - video.offsetLeft)) / content.width;
+        const y = (event.clientY - bounds.top - (content.top - video.offsetTop)) / content.height;
+        return { x: Math.min(1, Math.max(0, x)), y: Math.min(1, Math.max(0, y)) };
+    }
+
+    function drawCursor(player, position, shape) {
+        const rect = videoContentRect(player.video);
+        const cursor = player.cursor;
+        let x = rect.left + position.x * rect.width;
+        let y = rect.top + position.y * rect.height;
+        if (shape) {
+            // Shapes are in source pixels; scale them like the picture
+            const sourceWidth = (player.geometry && player.geometry.width) || player.video.videoWidth
+                || player.video.naturalWidth || rect.width;
+            const scale = rect.width / sourceWidth;
+            cursor.classList.remove('default');
+            cursor.style.backgroundImage = shape.url;
+            cursor.style.width = `${shape.width * scale}px`;
+            cursor.style.height = `${shape.height * scale}px`;
+            x -= shape.hot_x * scale;
+            y -= shape.hot_y * scale;
+        } else {
+            cursor.classList.add('default');
+            cursor.style.backgroundImage = '';
+            cursor.style.width = '';
+            cursor.style.height = '';
+        }
+        cursor.style.transform = `translate(${x}px, ${y}px)`;
+        cursor.style.display = 'block';
+    }
+
+    function resetPlayer(player) {
+        if (player.codec === 'mjpeg') return; // Every JPEG stands on its own
+        if (player.jmuxer) player.jmuxer.destroy();
+        player.jmuxer = createJMuxer(player);
+    }
+
     async function fetchClients() {
         try {
             const response = await fetch('/api/clients');
@@ -67,118 +287,202 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    function updateSubscription(player, client) {
+        // Small tiles of simulcast sources only need the thumbnail layer
+        const large = !!client.is_active;
+        const layer = client.simulcast && !large ? LAYER_THUMBNAIL : LAYER_MAIN;
+        player.wrapper.classList.toggle('large', large);
+        if (player.layer === layer && player.large === large) return;
+        if (!videoSocket || videoSocket.readyState !== WebSocket.OPEN) return;
+
+        videoSocket.send(JSON.stringify({
+            type: 'subscribe', address: player.address, stream: player.stream, layer: layer, large: large,
+        }));
+        if (player.layer !== layer && player.layer !== null) {
+            resetPlayer(player);
+            player.sps = null;
+        }
+        player.layer = layer;
+        player.large = large;
+    }
+
     function updateVideoGrid(clients) {
-        const currentAddresses = Object.keys(players);
-        const newAddresses = Object.keys(clients);
-
-        currentAddresses.forEach(addr => {
-            if (!newAddresses.includes(addr)) {
-                if (players[addr]) {
-                    players[addr].wrapper.remove();
-                    if (players[addr].jmuxer) players[addr].jmuxer.destroy();
-                    delete players[addr];
+        // Every monitor an agent announced gets its own tile
+        const streams = {};
+        for (const address in clients) {
+            const clientStreams = clients[address].streams || [{ id: 1 }];
+            clientStreams.forEach(stream => {
+                streams[streamKey(address, stream.id)] = {
+                    address: address, stream: stream.id, geometry: stream, codec: stream.codec || 'h264',
+                };
+            });
+        }
+        const currentKeys = Object.keys(players);
+        const newKeys = Object.keys(streams);
+
+        currentKeys.forEach(key => {
+            // A stream that switched codec gets a new tile of the right kind
+            if (!newKeys.includes(key) || players[key].codec !== streams[key].codec) {
+                if (players[key]) {
+                    players[key].wrapper.remove();
+                    if (players[key].jmuxer) players[key].jmuxer.destroy();
+                    delete players[key];
                 }
             }
         });
 
-        newAddresses.forEach(addr => {
-            if (!currentAddresses.includes(addr)) {
-                const client = clients[addr];
+        newKeys.forEach(key => {
+            const { address, stream, codec } = streams[key];
+            if (!players[key]) {
                 const wrapper = document.createElement('div');
                 wrapper.className = 'video-wrapper';
-                wrapper.dataset.address = addr;
+                wrapper.dataset.key = key;
 
-                const video = document.createElement('video');
+                const video = document.createElement(codec === 'mjpeg' ? 'img' : 'video');
                 video.autoplay = true;
                 video.muted = true;
                 video.playsInline = true;
+                video.draggable = false;
 
                 const fpsDisplay = document.createElement('div');
                 fpsDisplay.className = 'fps-display';
                 fpsDisplay.textContent = 'FPS: 0';
 
+                // The agent's pointer, drawn from the cursor side channel
+                const cursor = document.createElement('div');
+                cursor.className = 'cursor-overlay';
+
                 wrapper.appendChild(video);
+                wrapper.appendChild(cursor);
                 wrapper.appendChild(fpsDisplay);
                 videoGrid.appendChild(wrapper);
 
-                const jmuxer = new JMuxer({
-                    node: video,
-                    mode: 'video',
-                    flushingTime: 0,
-                    fps: 60,
-                    debug: false,
-                });
-
-                players[addr] = {
-                    jmuxer: jmuxer,
+                players[key] = {
+                    address: address,
+                    stream: stream,
+                    codec: codec,
+                    jmuxer: null,
                     wrapper: wrapper,
                     video: video,
+                    cursor: cursor,
+                    geometry: null,
                     fpsDisplay: fpsDisplay,
                     frameCount: 0,
+                    sps: null,
+                    layer: null,
+                    large: null,
+                    awaitingKeyframe: false,
+                    recoveredAt: -Infinity,
+                    lastTime: 0, // video.currentTime at the last stall check
                 };
+                if (codec !== 'mjpeg') {
+                    const player = players[key];
+                    player.jmuxer = createJMuxer(player);
+                    video.addEventListener('error', () => recoverPlayer(player, 'video element error'));
+                }
 
-                wrapper.addEventListener('mouseenter', () => handleMouseEnter(addr));
-                wrapper.addEventListener('mouseleave', () => handleMouseLeave(addr));
-                wrapper.addEventListener('mousemove', (e) => handleMouseMove(e, addr));
+                requestKeyframe(address, stream);
+
+                wrapper.addEventListener('mouseenter', () => handleMouseEnter(key));
+                wrapper.addEventListener('mouseleave', () => handleMouseLeave(key));
+                wrapper.addEventListener('mousemove', (e) => handleMouseMove(e, key));
             }
+            if (streams[key].geometry.width) players[key].geometry = streams[key].geometry;
+            updateSubscription(players[key], clients[address]);
         });
     }
     
     setInterval(() => {
-        for (const addr in players) {
-            if (players[addr].fpsDisplay) {
-                players[addr].fpsDisplay.textContent = `FPS: ${players[addr].frameCount}`;
-                players[addr].frameCount = 0;
+        for (const key in players) {
+            const player = players[key];
+            if (player.jmuxer && player.frameCount > 0 && !player.video.paused) {
+                // Frames arrive but the picture stands still: something was lost on the way
+                if (player.video.currentTime === player.lastTime) recoverPlayer(player, 'playback stalled');
+                player.lastTime = player.video.currentTime;
+            } else if (player.awaitingKeyframe) {
+                requestKeyframe(player.address, player.stream); // The first request may have been rate-limited
+            }
+            if (players[key].fpsDisplay) {
+                players[key].fpsDisplay.textContent = `FPS: ${players[key].frameCount}`;
+                players[key].frameCount = 0;
             }
         }
     }, 1000);
 
-    function handleMouseEnter(address) {
-        activeIOClient = address;
+    async function requestKeyframe(address, stream) {
+        try {
+            await fetch('/api/video/keyframe', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ address: address, stream: stream }),
+            });
+        } catch (error) {
+            console.error('Error requesting keyframe:', error);
+        }
+    }
+
+    async function setFocusedClient(address) {
+        try {
+            await fetch('/api/video/focus', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ address: address }),
+            });
+        } catch (error) {
+            console.error('Error setting focused client:', error);
+        }
+    }
+
+    // activeIOClient holds the stream key of the hovered tile
+    function handleMouseEnter(key) {
+        activeIOClient = key;
+        setFocusedClient(players[key].address);
         document.querySelectorAll('.video-wrapper').forEach(w => {
-            w.classList.toggle('active', w.dataset.address === address);
-            w.classList.toggle('inactive', w.dataset.address !== address);
+            w.classList.toggle('active', w.dataset.key === key);
+            w.classList.toggle('inactive', w.dataset.key !== key);
         });
     }
 
-    function handleMouseLeave(address) {
-        if (activeIOClient === address) activeIOClient = null;
+    function handleMouseLeave(key) {
+        if (activeIOClient === key) {
+            activeIOClient = null;
+            setFocusedClient(null);
+        }
         document.querySelectorAll('.video-wrapper').forEach(w => w.classList.remove('active', 'inactive'));
     }
 
-    function handleMouseMove(event, address) {
-        if (activeIOClient !== address || !inputForwardingCheckbox.checked) return;
-        const rect = event.target.getBoundingClientRect();
-        const normalizedX = (event.clientX - rect.left) / rect.width;
-        const normalizedY = (event.clientY - rect.top) / rect.height;
-        sendIOEvent(address, 'mouse_event', { event_type: 'move', x: normalizedX, y: normalizedY });
+    function handleMouseMove(event, key) {
+        if (activeIOClient !== key || !inputForwardingCheckbox.checked) return;
+        const player = players[key];
+        const position = streamPosition(event, player.video);
+        sendIOEvent(player.address, 'mouse_event', { event_type: 'move', x: position.x, y: position.y, stream: player.stream });
     }
 
     function handleMouseClick(event) {
         if (!activeIOClient || !inputForwardingCheckbox.checked) return;
-        const rect = players[activeIOClient].video.getBoundingClientRect();
-        const normalizedX = (event.clientX - rect.left) / rect.width;
-        const normalizedY = (event.clientY - rect.top) / rect.height;
+        const player = players[activeIOClient];
+        const position = streamPosition(event, player.video);
         const payload = {
             event_type: 'click',
-            x: normalizedX,
-            y: normalizedY,
+            x: position.x,
+            y: position.y,
+            stream: player.stream,
             button: `Button.${event.button === 0 ? 'left' : 'right'}`,
             pressed: event.type === 'mousedown',
         };
-        sendIOEvent(activeIOClient, 'mouse_event', payload);
+        sendIOEvent(player.address, 'mouse_event', payload);
     }
 
     function handleMouseScroll(event) {
         if (!activeIOClient || !inputForwardingCheckbox.checked) return;
         event.preventDefault();
-        sendIOEvent(activeIOClient, 'mouse_event', { event_type: 'scroll', dx: event.deltaX, dy: event.deltaY });
+        sendIOEvent(players[activeIOClient].address, 'mouse_event', { event_type: 'scroll', dx: event.deltaX, dy: event.deltaY });
     }
 
     function handleKeyEvent(event) {
         if (!activeIOClient || !inputForwardingCheckbox.checked) return;
         event.preventDefault();
-        sendIOEvent(activeIOClient, 'key_event', { event_type: event.type, key: event.key });
+        sendIOEvent(players[activeIOClient].address, 'key_event', { event_type: event.type, key: event.key });
     }
 
     async function sendIOEvent(address, event_type, payload) {
@@ -200,7 +504,10 @@ document.addEventListener('DOMContentLoaded', () => {
             const li = document.createElement('li');
             li.textContent = `${client.name} (${address})`;
             li.dataset.address = address;
-            if (client.is_active) li.classList.add('active');
+            if (client.is_active) {
+                li.classList.add('active');
+                activeClientAddress = address;
+            }
             li.addEventListener('click', () => setActiveClient(address));
             clientList.appendChild(li);
         }
@@ -300,6 +607,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
     inputForwardingCheckbox.addEventListener('change', (event) => setInputForwarding(event.target.checked));
     startAgentBtn.addEventListener('click', startAgent);
+    pushFileBtn.addEventListener('click', () => transferFile('push'));
+    pullFileBtn.addEventListener('click', () => transferFile('pull'));
     stopAgentBtn.addEventListener('click', stopAgent);
     refreshIntervalSelect.addEventListener('change', setupRefreshTimer);
     shutdownHubBtn.addEventListener('click', async () => {
@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+pytest.importorskip("evdev")
+from evdev import InputEvent, ecodes
+
+from central_hub.evdev_capture import EvdevCapture, build_capture_key_table
+from common.protocol import MessageType
+
+def key(code, value):
+    return InputEvent(0, 0, ecodes.EV_KEY, code, value)
+
+def rel(code, value):
+    return InputEvent(0, 0, ecodes.EV_REL, code, value)
+
+SYN = InputEvent(0, 0, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
+
+class StandInDevice:
+    """Stands in for a uinput-created device: a pipe to select on and a queue of events."""
+    def __init__(self, name="stand-in"):
+        self.name = name
+        self.fd, self.writer = os.pipe()
+        self.queued = []
+        self.grabs = []
+
+    def push(self, *events):
+        self.queued.extend(events)
+        os.write(self.writer, b"x")
+
+    def read(self):
+        os.read(self.fd, 4096)
+        events, self.queued = self.queued, []
+        return iter(events)
+
+    def grab(self):
+        self.grabs.append(True)
+
+    def ungrab(self):
+        self.grabs.append(False)
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self.writer)
+
+@pytest.fixture
+def sent():
+    return []
+
+@pytest.fixture
+def capture(sent):
+    return EvdevCapture(lambda msg_type, payload: sent.append((msg_type, payload)), devices=[],
+                        geometry=(0, 0, 100, 50))
+
+def test_key_table_uses_wire_names():
+    table = build_capture_key_table()
+    assert table[ecodes.KEY_LEFTSHIFT] == "Key.shift"
+    assert table[ecodes.KEY_RIGHTALT] == "Key.alt_r"
+    assert table[ecodes.KEY_SPACE] == "Key.space"
+    assert table[ecodes.KEY_A] == "a"
+    assert table[ecodes.KEY_1] == "1"
+    assert table[ecodes.KEY_SLASH] == "/"
+
+def test_keys_become_key_events(capture, sent):
+    capture.handle_events(3, [key(ecodes.KEY_LEFTSHIFT, 1), key(ecodes.KEY_A, 1), key(ecodes.KEY_A, 2),
+                              key(ecodes.KEY_A, 0), key(ecodes.KEY_LEFTSHIFT, 0), SYN])
+    assert sent == [
+        (MessageType.KEY_EVENT, {"event_type": "press", "key": "Key.shift"}),
+        (MessageType.KEY_EVENT, {"event_type": "press", "key": "a"}),
+        (MessageType.KEY_EVENT, {"event_type": "press", "key": "a"}),
+        (MessageType.KEY_EVENT, {"event_type": "release", "key": "a"}),
+        (MessageType.KEY_EVENT, {"event_type": "release", "key": "Key.shift"}),
+    ]
+
+def test_motion_is_one_move_per_frame_and_clamped(capture, sent):
+    capture.handle_events(3, [rel(ecodes.REL_X, 5), rel(ecodes.REL_Y, -3), rel(ecodes.REL_X, 5), SYN,
+                              rel(ecodes.REL_X, 1000), SYN])
+    assert sent == [
+        (MessageType.MOUSE_EVENT, {"event_type": "move", "x": 60, "y": 22}),
+        (MessageType.MOUSE_EVENT, {"event_type": "move", "x": 99, "y": 22}),
+    ]
+
+def test_click_lands_after_motion_of_same_frame(capture, sent):
+    capture.handle_events(3, [rel(ecodes.REL_X, -10), key(ecodes.BTN_LEFT, 1), rel(ecodes.REL_WHEEL, -1), SYN])
+    assert sent == [
+        (MessageType.MOUSE_EVENT, {"event_type": "move", "x": 40, "y": 25}),
+        (MessageType.MOUSE_EVENT, {"event_type": "click", "x": 40, "y": 25, "button": "Button.left",
+                                   "pressed": True}),
+        (MessageType.MOUSE_EVENT, {"event_type": "scroll", "x": 40, "y": 25, "dx": 0, "dy": -1}),
+    ]
+
+def test_reads_stand_in_device_and_grabs(sent):
+    device = StandInDevice()
+    capture = EvdevCapture(lambda msg_type, payload: sent.append((msg_type, payload)), devices=[device], grab=True)
+    capture.start()
+    try:
+        device.push(key(ecodes.KEY_B, 1), SYN)
+        for _ in range(100):
+            if sent:
+                break
+            capture.thread.join(0.01)
+        assert sent == [(MessageType.KEY_EVENT, {"event_type": "press", "key": "b"})]
+        # Scroll Lock releases the grab and is not forwarded
+        capture.handle_events(device.fd, [key(ecodes.KEY_SCROLLLOCK, 1), key(ecodes.KEY_SCROLLLOCK, 0)])
+        assert capture.grabbed is False
+        assert len(sent) == 1
+    finally:
+        capture.running = False
+        capture.thread.join(1)
+    assert device.grabs == [True, False]
+    device.close()
+
+def test_grab_only_when_configured(capture):
+    capture.set_grab(True)
+    assert capture.grabbed is False
@@ -0,0 +1,94 @@
+import av
+import cv2
+import numpy as np
+import pytest
+
+from central_hub.snapshots import SnapshotSource
+from central_hub.state_manager import StateManager
+
+
+def solid(value, width=64, height=48):
+    return np.full((height, width, 3), value, np.uint8)
+
+
+def shows(picture, value):
+    return abs(picture.mean() - value) <= 8  # Lossy, but far apart from the neighbouring frames
+
+
+def h264_stream(values, keyframes=(0,)):
+    """Access units for solid frames of the given values, IDRs at the given indices."""
+    stream = av.open('dummy', mode='w', format='h264').add_stream('libx264', rate=10)
+    stream.width, stream.height, stream.pix_fmt = 64, 48, 'yuv420p'
+    stream.options = {'tune': 'zerolatency', 'preset': 'ultrafast', 'g': '1000'}
+    units = []
+    for i, value in enumerate(values):
+        frame = av.VideoFrame.from_ndarray(solid(value), format='bgr24')
+        if i in keyframes:
+            frame.pict_type = av.video.frame.PictureType.I
+        units.append((b"".join(bytes(p) for p in stream.encode(frame)), i in keyframes))
+    return units
+
+
+def test_jpeg_is_decoded_only_on_request():
+    source = SnapshotSource("mjpeg")
+    for value in (10, 100, 200):
+        source.push(cv2.imencode('.jpg', solid(value))[1].tobytes(), keyframe=True)
+    assert source.decoded == 0
+    assert shows(source.picture(), 200)
+    assert source.decoded == 1
+    # Nothing new: the cached picture
+    assert source.picture() is source.picture()
+    assert source.decoded == 1
+
+
+def test_h264_decodes_what_arrived_since_the_last_snapshot():
+    units = h264_stream([20, 60, 100, 140, 180])
+    source = SnapshotSource("h264")
+    for data, keyframe in units[:3]:
+        source.push(data, keyframe)
+    assert source.decoded == 0
+    assert shows(source.picture(), 100)
+    assert source.decoded == 3
+
+    for data, keyframe in units[3:]:
+        source.push(data, keyframe)
+    assert shows(source.picture(), 180)
+    assert source.decoded == 5  # The decoder carried on instead of starting over
+
+
+def test_h264_keyframe_discards_older_access_units():
+    units = h264_stream([20, 60, 100, 140], keyframes=(0, 2))
+    source = SnapshotSource("h264")
+    for data, keyframe in units:
+        source.push(data, keyframe)
+    assert shows(source.picture(), 140)
+    assert source.decoded == 2
+
+
+def test_h264_without_a_keyframe_waits_for_one():
+    units = h264_stream([20, 60, 100])
+    source = SnapshotSource("h264")
+    source.push(*units[1])
+    assert source.picture() is None
+    source.push(*units[0])
+    assert source.picture() is not None
+
+
+def test_pending_h264_is_bounded():
+    units = h264_stream([20, 60, 100])
+    source = SnapshotSource("h264", max_pending_bytes=len(units[0][0]) + 1)
+    for data, keyframe in units:
+        source.push(data, keyframe)
+    assert source.pending == [] and source.pending_bytes == 0
+    # Starts over at the next keyframe
+    source.push(*units[1])
+    assert source.pending == []
+
+
+def test_state_manager_stores_encoded_frames():
+    sm = StateManager()
+    sm.add_client("USB:/dev/ttyACM0", {"name": "usb", "type": "USB"})
+    sm.update_latest_encoded("USB:/dev/ttyACM0", "mjpeg", cv2.imencode('.jpg', solid(90))[1].tobytes(), True)
+    assert sm.get_latest_frame("USB:/dev/ttyACM0").shape == (48, 64, 3)
+    sm.remove_client("USB:/dev/ttyACM0")
+    assert sm.get_latest_frame("USB:/dev/ttyACM0") is None
@@ -0,0 +1,120 @@
+import pytest
+from unittest.mock import patch
+
+from central_hub import state_manager as state_manager_module
+from central_hub.state_manager import StateManager
+
+@pytest.fixture
+def state_manager():
+    sm = StateManager()
+    sm.add_client(('127.0.0.1', 5000), {"name": "agent"})
+    return sm
+
+def test_keyframe_requests_are_rate_limited_per_source(state_manager):
+    addr = ('127.0.0.1', 5000)
+    with patch('central_hub.state_manager.time.monotonic', return_value=100.0):
+        assert state_manager.should_request_keyframe(addr, 0.5) is True
+        assert state_manager.should_request_keyframe(addr, 0.5) is False
+        # Other sources have their own budget
+        assert state_manager.should_request_keyframe(('127.0.0.2', 5000), 0.5) is True
+    with patch('central_hub.state_manager.time.monotonic', return_value=100.6):
+        assert state_manager.should_request_keyframe(addr, 0.5) is True
+
+def test_forced_keyframe_request_bypasses_rate_limit(state_manager):
+    addr = ('127.0.0.1', 5000)
+    assert state_manager.should_request_keyframe(addr, 0.5) is True
+    assert state_manager.should_request_keyframe(addr, 0) is True
+
+def test_remove_client_clears_keyframe_history(state_manager):
+    addr = ('127.0.0.1', 5000)
+    state_manager.should_request_keyframe(addr, 60)
+    state_manager.remove_client(addr)
+    assert state_manager.should_request_keyframe(addr, 60) is True
+
+def test_stream_reconfigure_updates_geometry(state_manager):
+    addr = ('127.0.0.1', 5000)
+    state_manager.get_client_info(addr)["streams"] = [{"id": 1, "left": 0, "top": 0, "width": 1920, "height": 1080}]
+    assert state_manager.update_stream_geometry(addr, {"stream": 1, "left": 0, "top": 0, "width": 1280, "height": 720})
+    assert state_manager.get_client_info(addr)["streams"] == [{"id": 1, "left": 0, "top": 0, "width": 1280, "height": 720}]
+    assert not state_manager.update_stream_geometry(('127.0.0.2', 5000), {"stream": 1, "width": 800, "height": 600})
+
+def test_resumed_session_gets_slot_and_active_status_back():
+    sm = StateManager()
+    first, second = ('127.0.0.1', 5000), ('127.0.0.2', 5000)
+    sm.add_client(first, {"name": "one", "session": "s1"})
+    sm.add_client(second, {"name": "two", "session": "s2"})
+    sm.set_active_client(first)
+    sm.remove_client(first)
+    sm.set_active_client(None)
+
+    reconnected = ('127.0.0.1', 5001)
+    assert sm.add_client(reconnected, {"name": "one", "session": "s1"}) is True
+    assert list(sm.get_all_clients()) == [reconnected, second]
+    assert sm.get_active_client() == reconnected
+    assert sm.find_client_by_session("s1") == reconnected
+
+def test_resumed_session_does_not_override_a_newer_choice():
+    sm = StateManager()
+    first, second = ('127.0.0.1', 5000), ('127.0.0.2', 5000)
+    sm.add_client(first, {"name": "one", "session": "s1"})
+    sm.add_client(second, {"name": "two", "session": "s2"})
+    sm.set_active_client(first)
+    sm.remove_client(first)
+    # The user moves on to another client during the outage
+    sm.set_active_client(second)
+
+    reconnected = ('127.0.0.1', 5001)
+    assert sm.add_client(reconnected, {"name": "one", "session": "s1"}) is True
+    assert list(sm.get_all_clients()) == [reconnected, second]
+    assert sm.get_active_client() == second
+
+def test_departed_sessions_expire_and_are_capped():
+    clock = [0.0]
+    sm = StateManager(clock=lambda: clock[0])
+    sm.add_client(('127.0.0.1', 5000), {"name": "old", "session": "old"})
+    sm.remove_client(('127.0.0.1', 5000))
+    clock[0] += state_manager_module.DEPARTED_SESSION_TTL + 1
+    for i in range(state_manager_module.MAX_DEPARTED_SESSIONS + 10):
+        sm.add_client(('127.0.0.2', i), {"name": "agent", "session": f"s{i}"})
+        sm.remove_client(('127.0.0.2', i))
+
+    assert len(sm.departed_sessions) == state_manager_module.MAX_DEPARTED_SESSIONS
+    assert "old" not in sm.departed_sessions and "s0" not in sm.departed_sessions
+    assert f"s{state_manager_module.MAX_DEPARTED_SESSIONS + 9}" in sm.departed_sessions
+
+def test_new_session_is_appended_and_not_activated(state_manager):
+    assert state_manager.add_client(('127.0.0.2', 5000), {"name": "new", "session": "s9"}) is False
+    assert list(state_manager.get_all_clients())[-1] == ('127.0.0.2', 5000)
+    assert state_manager.get_active_client() is None
+
+def test_active_session_survives_hub_restart(tmp_path):
+    session_file = str(tmp_path / "hub_session.json")
+    sm = StateManager(session_file=session_file)
+    sm.add_client(('127.0.0.1', 5000), {"name": "one", "session": "s1"})
+    sm.set_active_client(('127.0.0.1', 5000))
+
+    restarted = StateManager(session_file=session_file)
+    restarted.add_client(('127.0.0.2', 5000), {"name": "two", "session": "s2"})
+    assert restarted.add_client(('127.0.0.1', 6000), {"name": "one", "session": "s1"}) is True
+    assert restarted.get_active_client() == ('127.0.0.1', 6000)
+
+def test_active_session_wins_over_an_agent_picked_while_it_reconnects(tmp_path):
+    session_file = str(tmp_path / "hub_session.json")
+    sm = StateManager(session_file=session_file)
+    sm.add_client(('127.0.0.1', 5000), {"name": "one", "session": "s1"})
+    sm.set_active_client(('127.0.0.1', 5000))
+
+    restarted = StateManager(session_file=session_file)
+    # The other agent is back first and the hub makes it active for the time being
+    assert restarted.add_client(('127.0.0.2', 5000), {"name": "two", "session": "s2"}) is False
+    restarted.set_active_client(('127.0.0.2', 5000), chosen=False)
+    assert StateManager(session_file=session_file).active_session == "s1"
+
+    assert restarted.add_client(('127.0.0.1', 6000), {"name": "one", "session": "s1"}) is True
+    assert restarted.get_active_client() == ('127.0.0.1', 6000)
+
+def test_video_connection_matches_client_still_without_video(state_manager):
+    state_manager.add_video_socket(('127.0.0.1', 5000), object())
+    state_manager.add_client(('127.0.0.1', 5001), {"name": "agent"})
+    assert state_manager.find_client_by_ip('127.0.0.1') == ('127.0.0.1', 5000)
+    assert state_manager.find_client_by_ip('127.0.0.1', without_video=True) == ('127.0.0.1', 5001)
@@ -0,0 +1,148 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import wait
+from types import SimpleNamespace
+
+import pytest
+
+from central_hub.usb_discovery import PortFilter, SerialDiscovery
+
+
+def usb_port(device, vid=0x2e8a, pid=0x000a, description="Pico", serial_number="E1", manufacturer=None):
+    return SimpleNamespace(device=device, vid=vid, pid=pid, description=description, serial_number=serial_number,
+                           manufacturer=manufacturer, product=None)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_filter_defaults_to_usb_devices_that_are_not_modems():
+    port_filter = PortFilter()
+    assert port_filter.matches(usb_port("/dev/ttyACM0"))
+    assert not port_filter.matches(usb_port("/dev/ttyS0", vid=None, pid=None, description="ttyS0"))
+    assert not port_filter.matches(usb_port("/dev/ttyACM1", description="Sierra Wireless Modem"))
+    assert not port_filter.matches(usb_port("/dev/rfcomm0", description="n/a", manufacturer="Bluetooth Serial"))
+
+
+def test_filter_by_ids_and_description():
+    by_id = PortFilter(ids="2e8a:000a, 0483:*")
+    assert by_id.matches(usb_port("/dev/ttyACM0"))
+    assert by_id.matches(usb_port("/dev/ttyACM1", vid=0x0483, pid=0x5740))
+    assert not by_id.matches(usb_port("/dev/ttyUSB0", vid=0x10c4, pid=0xea60))
+
+    by_description = PortFilter(descriptions="pico,netkvm")
+    assert by_description.matches(usb_port("/dev/ttyACM0", description="NetKVM agent"))
+    assert not by_description.matches(usb_port("/dev/ttyUSB0", description="CP2102 USB to UART"))
+
+
+def test_handshakes_run_concurrently_within_the_pool_bound():
+    active, peak, lock = [0], [0], threading.Lock()
+
+    def probe(port):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.1)
+        with lock:
+            active[0] -= 1
+        return True
+
+    ports = [usb_port(f"/dev/ttyACM{i}", serial_number=str(i)) for i in range(6)]
+    discovery = SerialDiscovery(probe, workers=3, list_ports=lambda: ports)
+    started = time.monotonic()
+    wait(discovery.scan())
+    elapsed = time.monotonic() - started
+    assert peak[0] == 3
+    assert elapsed < 0.5  # Two rounds of 0.1 s, not six
+    assert len(discovery.connect_times) == 6
+    # Connected ports are not probed again while their agent is served
+    assert discovery.scan() == []
+
+
+def test_failed_ports_are_cached_until_expiry():
+    clock = Clock()
+    probed = []
+    ports = [usb_port("/dev/ttyACM0")]
+    discovery = SerialDiscovery(lambda port: probed.append(port.device) or False, negative_ttl=60,
+                                list_ports=lambda: ports, clock=clock)
+    wait(discovery.scan())
+    assert discovery.scan() == []
+    clock.now += 59
+    assert discovery.scan() == []
+    clock.now += 2
+    wait(discovery.scan())
+    assert probed == ["/dev/ttyACM0", "/dev/ttyACM0"]
+
+    # Something else plugged into the same node is probed right away
+    ports[0] = usb_port("/dev/ttyACM0", serial_number="E2")
+    wait(discovery.scan())
+    assert len(probed) == 3
+
+
+def test_released_ports_are_probed_again():
+    ports = [usb_port("/dev/ttyACM0")]
+    discovery = SerialDiscovery(lambda port: True, list_ports=lambda: ports)
+    assert len(discovery.scan()) == 1
+    assert discovery.scan() == []
+    discovery.release("/dev/ttyACM0")
+    assert len(discovery.scan()) == 1
+
+
+def test_hotplug_scans_probe_only_the_named_nodes():
+    probed = []
+    ports = [usb_port("/dev/ttyACM0", serial_number="0"), usb_port("/dev/ttyACM1", serial_number="1")]
+    discovery = SerialDiscovery(lambda port: probed.append(port.device) or True, list_ports=lambda: ports)
+    wait(discovery.scan(names={"ttyACM1"}))
+    assert probed == ["/dev/ttyACM1"]
+    wait(discovery.scan())
+    assert probed == ["/dev/ttyACM1", "/dev/ttyACM0"]
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_other_nodes_in_dev_do_not_trigger_a_scan(tmp_path):
+    listed = []
+
+    def list_ports():
+        listed.append(time.monotonic())
+        return []
+
+    discovery = SerialDiscovery(lambda port: True, poll_interval=60, settle=0.01, dev_dir=str(tmp_path),
+                                list_ports=list_ports)
+    discovery.start()
+    try:
+        time.sleep(0.1)
+        for i in range(5):
+            (tmp_path / f"loop{i}").touch()
+        time.sleep(0.2)
+        assert len(listed) == 1
+        (tmp_path / "ttyUSB3").touch()
+        time.sleep(0.2)
+        assert len(listed) == 2
+    finally:
+        discovery.stop()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_hotplugged_nodes_are_probed_without_waiting_for_a_poll(tmp_path):
+    connected = threading.Event()
+
+    def list_ports():
+        return [usb_port(str(tmp_path / name), serial_number=name) for name in os.listdir(tmp_path)]
+
+    discovery = SerialDiscovery(lambda port: connected.set() or True, poll_interval=60, settle=0.01,
+                                dev_dir=str(tmp_path), list_ports=list_ports)
+    discovery.start()
+    try:
+        time.sleep(0.1)  # The first scan finds nothing
+        (tmp_path / "ttyACM7").touch()
+        assert connected.wait(timeout=2)
+    finally:
+        discovery.stop()
+    assert discovery.connect_times[0] < 0.5
@@ -0,0 +1,194 @@
+import fcntl
+import os
+import random
+import select
+import struct
+import termios
+import threading
+import time
+
+import pytest
+
+from common.baud_negotiation import follow_baudrate_negotiation, negotiate_baudrate, parse_baudrates
+from common.serial_protocol import FrameReader, LinkMeter, send_framed
+
+
+class LineEnd:
+    """One end of a simulated serial line."""
+    def __init__(self, line, max_settable):
+        self.line = line
+        self.max_settable = max_settable
+        self._baudrate = 115200
+        self.timeout = 2
+        self.inbox = bytearray()
+        self.peer = None
+
+    @property
+    def baudrate(self):
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, value):
+        if value > self.max_settable:
+            raise ValueError(f"unsupported baud rate {value}")
+        self._baudrate = value
+
+    @property
+    def in_waiting(self):
+        with self.line.cond:
+            return len(self.inbox)
+
+    def read(self, size=1):
+        deadline = time.monotonic() + self.timeout
+        with self.line.cond:
+            while not self.inbox and self.line.cond.wait(max(0.0, deadline - time.monotonic())):
+                pass
+            data = bytes(self.inbox[:size])
+            del self.inbox[:size]
+            return data
+
+    def write(self, data):
+        self.line.carry(self, self.peer, bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        with self.line.cond:
+            self.inbox.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+
+class SimulatedLine:
+    """
+    Two ports joined by a line that carries data cleanly up to clean_rate,
+    garbles it above, and turns it into noise while the ends disagree on
+    the rate.
+    """
+    def __init__(self, clean_rate, hub_max=12_000_000, agent_max=12_000_000):
+        self.clean_rate = clean_rate
+        self.cond = threading.Condition()
+        self.rng = random.Random(7)
+        self.hub, self.agent = LineEnd(self, hub_max), LineEnd(self, agent_max)
+        self.hub.peer, self.agent.peer = self.agent, self.hub
+
+    def carry(self, sender, receiver, data):
+        if sender.baudrate != receiver.baudrate:
+            data = bytes(self.rng.randrange(256) for _ in data)
+        elif sender.baudrate > self.clean_rate:
+            data = bytearray(data)
+            for i in range(0, len(data), 97):
+                data[i] ^= 0x10
+        with self.cond:
+            receiver.inbox += data
+            self.cond.notify_all()
+
+
+class PtyMaster:
+    """The agent's end of a pty; a pty carries data at any baud rate."""
+    def __init__(self, fd):
+        self.fd = fd
+        self.baudrate = 115200
+        self.timeout = 2
+
+    @property
+    def in_waiting(self):
+        return struct.unpack('I', fcntl.ioctl(self.fd, termios.FIONREAD, b'\0' * 4))[0]
+
+    def read(self, size=1):
+        ready, _, _ = select.select([self.fd], [], [], self.timeout)
+        return os.read(self.fd, size) if ready else b''
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        while select.select([self.fd], [], [], 0)[0]:
+            os.read(self.fd, 65536)
+
+
+def negotiate(hub_port, agent_port, offered, supported):
+    agent_result = []
+    agent = threading.Thread(target=lambda: agent_result.append(
+        follow_baudrate_negotiation(agent_port, FrameReader(agent_port), supported)), daemon=True)
+    agent.start()
+    hub_reader = FrameReader(hub_port)
+    hub_result = negotiate_baudrate(hub_port, hub_reader, offered, supported)
+    agent.join(timeout=10)
+    return hub_result, agent_result[0], hub_reader
+
+
+def still_talking(hub_port, hub_reader, agent_port):
+    send_framed(agent_port, {"type": "ping", "payload": {}})
+    return hub_reader.receive_framed() == {"type": "ping", "payload": {}}
+
+
+def test_parse_baudrates():
+    assert parse_baudrates("921600, 3000000,,921600, x") == [3000000, 921600]
+    assert parse_baudrates([115200, "230400"]) == [230400, 115200]
+
+
+def test_keeps_the_fastest_rate_both_ends_support():
+    line = SimulatedLine(clean_rate=12_000_000)
+    (rate, measured), (agent_rate, agent_measured), reader = negotiate(
+        line.hub, line.agent, "12000000,3000000,921600", "3000000,921600")
+    assert rate == agent_rate == line.hub.baudrate == line.agent.baudrate == 3_000_000
+    assert measured > 0 and agent_measured == measured
+    assert still_talking(line.hub, reader, line.agent)
+
+
+def test_falls_back_when_a_rate_garbles_data():
+    line = SimulatedLine(clean_rate=1_000_000)
+    (rate, measured), (agent_rate, _), reader = negotiate(line.hub, line.agent, "3000000,1000000", "3000000,1000000")
+    assert rate == agent_rate == line.hub.baudrate == line.agent.baudrate == 1_000_000
+    assert still_talking(line.hub, reader, line.agent)
+
+
+def test_falls_back_when_the_agent_cannot_set_a_rate():
+    line = SimulatedLine(clean_rate=12_000_000, agent_max=2_000_000)
+    (rate, _), (agent_rate, _), reader = negotiate(line.hub, line.agent, "3000000,2000000", "3000000,2000000")
+    assert rate == agent_rate == line.agent.baudrate == 2_000_000
+    assert still_talking(line.hub, reader, line.agent)
+
+
+def test_stays_at_the_base_rate_when_nothing_faster_works():
+    line = SimulatedLine(clean_rate=115200)
+    (rate, measured), (agent_rate, agent_measured), reader = negotiate(line.hub, line.agent, "460800", "460800")
+    assert (rate, measured) == (agent_rate, agent_measured) == (115200, None)
+    assert line.hub.baudrate == line.agent.baudrate == 115200
+    assert still_talking(line.hub, reader, line.agent)
+
+    # No rate in common: done right away
+    started = time.monotonic()
+    assert negotiate(line.hub, line.agent, "921600", "460800")[:2] == ((115200, None), (115200, None))
+    assert time.monotonic() - started < 0.5
+
+
+def test_probe_rate_seeds_the_link_meter():
+    assert LinkMeter(3_000_000).bytes_per_second() == 300_000
+    assert LinkMeter(3_000_000, measured=120_000).bytes_per_second() == 120_000
+
+
+def test_negotiates_over_a_pty():
+    serial = pytest.importorskip("serial")
+    master, slave = os.openpty()
+    hub_port = serial.Serial(os.ttyname(slave), baudrate=115200, timeout=2)
+    agent_port = PtyMaster(master)
+    try:
+        (rate, measured), (agent_rate, _), reader = negotiate(hub_port, agent_port, "3000000,921600", "3000000")
+        assert rate == agent_rate == hub_port.baudrate == 3_000_000
+        assert measured > 0
+        assert hub_port.timeout == 2  # Restored after negotiating
+        assert still_talking(hub_port, reader, agent_port)
+    finally:
+        hub_port.close()
+        os.close(master)
+        os.close(slave)
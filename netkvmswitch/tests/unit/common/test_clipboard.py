@@ -0,0 +1,202 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from common import clipboard
+from common.clipboard import (IMAGE, TEXT, ClipboardChannel, LocalClipboard, PasteHold, PasteKeys, content_hash,
+                              describe)
+from common.file_transfer import BacklogGate
+from common.protocol import MessageReader, MessageType, create_data_message
+
+class FakeBackend:
+    def __init__(self, content=None):
+        self.content = content
+        self.token = 0
+        self.reads = 0
+
+    def sequence(self):
+        return self.token
+
+    def read(self):
+        self.reads += 1
+        return self.content
+
+    def write(self, mime, data):
+        self.content = (mime, data)
+        self.token += 1
+
+class Peer:
+    """One end of a connection, its clipboard channel fed by a reader thread like the hub's and agent's."""
+    def __init__(self, sock, content=None):
+        self.sock = sock
+        self.content = content or {}
+        self.announcements = []
+        self.received = []  # Every message, to see what went over the connection
+        self.channel = ClipboardChannel(sock, threading.Lock(), BacklogGate(sock), self.content.get,
+                                        self.announcements.append)
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        reader = MessageReader()
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            for message in reader.feed(data):
+                self.received.append(message)
+                self.channel.handle(message)
+        self.channel.close()
+
+    def wait_for(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while len(self.announcements) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(self.announcements) >= count
+
+@pytest.fixture
+def peers():
+    hub_sock, agent_sock = socket.socketpair()
+    yield Peer(hub_sock), Peer(agent_sock)
+    hub_sock.close()
+    agent_sock.close()
+
+def test_small_text_goes_inline_and_large_content_by_hash():
+    text = describe(TEXT, "héllo".encode('utf-8'))
+    assert text["text"] == "héllo" and text["hash"] == content_hash("héllo".encode('utf-8'))
+
+    long_text = describe(TEXT, b"x" * (clipboard.INLINE_LIMIT + 1))
+    image = describe(IMAGE, b"\x89PNG" + bytes(100))
+    assert "text" not in long_text and long_text["size"] == clipboard.INLINE_LIMIT + 1
+    assert "text" not in image and image["mime"] == IMAGE
+
+def test_local_clipboard_announces_each_change_once():
+    backend = FakeBackend((TEXT, b"one"))
+    local = LocalClipboard(backend, on_change=None)
+
+    assert local.poll()["text"] == "one"
+    # Unchanged sequence: not even read
+    assert local.poll() is None and backend.reads == 1
+    # Changed sequence, same content: read but not announced
+    backend.token += 1
+    assert local.poll() is None
+    backend.content, backend.token = (TEXT, b"two"), backend.token + 1
+    assert local.poll()["text"] == "two"
+    assert local.content(content_hash(b"two")) == b"two"
+    assert local.content(content_hash(b"one")) is None
+
+def test_content_from_the_other_side_is_not_announced_back():
+    backend = FakeBackend()
+    local = LocalClipboard(backend, on_change=None)
+    local.write(IMAGE, b"picture")
+
+    assert backend.content == (IMAGE, b"picture")
+    assert local.poll() is None and backend.reads == 0
+    assert local.content(content_hash(b"picture")) == b"picture"
+
+def test_announcements_are_not_repeated_or_sent_back(peers):
+    hub, agent = peers
+    payload = describe(IMAGE, os.urandom(5 * 1024 * 1024))
+
+    assert hub.channel.announce(payload)
+    # Switching back and forth announces nothing new
+    assert not hub.channel.announce(payload)
+    agent.wait_for(1)
+    # Only the announcement went over the connection, not the 5 MB
+    assert [m["type"] for m in agent.received] == [MessageType.CLIPBOARD_EVENT]
+    assert agent.channel.pending == payload
+    # Nor does the agent send the hub's own clipboard back once it has it
+    assert not agent.channel.announce(payload)
+
+    # Once the agent's clipboard moves on, the same content is worth announcing again
+    assert agent.channel.announce(describe(TEXT, b"copied on the agent"))
+    hub.wait_for(1)
+    assert agent.channel.pending is None
+    assert hub.channel.announce(payload)
+
+def test_large_content_is_fetched_in_chunks_when_pasted(peers):
+    hub, agent = peers
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    payload = describe(IMAGE, data)
+    hub.content[payload["hash"]] = data
+    hub.channel.announce(payload)
+    agent.wait_for(1)
+
+    assert agent.channel.fetch(payload["hash"]) == data
+    chunks = [m for m in agent.received if m["type"] == MessageType.CLIPBOARD_DATA]
+    assert len(chunks) > 1 and all(len(m["data"]) <= clipboard.MAX_CHUNK for m in chunks)
+    assert agent.channel.pending is None
+
+def test_fetch_of_content_no_longer_there_fails(peers):
+    hub, agent = peers
+    assert agent.channel.fetch(content_hash(b"gone"), timeout=5) is None
+
+def test_fetch_refuses_content_larger_than_the_limit():
+    hub_sock, agent_sock = socket.socketpair()
+    agent = Peer(agent_sock)
+    result = []
+    fetching = threading.Thread(target=lambda: result.append(agent.channel.fetch("abc", timeout=5)))
+    fetching.start()
+    request = MessageReader().feed(hub_sock.recv(65536))[0]["payload"]["request"]
+    # The hub claims far more than any clipboard may hold
+    hub_sock.sendall(create_data_message(MessageType.CLIPBOARD_DATA, {"request": request, "offset": 0,
+                                                                      "size": clipboard.MAX_SIZE + 1}, 4) + b"data")
+    started = time.monotonic()
+    fetching.join(5)
+
+    # Refused as soon as it is announced, not after the fetch times out
+    assert result == [None] and time.monotonic() - started < 1
+    hub_sock.close()
+    agent_sock.close()
+
+def test_paste_shortcuts():
+    keys = PasteKeys()
+    press = lambda key: keys.feed({"event_type": "press", "key": key})
+    release = lambda key: keys.feed({"event_type": "release", "key": key})
+
+    assert not press("v")
+    assert not press("Key.ctrl_l")
+    assert press("v") and press("\x16")
+    release("Key.ctrl_l")
+    assert not press("v")
+    press("Key.cmd")
+    assert press("V")
+    release("Key.cmd")
+    press("Key.shift")
+    assert press("Key.insert")
+    assert not press("a")
+
+def test_paste_waits_for_its_content_and_keeps_input_order():
+    submitted = []
+    arrived = threading.Event()
+    fetched = threading.Event()
+    def fetch():
+        arrived.wait(5)
+        fetched.set()
+    hold = PasteHold(lambda msg_type, payload: submitted.append(payload["key"]), lambda: fetch)
+    key = lambda event_type, name: hold.submit(MessageType.KEY_EVENT, {"event_type": event_type, "key": name})
+
+    key("press", "Key.ctrl")
+    key("press", "v")
+    key("release", "v")
+    key("press", "x")
+    assert submitted == ["Key.ctrl"]
+
+    arrived.set()
+    assert fetched.wait(5)
+    deadline = time.monotonic() + 5
+    while len(submitted) < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert submitted == ["Key.ctrl", "v", "v", "x"]
+
+def test_paste_of_content_already_here_is_not_held():
+    submitted = []
+    hold = PasteHold(lambda msg_type, payload: submitted.append(payload["key"]), lambda: None)
+    for event_type, name in (("press", "Key.ctrl"), ("press", "v")):
+        hold.submit(MessageType.KEY_EVENT, {"event_type": event_type, "key": name})
+    assert submitted == ["Key.ctrl", "v"]
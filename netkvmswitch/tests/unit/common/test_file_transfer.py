@@ -0,0 +1,216 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from common import file_transfer
+from common.file_transfer import (HUB, BacklogGate, FileTransferChannel, Throttle, TransferState, safe_name,
+                                  unique_path)
+from common.protocol import MessageReader, MessageType, create_message
+
+class Peer:
+    """One end of a connection, its channel fed by a reader thread like the hub's and agent's."""
+    def __init__(self, sock, directory, **kwargs):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.updates = []
+        self.channel = FileTransferChannel(sock, self.send_lock, str(directory), progress=self.updates.append,
+                                           **kwargs)
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        reader = MessageReader()
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            for message in reader.feed(data):
+                self.channel.handle(message)
+        self.channel.close()
+
+    def wait(self, transfer_id, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            transfer = self.channel.transfers.get(transfer_id)
+            if transfer is not None and transfer.state in (TransferState.DONE, TransferState.FAILED):
+                return transfer
+            time.sleep(0.01)
+        raise AssertionError(f"Transfer {transfer_id} did not finish")
+
+@pytest.fixture
+def peers(tmp_path):
+    hub_sock, agent_sock = socket.socketpair()
+    hub = Peer(hub_sock, tmp_path / "hub", role=HUB)
+    agent = Peer(agent_sock, tmp_path / "agent")
+    yield hub, agent
+    hub_sock.close()
+    agent_sock.close()
+
+def write_file(path, size):
+    data = os.urandom(size)
+    path.write_bytes(data)
+    return data
+
+def test_push_delivers_the_file_and_reports_progress(peers, tmp_path, monkeypatch):
+    monkeypatch.setattr(file_transfer, "ACK_INTERVAL", 64 * 1024)
+    hub, agent = peers
+    data = write_file(tmp_path / "report.bin", 3 * 1024 * 1024 + 17)
+
+    transfer_id = hub.channel.push(str(tmp_path / "report.bin"))
+    sent = hub.wait(transfer_id)
+    received = agent.wait(transfer_id)
+
+    assert sent.state == received.state == TransferState.DONE
+    assert (tmp_path / "agent" / "report.bin").read_bytes() == data
+    assert received.hash.hexdigest() == hashlib.sha256(data).hexdigest()
+    assert not [name for name in os.listdir(tmp_path / "agent") if name.endswith(".part")]
+    states = [update["state"] for update in hub.updates]
+    assert states[0] == TransferState.OFFERED and states[-1] == TransferState.DONE
+    assert hub.updates[-1]["bytes"] == len(data)
+
+def test_pull_fetches_a_file_from_the_other_side(peers, tmp_path):
+    hub, agent = peers
+    data = write_file(tmp_path / "log.txt", 200000)
+
+    transfer_id = hub.channel.pull(str(tmp_path / "log.txt"))
+    received = hub.wait(transfer_id)
+
+    assert received.state == TransferState.DONE
+    assert received.path == str(tmp_path / "hub" / "log.txt")
+    assert (tmp_path / "hub" / "log.txt").read_bytes() == data
+    assert agent.wait(transfer_id).direction == file_transfer.SEND
+
+def test_pull_of_a_missing_file_fails_with_the_reason(peers, tmp_path):
+    hub, agent = peers
+    transfer = hub.wait(hub.channel.pull(str(tmp_path / "missing.txt")))
+    assert transfer.state == TransferState.FAILED
+    assert "missing.txt" in transfer.error
+
+def test_received_files_never_overwrite_or_escape_the_directory(peers, tmp_path):
+    hub, agent = peers
+    (tmp_path / "agent").mkdir()
+    (tmp_path / "agent" / "notes.txt").write_text("already here")
+    write_file(tmp_path / "notes.txt", 10)
+
+    transfer = agent.wait(hub.channel.push(str(tmp_path / "notes.txt")))
+
+    assert transfer.path == str(tmp_path / "agent" / "notes (1).txt")
+    assert (tmp_path / "agent" / "notes.txt").read_text() == "already here"
+    assert safe_name("../../etc/passwd") == "passwd"
+    assert safe_name("C:\\Users\\me\\a.txt") == "a.txt"
+    assert safe_name("..") == "file"
+
+def test_hub_refuses_requests_and_offers_it_did_not_ask_for(peers, tmp_path):
+    hub, agent = peers
+    secret = tmp_path / "server.key"
+    secret.write_text("private")
+
+    # The agent asks for one of the hub's files
+    transfer_id = agent.channel.pull(str(secret))
+    refused = agent.wait(transfer_id)
+    assert refused.state == TransferState.FAILED and "does not send" in refused.error
+    assert transfer_id not in hub.channel.transfers
+
+    # The agent pushes a file the hub never asked for
+    write_file(tmp_path / "junk.bin", 100000)
+    transfer_id = agent.channel.push(str(tmp_path / "junk.bin"))
+    refused = agent.wait(transfer_id)
+    assert refused.state == TransferState.FAILED and "asked for" in refused.error
+    assert not (tmp_path / "hub").exists()
+
+def test_sender_stops_at_the_window_until_acknowledged(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_transfer, "WINDOW", 256 * 1024)
+    hub_sock, agent_sock = socket.socketpair()
+    hub = Peer(hub_sock, tmp_path / "hub", role=HUB)
+    write_file(tmp_path / "big.bin", 1024 * 1024)
+    # The agent accepts but never acknowledges, however much it reads
+    reader = MessageReader()
+    transfer_id = hub.channel.push(str(tmp_path / "big.bin"))
+    agent_sock.sendall(create_message(MessageType.FILE_ACK, {"transfer": transfer_id, "offset": 0}))
+    received = 0
+    agent_sock.settimeout(0.5)
+    try:
+        while True:
+            for message in reader.feed(agent_sock.recv(65536)):
+                received += len(message.get("data", b""))
+    except socket.timeout:
+        pass
+
+    assert received == 256 * 1024
+    agent_sock.sendall(create_message(MessageType.FILE_CANCEL, {"transfer": transfer_id, "reason": "test"}))
+    assert hub.wait(transfer_id).state == TransferState.FAILED
+    hub_sock.close()
+    agent_sock.close()
+
+def test_cancel_removes_the_partial_file_on_the_other_side(peers, tmp_path):
+    hub, agent = peers
+    write_file(tmp_path / "slow.bin", 1024 * 1024)
+    transfer_id = hub.channel.push(str(tmp_path / "slow.bin"), rate=200000)
+    time.sleep(0.3)
+
+    assert hub.channel.cancel(transfer_id)
+    received = agent.wait(transfer_id)
+
+    assert received.state == TransferState.FAILED and received.error == "Cancelled"
+    assert os.listdir(tmp_path / "agent") == []
+
+def test_chunk_racing_a_cancel_is_dropped(peers, tmp_path):
+    hub, agent = peers
+    write_file(tmp_path / "slow.bin", 1024 * 1024)
+    transfer_id = hub.channel.push(str(tmp_path / "slow.bin"), rate=200000)
+    time.sleep(0.2)
+    transfer = agent.channel.transfers[transfer_id]
+    agent.channel.cancel(transfer_id)
+
+    # A chunk the reader had already matched to the transfer when the cancel closed its file
+    agent.channel._find = lambda transfer_id, direction: transfer
+    agent.channel._on_data({"transfer": transfer_id, "offset": transfer.done}, b"late")
+
+    assert transfer.state == TransferState.FAILED and transfer.error == "Cancelled"
+
+def test_throttle_paces_chunks_to_the_rate():
+    now = [0.0]
+    def sleep(seconds):
+        now[0] += seconds
+    throttle = Throttle(100000, clock=lambda: now[0], sleep=sleep)
+    for _ in range(10):
+        throttle.wait(throttle.chunk_limit())
+    # Ten 10 kB chunks at 100 kB/s: the last one goes after 0.9 s
+    assert now[0] == pytest.approx(0.9)
+    assert Throttle(0).chunk_limit() == file_transfer.MAX_CHUNK
+
+def test_backlog_gate_follows_the_measured_link_rate(monkeypatch):
+    now = [0.0]
+    queued = {"control": 0, "video": 0}
+    monkeypatch.setattr(file_transfer, "queued_bytes", lambda sock: queued[sock])
+    gate = BacklogGate("control", yield_to=lambda: ["video"], clock=lambda: now[0], sleep=lambda s: None)
+
+    assert gate._clear(16384)
+    # The link carries 50 MB/s while a backlog remains
+    for _ in range(20):
+        gate.sent(500000)
+        now[0] += 0.01
+        queued["control"] = 500000
+        gate._clear(1)
+    assert gate.rate == pytest.approx(50e6, rel=0.1)
+    # 4 ms at that rate
+    assert gate.limit == pytest.approx(200000, rel=0.1)
+    assert not gate._clear(gate.limit)
+    queued["control"] = 0
+    assert gate._clear(gate.limit)
+    # Video with anything queued goes first
+    queued["video"] = 1
+    assert not gate._clear(1)
+
+def test_unique_path_numbers_taken_names(tmp_path):
+    (tmp_path / "a.txt").write_text("")
+    (tmp_path / "a (1).txt").write_text("")
+    assert unique_path(str(tmp_path), "a.txt") == str(tmp_path / "a (2).txt")
+    assert unique_path(str(tmp_path), "b") == str(tmp_path / "b")
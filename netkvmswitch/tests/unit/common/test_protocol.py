@@ -1,5 +1,5 @@
 import pytest
-from common.protocol import create_message, parse_message, MessageType
+from common.protocol import create_message, create_data_message, parse_message, MessageType, MessageReader
 
 def test_create_and_parse_message():
     # Test KEY_EVENT
@@ -48,4 +48,35 @@ def test_create_and_parse_message():
     complex_message = create_message("TEST_COMPLEX", complex_payload)
     parsed_complex_message = parse_message(complex_message)
     assert parsed_complex_message["type"] == "TEST_COMPLEX"
-    assert parsed_complex_message["payload"] == complex_payload
\ No newline at end of file
+    assert parsed_complex_message["payload"] == complex_payload
+
+def test_message_reader_splits_coalesced_messages():
+    reader = MessageReader()
+    data = create_message(MessageType.MOUSE_EVENT, {"event_type": "move", "x": 1, "y": 2}) + \
+           create_message(MessageType.REQUEST_KEYFRAME, {})
+    messages = reader.feed(data)
+    assert [m["type"] for m in messages] == [MessageType.MOUSE_EVENT, MessageType.REQUEST_KEYFRAME]
+    assert messages[0]["payload"] == {"event_type": "move", "x": 1, "y": 2}
+
+def test_message_reader_buffers_partial_messages():
+    reader = MessageReader()
+    data = create_message(MessageType.KEY_EVENT, {"event_type": "press", "key": "a"})
+    assert reader.feed(data[:5]) == []
+    messages = reader.feed(data[5:])
+    assert len(messages) == 1
+    assert messages[0]["payload"]["key"] == "a"
+
+def test_message_reader_returns_attached_data_between_messages():
+    reader = MessageReader()
+    # The attachment may hold newlines and zero bytes
+    data = b"line\n\x00" * 3
+    stream = create_message(MessageType.KEY_EVENT, {"event_type": "press", "key": "a"}) + \
+             create_data_message(MessageType.FILE_DATA, {"transfer": "t", "offset": 0}, len(data)) + data + \
+             create_message(MessageType.KEY_EVENT, {"event_type": "release", "key": "a"})
+    messages = []
+    for i in range(0, len(stream), 7):
+        messages += reader.feed(stream[i:i + 7])
+    assert [m["type"] for m in messages] == [MessageType.KEY_EVENT, MessageType.FILE_DATA, MessageType.KEY_EVENT]
+    assert messages[1]["payload"] == {"transfer": "t", "offset": 0}
+    assert messages[1]["data"] == data
+    assert "data" not in messages[0]
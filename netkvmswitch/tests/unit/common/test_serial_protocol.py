@@ -0,0 +1,155 @@
+import base64
+import io
+import json
+import os
+import random
+import threading
+import time
+
+import pytest
+
+from common.serial_protocol import (DELIMITER, FrameFlags, FrameReader, FrameType, cobs_decode, cobs_encode,
+                                    encode_frame, send_frame, send_framed)
+
+class TricklingSerial(io.BytesIO):
+    """Returns at most a few bytes per read, like a slow serial line."""
+    def read(self, size=-1):
+        return super().read(min(size, 7))
+
+def written(*frames):
+    conn = io.BytesIO()
+    for frame_type, payload in frames:
+        send_frame(conn, frame_type, payload)
+    return conn.getvalue()
+
+@pytest.mark.parametrize("data", [b'', b'\x00', b'\x00\x00', b'a\x00b', bytes(range(256)) * 3,
+                                  b'x' * 254, b'x' * 254 + b'\x00', b'x' * 255, b'\x00' + b'x' * 600])
+def test_cobs_round_trip(data):
+    encoded = cobs_encode(data)
+    assert DELIMITER not in encoded
+    assert cobs_decode(encoded) == data
+
+def test_video_frames_carry_raw_bytes():
+    jpeg = bytes(range(1, 256)) * 40  # No zero bytes: COBS adds 1 byte per 254
+    conn = io.BytesIO()
+    assert send_frame(conn, FrameType.VIDEO, memoryview(jpeg), FrameFlags.KEYFRAME)
+    wire = conn.getvalue()
+    assert len(wire) < len(jpeg) * 1.005 + 16
+    # The old format: base64 inside JSON behind a 4-byte length
+    old = len(json.dumps({"type": "video_frame", "payload": {"frame": base64.b64encode(jpeg).decode()}})) + 4
+    assert old / len(wire) > 1.32
+
+    conn.seek(0)
+    assert FrameReader(conn).receive_frame() == (FrameType.VIDEO, FrameFlags.KEYFRAME, jpeg)
+
+def test_control_messages_stay_json():
+    conn = io.BytesIO()
+    send_framed(conn, {"type": "key_event", "payload": {"event_type": "press", "key": "a"}})
+    conn.seek(0)
+    frame_type, flags, payload = FrameReader(conn).receive_frame()
+    assert (frame_type, flags) == (FrameType.CONTROL, 0)
+    assert json.loads(payload) == {"type": "key_event", "payload": {"event_type": "press", "key": "a"}}
+
+def test_receive_framed_skips_video_frames():
+    conn = io.BytesIO()
+    send_frame(conn, FrameType.VIDEO, b'\xff\xd8jpeg')
+    send_framed(conn, {"type": "handshake", "payload": {"magic": "NETKVM_CLIENT_HELLO"}})
+    conn.seek(0)
+    assert FrameReader(conn).receive_framed()["payload"]["magic"] == "NETKVM_CLIENT_HELLO"
+
+def test_frames_arriving_in_pieces_are_reassembled():
+    conn = TricklingSerial()
+    send_frame(conn, FrameType.VIDEO, b'x\x00' * 500)
+    send_framed(conn, {"type": "handshake"})
+    conn.seek(0)
+    reader = FrameReader(conn)
+    assert reader.receive_frame() == (FrameType.VIDEO, 0, b'x\x00' * 500)
+    assert reader.receive_framed() == {"type": "handshake"}
+
+class SplittingSerial(io.BytesIO):
+    """Writes in small pieces with a pause between them, like pyserial's partial OS writes."""
+    def write(self, data):
+        data = bytes(data)
+        for start in range(0, len(data), 64):
+            super().write(data[start:start + 64])
+            time.sleep(0)
+        return len(data)
+
+def test_frames_from_several_threads_do_not_interleave():
+    conn = SplittingSerial()
+    payloads = {name: [bytes([name]) * 1000 + bytes([i]) for i in range(20)] for name in (1, 2, 3)}
+    threads = [threading.Thread(target=lambda sent=sent: [send_frame(conn, FrameType.VIDEO, p) for p in sent])
+               for sent in payloads.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    conn.seek(0)
+    reader = FrameReader(conn)
+    received = [reader.receive_frame() for _ in range(60)]
+    assert reader.dropped == 0
+    assert sorted(payload for _, _, payload in received) == sorted(p for sent in payloads.values() for p in sent)
+
+def test_truncated_frame_is_an_error():
+    wire = written((FrameType.VIDEO, b'x' * 100))
+    assert FrameReader(io.BytesIO(wire[:50])).receive_frame() is None
+    assert FrameReader(io.BytesIO()).receive_frame() is None
+
+def test_corrupt_frame_is_dropped_and_the_next_one_read():
+    wire = bytearray(written((FrameType.VIDEO, b'first frame'), (FrameType.VIDEO, b'second frame')))
+    wire[5] ^= 0x10
+    reader = FrameReader(io.BytesIO(bytes(wire)))
+    assert reader.receive_frame() == (FrameType.VIDEO, 0, b'second frame')
+    assert reader.dropped == 1
+
+def test_noise_without_delimiters_is_bounded():
+    noise = bytes(random.Random(1).randrange(1, 256) for _ in range(5000))
+    reader = FrameReader(io.BytesIO(noise + written((FrameType.VIDEO, b'after the noise'))), max_frame_size=1000)
+    assert reader.receive_frame() == (FrameType.VIDEO, 0, b'after the noise')
+    assert len(reader.buffer) < 5000
+    assert reader.dropped == 1
+
+def test_bit_errors_on_a_pty_lose_only_the_damaged_frames():
+    serial = pytest.importorskip("serial")
+    master, slave = os.openpty()
+    port = serial.Serial(os.ttyname(slave), baudrate=115200, timeout=1)
+    rng = random.Random(42)
+    frames, damaged, wire = [], set(), bytearray()
+    for seq in range(300):
+        payload = seq.to_bytes(2, 'big') + bytes(rng.randrange(256) for _ in range(rng.randrange(0, 2000)))
+        frames.append(payload)
+        encoded = bytearray(encode_frame(FrameType.VIDEO, payload))
+        if rng.random() < 0.2:
+            for _ in range(rng.randrange(1, 4)):
+                encoded[rng.randrange(len(encoded))] ^= 1 << rng.randrange(8)
+            damaged.add(seq)
+        wire += encoded
+    wire += encode_frame(FrameType.CONTROL, b'{"type": "end"}')
+
+    def write():
+        for i in range(0, len(wire), 4096):
+            os.write(master, wire[i:i + 4096])
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    try:
+        reader = FrameReader(port)
+        received = []
+        while True:
+            frame = reader.receive_frame()
+            assert frame is not None, "stalled before the end marker"
+            if frame[0] == FrameType.CONTROL:
+                break
+            received.append(frame[2])
+        writer.join(timeout=5)
+    finally:
+        port.close()
+        os.close(master)
+        os.close(slave)
+
+    # Nothing corrupt gets through, and each error costs only its own frame
+    assert all(frames[int.from_bytes(payload[:2], 'big')] == payload for payload in received)
+    received_seqs = {int.from_bytes(payload[:2], 'big') for payload in received}
+    assert received_seqs == set(range(300)) - damaged
+    # A flip to a zero byte splits a frame, so it can count twice
+    assert reader.dropped >= len(damaged)
@@ -0,0 +1,11 @@
+from common.utils import backoff_delay
+
+def test_backoff_doubles_up_to_the_cap():
+    delays = [backoff_delay(attempt, 0.05, 1.0, rand=lambda: 1.0) for attempt in range(8)]
+    assert delays == [0.05, 0.1, 0.2, 0.4, 0.8, 1.0, 1.0, 1.0]
+    # Very long outages stay at the cap
+    assert backoff_delay(10_000, 0.05, 1.0, rand=lambda: 1.0) == 1.0
+
+def test_backoff_jitter_keeps_at_least_half_the_delay():
+    assert backoff_delay(3, 0.05, 1.0, rand=lambda: 0.0) == 0.2
+    assert 0.2 <= backoff_delay(3, 0.05, 1.0) <= 0.4
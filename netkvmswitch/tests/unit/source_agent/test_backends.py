@@ -0,0 +1,66 @@
+import json
+import pytest
+import numpy as np
+from unittest.mock import patch
+
+from source_agent import backends
+from source_agent.backends import PipelineBackend, resolve_backend, select_backend
+
+
+class FakeCapture:
+    name = "fake"
+
+    @staticmethod
+    def available():
+        return True
+
+    @staticmethod
+    def create(monitor_index):
+        class Capturer:
+            def capture_frame(self):
+                return np.zeros((64, 96, 3), dtype=np.uint8)
+        return Capturer()
+
+
+class BrokenCapture(FakeCapture):
+    name = "broken"
+
+    @staticmethod
+    def available():
+        raise OSError("no display")
+
+
+@pytest.fixture
+def registry():
+    with patch.dict(backends.CAPTURERS, {"broken": BrokenCapture, "fake": FakeCapture}, clear=True), \
+         patch.dict(backends._availability, clear=True):
+        yield
+
+def test_parse_requires_three_stages():
+    assert str(PipelineBackend.parse("mss/i420/libx264")) == "mss/i420/libx264"
+    with pytest.raises(ValueError):
+        PipelineBackend.parse("mss")
+
+def test_unavailable_stages_fall_back_in_preference_order(registry):
+    backend = resolve_backend("broken/rgb/native")
+    # The native encoder is not built here; libx264 takes RGB as well
+    assert str(backend) == "fake/rgb/libx264"
+
+def test_aliases_resolve(registry):
+    assert resolve_backend("python").encode == "libx264"
+
+def test_benchmark_runs_once_and_is_cached(registry, tmp_path):
+    cache = tmp_path / "backend.json"
+    with patch.object(backends, 'benchmark_backends', wraps=backends.benchmark_backends) as benchmark:
+        first = select_backend("auto", cache_file=str(cache))
+        second = select_backend("auto", cache_file=str(cache))
+    assert benchmark.call_count == 1
+    assert first == second
+    cached = json.loads(cache.read_text())
+    assert cached["backend"] == str(first)
+    assert any(key.startswith("encode:") for key in cached["results"])
+
+def test_explicit_backend_skips_benchmark(registry, tmp_path):
+    with patch.object(backends, 'benchmark_backends') as benchmark:
+        assert str(select_backend("fake/rgb/libx264", cache_file=str(tmp_path / "c.json"))) == "fake/rgb/libx264"
+    benchmark.assert_not_called()
@@ -0,0 +1,53 @@
+import base64
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import cv2
+import numpy as np
+
+from source_agent.cursor import X11Cursor, encode_cursor_shape, map_to_stream
+
+
+class TestCursorShape(unittest.TestCase):
+
+    def test_shape_hash_is_stable_and_png_round_trips(self):
+        rgba = np.zeros((16, 16, 4), dtype=np.uint8)
+        rgba[4:8, 4:8] = [255, 0, 0, 255]
+        first = encode_cursor_shape(rgba, 4, 4)
+        self.assertEqual(first["hash"], encode_cursor_shape(rgba.copy(), 4, 4)["hash"])
+        self.assertNotEqual(first["hash"], encode_cursor_shape(rgba, 0, 0)["hash"])
+
+        png = np.frombuffer(base64.b64decode(first["png"]), dtype=np.uint8)
+        decoded = cv2.cvtColor(cv2.imdecode(png, cv2.IMREAD_UNCHANGED), cv2.COLOR_BGRA2RGBA)
+        np.testing.assert_array_equal(decoded, rgba)
+
+    def test_x11_premultiplied_argb_is_converted(self):
+        cursor = X11Cursor.__new__(X11Cursor)
+        # Half-transparent red (premultiplied) and a fully transparent pixel
+        cursor.image = SimpleNamespace(width=2, height=1, xhot=1, yhot=0,
+                                       cursor_image=[0x80800000, 0x00000000])
+        rgba, hot_x, hot_y = cursor.shape()
+        np.testing.assert_array_equal(rgba, [[[255, 0, 0, 128], [0, 0, 0, 0]]])
+        self.assertEqual((hot_x, hot_y), (1, 0))
+
+
+class TestMapToStream(unittest.TestCase):
+
+    def setUp(self):
+        self.streams = [
+            {"id": 0, "left": 0, "top": 0, "width": 3840, "height": 1080},
+            {"id": 1, "left": 0, "top": 0, "width": 1920, "height": 1080},
+            {"id": 2, "left": 1920, "top": 0, "width": 1920, "height": 1080},
+        ]
+
+    def test_physical_monitor_wins_over_combined_screen(self):
+        self.assertEqual(map_to_stream(self.streams, 2880, 540), (2, 0.5, 0.5))
+        self.assertEqual(map_to_stream(self.streams, 0, 0), (1, 0.0, 0.0))
+
+    def test_pointer_outside_captured_monitors(self):
+        self.assertEqual(map_to_stream(self.streams[1:2], 2000, 10), (None, None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import json
+import pytest
+from unittest.mock import patch
+
+from common import config as config_module
+from source_agent import encoder_tuning
+from source_agent.encoder_tuning import x264_options, tune_encoder, autotune
+
+def fake_measure(settings, frames, width, height, fps):
+    # ultrafast is cheapest but doubles the bitrate; superfast just fits
+    cost = {"ultrafast": 4.0, "superfast": 8.0, "veryfast": 12.0}[settings["preset"]]
+    size = {"ultrafast": 20000, "superfast": 11000, "veryfast": 10000}[settings["preset"]]
+    delay = 0 if settings["sliced_threads"] else 2
+    return {"settings": dict(settings), "ms_per_frame": cost, "cpu_percent": 100.0,
+            "cpu_ms_per_frame": cost, "latency_ms": cost + delay * 1000 / fps, "bytes_per_frame": size}
+
+def test_options_follow_settings():
+    options = x264_options(threads=2, sliced_threads=False, preset="superfast", profile="main")
+    assert options["threads"] == "2"
+    assert options["x264-params"] == "sliced-threads=0"
+    assert options["profile"] == "main"
+    assert "threads" not in x264_options()
+
+def test_tuner_picks_cheapest_candidate_within_latency_and_bitrate():
+    with patch.object(encoder_tuning, 'measure', side_effect=fake_measure), \
+         patch.object(encoder_tuning, 'motion_frames', return_value=[None]):
+        settings, results = tune_encoder(1920, 1080, 60, report=None)
+    assert settings["preset"] == "superfast"
+    assert settings["sliced_threads"] is True  # Frame threading adds two frames of latency
+    assert all(result["cpu_percent"] == 100.0 for result in results)
+
+def test_autotune_persists_per_user_and_runs_once_per_resolution(tmp_path):
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"client": {"client_name": "agent", "encoder_preset": "veryfast"}}))
+    settings_file = tmp_path / "client_settings.json"
+    client = config_module.ClientConfig()
+    with patch.object(config_module.config, 'client', client), \
+         patch.object(config_module, '_settings_path', str(settings_file)), \
+         patch.object(encoder_tuning, 'tune_encoder', return_value=({"threads": 2, "sliced_threads": True,
+                                                                      "preset": "superfast", "profile": ""}, [])) as tune:
+        autotune(1920, 1080, 60)
+        autotune(1920, 1080, 60)
+        assert tune.call_count == 1
+        assert client.encoder_preset == "superfast"
+        # config.json is left alone; the tuned settings go to the user's file and win when loading
+        assert json.loads(config_file.read_text())["client"]["encoder_preset"] == "veryfast"
+        assert json.loads(settings_file.read_text())["encoder_threads"] == 2
+        loaded = config_module.AppConfig.load(str(config_file), str(settings_file)).client
+        assert loaded.client_name == "agent" and loaded.encoder_preset == "superfast"
+        autotune(1280, 720, 60)
+        assert tune.call_count == 2
@@ -0,0 +1,108 @@
+import enum
+
+import pytest
+
+from common.protocol import MessageType
+from source_agent.input_injector import CoordinateMapper, InputInjector, PynputBackend, coalesce
+
+class Key(enum.Enum):
+    shift = 1
+    enter = 2
+
+class Button(enum.Enum):
+    left = 1
+    right = 2
+
+class FakeController:
+    def __init__(self):
+        self.calls = []
+
+    @property
+    def position(self):
+        return None
+
+    @position.setter
+    def position(self, value):
+        self.calls.append(("position", value))
+
+    def press(self, key):
+        self.calls.append(("press", key))
+
+    def release(self, key):
+        self.calls.append(("release", key))
+
+    def scroll(self, dx, dy):
+        self.calls.append(("scroll", dx, dy))
+
+@pytest.fixture
+def injector():
+    return InputInjector(PynputBackend(FakeController(), FakeController(), Key, Button))
+
+def move(x, y):
+    return (0.0, MessageType.MOUSE_EVENT, {"event_type": "move", "x": x, "y": y})
+
+def test_coalesce_keeps_last_move_of_each_run():
+    click = (0.0, MessageType.MOUSE_EVENT, {"event_type": "click", "x": 3, "y": 3, "button": "Button.left",
+                                            "pressed": True})
+    events, dropped = coalesce([move(1, 1), move(2, 2), click, move(4, 4), move(5, 5)])
+    assert [event[2].get("x") for event in events] == [2, 3, 5]
+    assert dropped == 2
+
+def test_burst_of_moves_is_injected_once(injector):
+    for i in range(50):
+        injector.submit(MessageType.MOUSE_EVENT, {"event_type": "move", "x": i, "y": i})
+    injector.process(injector.drain(timeout=0))
+    assert injector.backend.mouse_controller.calls == [("position", (49, 49))]
+    assert injector.stats()["injected"] == 1
+    assert injector.stats()["coalesced"] == 49
+    assert injector.stats()["p50_ms"] >= 0
+
+def test_keys_use_lookup_table(injector):
+    injector.submit(MessageType.KEY_EVENT, {"event_type": "press", "key": "Key.shift"})
+    injector.submit(MessageType.KEY_EVENT, {"event_type": "press", "key": "a"})
+    injector.submit(MessageType.KEY_EVENT, {"event_type": "release", "key": "Key.nonexistent"})
+    injector.submit(MessageType.KEY_EVENT, {"event_type": "press", "key": None})
+    injector.process(injector.drain(timeout=0))
+    assert injector.backend.keyboard_controller.calls == [("press", Key.shift), ("press", "a")]
+
+def test_click_moves_then_presses(injector):
+    injector.submit(MessageType.MOUSE_EVENT, {"event_type": "click", "x": 7, "y": 8, "button": "Button.right",
+                                              "pressed": False})
+    injector.process(injector.drain(timeout=0))
+    assert injector.backend.mouse_controller.calls == [("position", (7, 8)), ("release", Button.right)]
+
+def test_thread_injects_and_stops(injector):
+    injector.start()
+    injector.submit(MessageType.MOUSE_EVENT, {"event_type": "scroll", "x": 0, "y": 0, "dx": 0, "dy": -1})
+    injector.stop()
+    assert injector.backend.mouse_controller.calls == [("scroll", 0, -1)]
+
+STREAMS = [{"id": 1, "left": 0, "top": 0, "width": 1920, "height": 1080},
+           {"id": 2, "left": -1280, "top": 200, "width": 1280, "height": 1024}]
+
+def test_mapper_applies_monitor_offsets():
+    mapper = CoordinateMapper()
+    mapper.update(STREAMS, (-1280, 0, 3200, 1224))
+    assert mapper.map({"event_type": "move", "x": 1.0, "y": 1.0, "stream": 1}) == {"event_type": "move", "x": 1919,
+                                                                                   "y": 1079}
+    assert mapper.map({"event_type": "move", "x": 0.5, "y": 0.0, "stream": 2}) == {"event_type": "move", "x": -640,
+                                                                                   "y": 200}
+    # Stream 0 is the whole desktop, which hub-captured positions are normalized over
+    assert mapper.map({"event_type": "move", "x": 0.0, "y": 0.5, "stream": 0})["x"] == -1280
+    # Out-of-picture positions are clamped; pixel positions pass through
+    assert mapper.map({"event_type": "move", "x": 1.5, "y": -1, "stream": 1})["x"] == 1919
+    assert mapper.map({"event_type": "move", "x": 300, "y": 400}) == {"event_type": "move", "x": 300, "y": 400}
+    with pytest.raises(ValueError):
+        mapper.map({"event_type": "move", "x": 0.5, "y": 0.5, "stream": 9})
+
+def test_injector_maps_after_geometry_change(injector):
+    injector.set_geometry(STREAMS, (-1280, 0, 3200, 1224))
+    injector.submit(MessageType.MOUSE_EVENT, {"event_type": "move", "x": 0.5, "y": 0.5, "stream": 1})
+    injector.process(injector.drain(timeout=0))
+    # Resolution change on stream 1
+    injector.set_geometry([dict(STREAMS[0], width=1280, height=720), STREAMS[1]], (-1280, 0, 2560, 1224))
+    injector.submit(MessageType.MOUSE_EVENT, {"event_type": "click", "x": 0.5, "y": 0.5, "stream": 1,
+                                              "button": "Button.left", "pressed": True})
+    injector.process(injector.drain(timeout=0))
+    assert injector.backend.mouse_controller.calls == [("position", (960, 540)), ("position", (640, 360)),
+                                                       ("press", Button.left)]
@@ -7,7 +7,7 @@ import os
 # Add src to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../../src'))
 
-from source_agent.screen_capture import ScreenCapturer
+from source_agent.screen_capture import ScreenCapturer, DamageCapturer, CaptureScheduler, select_monitors
 
 
 class TestScreenCapturer(unittest.TestCase):
@@ -113,6 +113,145 @@ class TestScreenCapturer(unittest.TestCase):
         
         self.assertTrue(np.array_equal(result, expected))
 
+    @patch('source_agent.screen_capture.mss.mss')
+    def test_init_with_explicit_monitor(self, mock_mss):
+        """Test that a monitor index selects that monitor's area."""
+        mock_sct = Mock()
+        mock_mss.return_value = mock_sct
+        mock_sct.monitors = [
+            {'top': 0, 'left': 0, 'width': 3840, 'height': 1080},
+            {'top': 0, 'left': 0, 'width': 1920, 'height': 1080, 'id': 1},
+            {'top': 0, 'left': 1920, 'width': 1920, 'height': 1080, 'id': 2},
+        ]
+
+        capturer = ScreenCapturer(monitor_index=2)
+        self.assertEqual(capturer.capture_area["left"], 1920)
+        self.assertEqual(capturer.capture_area["mon"], 2)
+
+    @patch('source_agent.screen_capture.mss.mss')
+    def test_refresh_geometry_detects_resolution_change(self, mock_mss):
+        """Test that a resolution change is picked up by a fresh mss instance."""
+        resized_sct = Mock()
+        resized_sct.monitors = [
+            {'top': 0, 'left': 0, 'width': 1280, 'height': 720},
+            {'top': 0, 'left': 0, 'width': 1280, 'height': 720, 'id': 1}
+        ]
+        mock_mss.return_value = resized_sct
+
+        self.assertTrue(self.capturer.refresh_geometry())
+        self.mock_sct.close.assert_called_once()
+        self.assertEqual(self.capturer.geometry(), (0, 0, 1280, 720))
+        self.assertFalse(self.capturer.refresh_geometry())
+
+
+class FakeDamageNotify:
+    def __init__(self, x, y, width, height):
+        self.area = Mock(x=x, y=y, width=width, height=height)
+
+
+class TestDamageCapturer(unittest.TestCase):
+
+    def setUp(self):
+        # Second monitor of a two-monitor desktop, without a real X server
+        self.capturer = DamageCapturer.__new__(DamageCapturer)
+        self.capturer.capture_area = {"left": 1920, "top": 0, "width": 1920, "height": 1080}
+        self.capturer.notify_event = FakeDamageNotify
+        self.capturer.damage = 1
+        self.capturer.damaged = []
+        self.capturer.frame = np.zeros((1080, 1920, 3), dtype=np.uint8)
+        self.capturer.display = Mock()
+        self.capturer.sct = Mock()
+
+    def queue_events(self, *events):
+        events = list(events)
+        self.capturer.display.pending_events.side_effect = lambda: len(events)
+        self.capturer.display.next_event.side_effect = lambda: events.pop(0)
+
+    def test_no_damage_means_nothing_to_grab(self):
+        self.queue_events()
+        self.assertFalse(self.capturer.poll_damage())
+        self.capturer.display.damage_subtract.assert_not_called()
+
+    def test_damage_is_clipped_to_the_monitor(self):
+        # One rectangle straddles both monitors, one is entirely on the first
+        self.queue_events(FakeDamageNotify(1900, 10, 40, 20), FakeDamageNotify(0, 0, 100, 100))
+        self.assertTrue(self.capturer.poll_damage())
+        self.assertEqual(self.capturer.damaged, [(0, 10, 20, 20)])
+        self.capturer.display.damage_subtract.assert_called_once_with(1)
+
+    def test_paused_stream_drains_damage_and_regrabs_on_resume(self):
+        self.queue_events(FakeDamageNotify(1900, 10, 40, 20), FakeDamageNotify(2000, 0, 10, 10))
+        self.capturer.discard_damage()
+        self.capturer.display.damage_subtract.assert_called_once_with(1)
+        self.assertFalse(self.capturer.display.pending_events())
+        self.assertIsNone(self.capturer.frame)
+        self.assertEqual(self.capturer.damaged, [])
+
+    def test_only_damaged_rectangles_are_grabbed(self):
+        self.capturer.damaged = [(10, 20, 4, 2)]
+        bgra = np.full((2, 4, 4), [30, 20, 10, 255], dtype=np.uint8)
+        self.capturer.sct.grab.return_value = bgra
+        frame = self.capturer.capture_frame()
+
+        self.capturer.sct.grab.assert_called_once_with({"left": 1930, "top": 20, "width": 4, "height": 2})
+        np.testing.assert_array_equal(frame[20:22, 10:14], np.full((2, 4, 3), [10, 20, 30]))
+        self.assertEqual(int(frame.sum()), 2 * 4 * 60)
+        self.assertEqual(self.capturer.damaged, [])
+
+    def test_many_rectangles_are_grabbed_as_one(self):
+        self.capturer.damaged = [(i, i, 1, 1) for i in range(DamageCapturer.max_rects + 1)]
+        self.capturer.sct.grab.return_value = np.zeros((17, 17, 4), dtype=np.uint8)
+        self.capturer.capture_frame()
+        self.capturer.sct.grab.assert_called_once_with({"left": 1920, "top": 0, "width": 17, "height": 17})
+
+
+class TestMonitorSelection(unittest.TestCase):
+
+    def setUp(self):
+        self.monitors = [
+            {'top': 0, 'left': 0, 'width': 3840, 'height': 1080},
+            {'top': 0, 'left': 0, 'width': 1920, 'height': 1080},
+            {'top': 0, 'left': 1920, 'width': 1920, 'height': 1080},
+        ]
+
+    def test_default_selects_primary_monitor(self):
+        self.assertEqual(select_monitors(self.monitors), [1])
+
+    def test_all_and_combined(self):
+        self.assertEqual(select_monitors(self.monitors, "all"), [1, 2])
+        self.assertEqual(select_monitors(self.monitors, "all", include_combined=True), [1, 2, 0])
+
+    def test_invalid_indices_fall_back_to_primary(self):
+        self.assertEqual(select_monitors(self.monitors, "2,7"), [2])
+        self.assertEqual(select_monitors(self.monitors, "9"), [1])
+
+
+class TestCaptureScheduler(unittest.TestCase):
+
+    def test_changed_monitors_are_grabbed_first(self):
+        scheduler = CaptureScheduler([1, 2])
+        scheduler.record(2, changed=True)
+        self.assertEqual(scheduler.due_streams()[0], 2)
+
+    def test_idle_monitors_are_skipped_with_backoff(self):
+        scheduler = CaptureScheduler([1, 2], max_idle_skip=2)
+        scheduler.record(1, changed=False)  # Skip 1 tick
+        self.assertEqual(scheduler.due_streams(), [2])
+        self.assertIn(1, scheduler.due_streams())
+
+        scheduler.record(1, changed=False)  # Skip 2 ticks
+        scheduler.record(1, changed=False)  # Capped at max_idle_skip
+        self.assertNotIn(1, scheduler.due_streams())
+        self.assertNotIn(1, scheduler.due_streams())
+        self.assertIn(1, scheduler.due_streams())
+
+    def test_wake_grabs_idle_monitor_on_next_tick(self):
+        scheduler = CaptureScheduler([1], max_idle_skip=8)
+        for _ in range(5):
+            scheduler.record(1, changed=False)
+        scheduler.wake(1)
+        self.assertEqual(scheduler.due_streams(), [1])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,51 @@
+import pytest
+
+from source_agent.stream_control import StreamControl
+from common.protocol import StreamProfile, VideoLayer
+
+def test_thumbnail_status_lowers_fps_and_scale():
+    control = StreamControl()
+    control.apply_status({"profile": StreamProfile.THUMBNAIL, "fps": 5, "scale": 0.25})
+    assert control.fps.value == 5
+    assert control.frame_interval() == pytest.approx(0.2)
+    assert control.output_size(1920, 1080) == (480, 270 & ~1)
+
+def test_paused_status_stops_capture():
+    control = StreamControl()
+    control.apply_status({"profile": StreamProfile.PAUSED, "fps": 0})
+    assert control.paused is True
+    assert control.frame_interval() is None
+
+    control.apply_status({"profile": StreamProfile.FULL, "fps": 60, "scale": 1.0})
+    assert control.paused is False
+    assert control.output_size(1920, 1080) == (1920, 1080)
+
+def test_keyframe_request_is_consumed_once():
+    control = StreamControl()
+    assert control.take_keyframe_request() is False
+    control.request_keyframe()
+    assert control.take_keyframe_request() is True
+    assert control.take_keyframe_request() is False
+
+def test_simulcast_status_enables_thumbnail_layer():
+    control = StreamControl()
+    control.apply_status({"profile": StreamProfile.PAUSED, "fps": 0,
+                          "thumbnail": {"fps": 5, "scale": 0.25}})
+    assert control.layers() == [(VideoLayer.THUMBNAIL, 5, 0.25)]
+    assert control.paused is False
+    assert control.frame_interval() == pytest.approx(0.2)
+
+    control.apply_status({"profile": StreamProfile.FULL, "fps": 60, "scale": 1.0,
+                          "thumbnail": {"fps": 5, "scale": 0.25}})
+    assert [layer for layer, _, _ in control.layers()] == [VideoLayer.MAIN, VideoLayer.THUMBNAIL]
+    assert control.frame_interval() == pytest.approx(1 / 60)
+
+    control.apply_status({"profile": StreamProfile.FULL, "fps": 60, "scale": 1.0})
+    assert control.layers() == [(VideoLayer.MAIN, 60, 1.0)]
+
+def test_keyframe_request_covers_every_layer():
+    control = StreamControl()
+    control.request_keyframe()
+    assert control.take_keyframe_request(VideoLayer.THUMBNAIL) is True
+    assert control.take_keyframe_request(VideoLayer.THUMBNAIL) is False
+    assert control.take_keyframe_request(VideoLayer.MAIN) is True
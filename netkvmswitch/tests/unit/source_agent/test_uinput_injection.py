@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+pytest.importorskip("evdev")
+from evdev import ecodes
+
+import source_agent.uinput_injection as uinput_injection
+from common.protocol import MessageType
+from source_agent.input_injector import InputInjector
+
+class PipeUInput:
+    """Stands in for a uinput device: events written to fd can be read back."""
+    def __init__(self, events, name):
+        self.capabilities = events
+        self.name = name
+        self.reader, self.fd = os.pipe()
+        self.writes = 0
+
+    def read_events(self):
+        os.close(self.fd)
+        data = b""
+        while chunk := os.read(self.reader, 65536):
+            data += chunk
+        size = uinput_injection.INPUT_EVENT.size
+        return [uinput_injection.INPUT_EVENT.unpack_from(data, i)[2:] for i in range(0, len(data), size)]
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def backend(monkeypatch):
+    monkeypatch.setattr(uinput_injection, "UInput", PipeUInput)
+    return uinput_injection.UInputBackend(geometry=(-1920, 0, 3841, 1081))
+
+SYN = (ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
+
+def test_moves_map_onto_absolute_axes(backend):
+    backend.inject_mouse({"event_type": "move", "x": -1920, "y": 0})
+    backend.inject_mouse({"event_type": "move", "x": 1920, "y": 1080})
+    backend.inject_mouse({"event_type": "move", "x": 0, "y": 540})
+    backend.flush()
+    assert backend.pointer.read_events() == [
+        (ecodes.EV_ABS, ecodes.ABS_X, 0), (ecodes.EV_ABS, ecodes.ABS_Y, 0), SYN,
+        (ecodes.EV_ABS, ecodes.ABS_X, 65535), (ecodes.EV_ABS, ecodes.ABS_Y, 65535), SYN,
+        (ecodes.EV_ABS, ecodes.ABS_X, 32768), (ecodes.EV_ABS, ecodes.ABS_Y, 32768), SYN,
+    ]
+
+def test_click_and_scroll_frames(backend):
+    backend.set_geometry(0, 0, 2, 2)
+    backend.inject_mouse({"event_type": "click", "x": 1, "y": 1, "button": "Button.right", "pressed": True})
+    backend.inject_mouse({"event_type": "scroll", "x": 1, "y": 1, "dx": 0, "dy": -2})
+    backend.flush()
+    assert backend.pointer.read_events() == [
+        (ecodes.EV_ABS, ecodes.ABS_X, 65535), (ecodes.EV_ABS, ecodes.ABS_Y, 65535),
+        (ecodes.EV_KEY, ecodes.BTN_RIGHT, 1), SYN,
+        (ecodes.EV_REL, ecodes.REL_WHEEL, -2), (ecodes.EV_REL, ecodes.REL_HWHEEL, 0), SYN,
+    ]
+
+def test_keys_and_characters(backend):
+    for key, event_type in (("Key.shift", "press"), ("A", "press"), ("!", "release"), ("Key.f12", "press"),
+                            ("Key.unknown", "press"), (None, "press")):
+        backend.inject_key({"event_type": event_type, "key": key})
+    backend.flush()
+    assert backend.keyboard.read_events() == [
+        (ecodes.EV_KEY, ecodes.KEY_LEFTSHIFT, 1), SYN, (ecodes.EV_KEY, ecodes.KEY_A, 1), SYN,
+        (ecodes.EV_KEY, ecodes.KEY_1, 0), SYN, (ecodes.EV_KEY, ecodes.KEY_F12, 1), SYN,
+    ]
+
+def test_injector_flushes_a_pass_in_one_write(backend, monkeypatch):
+    writes = []
+    real_write = os.write
+    monkeypatch.setattr(uinput_injection.os, "write", lambda fd, data: writes.append(fd) or real_write(fd, data))
+    injector = InputInjector(backend)
+    injector.submit(MessageType.MOUSE_EVENT, {"event_type": "move", "x": 0, "y": 0})
+    injector.submit(MessageType.MOUSE_EVENT, {"event_type": "click", "x": 0, "y": 0, "button": "Button.left",
+                                              "pressed": True})
+    injector.submit(MessageType.MOUSE_EVENT, {"event_type": "click", "x": 0, "y": 0, "button": "Button.left",
+                                              "pressed": False})
+    injector.process(injector.drain(timeout=0))
+    assert writes == [backend.pointer.fd]
+    assert len(backend.pointer.read_events()) == 3 + 4 + 4
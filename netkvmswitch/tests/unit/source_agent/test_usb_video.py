@@ -0,0 +1,177 @@
+import io
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from common.serial_protocol import FrameFlags, FrameReader, FrameType, LinkMeter
+from source_agent.usb_video import SerialVideoStream, output_size
+
+
+class BaudLimitedPort:
+    """The agent's end of a pty, draining no faster than a real line at the given baud rate."""
+    def __init__(self, fd, baudrate):
+        self.fd = fd
+        self.baudrate = baudrate
+        self.busy_until = 0.0
+
+    def write(self, data):
+        now = time.perf_counter()
+        self.busy_until = max(now, self.busy_until) + len(data) * 10 / self.baudrate
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def flush(self):
+        time.sleep(max(0.0, self.busy_until - time.perf_counter()))
+
+
+class RecordingEncoder:
+    instances = []
+
+    def __init__(self, width, height, fps, bitrate=None):
+        self.size, self.bitrate, self.keyframes = (width, height), bitrate, []
+        RecordingEncoder.instances.append(self)
+
+    def encode(self, image, pixel_format, keyframe=False):
+        self.keyframes.append(keyframe)
+        return b'\x00\x00\x00\x01' + bytes([keyframe])
+
+
+class BrokenEncoder:
+    def __init__(self, *args, **kwargs):
+        raise RuntimeError("no H.264 here")
+
+
+class FixedMeter(LinkMeter):
+    """A link whose measured rate only changes when the test says so."""
+    def record(self, size, elapsed):
+        pass
+
+    def measure(self, size, elapsed):
+        self.samples.clear()
+        super().record(size, elapsed)
+
+
+class WriteOnlyPort(io.BytesIO):
+    def flush(self):
+        pass
+
+
+def desktop_frame(i, width=640, height=360):
+    frame = np.full((height, width, 3), 230, np.uint8)
+    for row in range(0, height, 14):
+        cv2.putText(frame, f"line {row} of some text", (8, row + 12), cv2.FONT_HERSHEY_PLAIN, 0.8, (30, 30, 30), 1)
+    cv2.rectangle(frame, (i * 12 % width, 100), (i * 12 % width + 60, 160), (200, 60, 60), -1)
+    return frame
+
+
+def frames_on(port):
+    reader = FrameReader(io.BytesIO(port.getvalue()))
+    frames = []
+    while (frame := reader.receive_frame()) is not None:
+        frames.append(frame)
+    return frames
+
+
+def test_output_size_keeps_aspect_and_even_dimensions():
+    assert output_size(1920, 1080, 320) == (320, 180)
+    assert output_size(1366, 768, 321) == (320, 178)
+    assert output_size(200, 100, 320) == (200, 100)  # Never upscaled
+
+
+def test_link_meter_starts_at_the_nominal_rate():
+    meter = LinkMeter(115200)
+    assert meter.bytes_per_second() == 11520
+    meter.record(50_000, 0.5)
+    meter.record(50_000, 0.5)
+    assert meter.bytes_per_second() == 100_000
+
+
+def test_bitrate_cap_follows_measured_throughput():
+    RecordingEncoder.instances = []
+    meter = FixedMeter(115200)
+    stream = SerialVideoStream(WriteOnlyPort(), width=160, link_share=0.5, link_meter=meter,
+                               encoder_factory=RecordingEncoder)
+    stream.send(desktop_frame(0))
+    assert RecordingEncoder.instances[-1].bitrate == 11520 * 8 // 2
+
+    # Small drifts keep the encoder (and spare the link an IDR)
+    meter.measure(12_000, 1.0)
+    stream.send(desktop_frame(1))
+    assert len(RecordingEncoder.instances) == 1
+
+    # A much faster link (e.g. USB CDC ignoring the baud rate) raises the cap
+    meter.measure(100_000, 1.0)
+    stream.send(desktop_frame(2))
+    assert len(RecordingEncoder.instances) == 2
+    assert RecordingEncoder.instances[-1].bitrate == 400_000
+    assert RecordingEncoder.instances[-1].keyframes == [True]
+
+
+def test_keyframes_are_flagged_and_sent_on_request():
+    RecordingEncoder.instances = []
+    port = WriteOnlyPort()
+    stream = SerialVideoStream(port, width=160, link_meter=FixedMeter(), encoder_factory=RecordingEncoder)
+    stream.send(desktop_frame(0))
+    stream.send(desktop_frame(1))
+    stream.request_keyframe()
+    stream.send(desktop_frame(2))
+    assert RecordingEncoder.instances[0].keyframes == [True, False, True]
+    assert [(frame_type, flags) for frame_type, flags, _ in frames_on(port)] == [
+        (FrameType.H264, FrameFlags.KEYFRAME), (FrameType.H264, 0), (FrameType.H264, FrameFlags.KEYFRAME)]
+
+
+def test_falls_back_to_jpeg_without_an_encoder():
+    port = WriteOnlyPort()
+    stream = SerialVideoStream(port, width=160, link_meter=FixedMeter(), encoder_factory=BrokenEncoder)
+    stream.send(desktop_frame(0))
+    frame_type, flags, payload = frames_on(port)[0]
+    assert (frame_type, flags) == (FrameType.VIDEO, FrameFlags.KEYFRAME)
+    assert cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR).shape == (90, 160, 3)
+
+
+def test_h264_over_a_baud_limited_pty():
+    av = pytest.importorskip("av")
+    serial = pytest.importorskip("serial")
+    master, slave = os.openpty()
+    hub_port = serial.Serial(os.ttyname(slave), baudrate=115200, timeout=2)
+    agent_port = BaudLimitedPort(master, 115200)
+    stream = SerialVideoStream(agent_port, width=160, fps=10)
+    count = 12
+
+    def agent():
+        stream.send_geometry(0, 0, 640, 360)
+        for i in range(count):
+            stream.send(desktop_frame(i))
+
+    started = time.perf_counter()
+    sender = threading.Thread(target=agent, daemon=True)
+    sender.start()
+    try:
+        reader = FrameReader(hub_port)
+        assert reader.receive_framed()["payload"]["width"] == 640
+        decoder = av.CodecContext.create('h264', 'r')
+        pictures = []
+        while len(pictures) < count:
+            frame = reader.receive_frame()
+            assert frame is not None, f"stalled after {len(pictures)} frames"
+            frame_type, flags, payload = frame
+            assert frame_type == FrameType.H264
+            assert bool(flags & FrameFlags.KEYFRAME) == (not pictures)
+            pictures += [picture.to_ndarray(format='bgr24') for picture in decoder.decode(av.Packet(payload))]
+        sender.join(timeout=5)
+        elapsed = time.perf_counter() - started
+    finally:
+        hub_port.close()
+        os.close(master)
+        os.close(slave)
+
+    assert pictures[0].shape == (90, 160, 3)
+    # The meter sees the simulated line rate, and the stream never outran it
+    assert stream.link_meter.bytes_per_second() == pytest.approx(11520, rel=0.1)
+    assert elapsed >= stream.bytes_sent / 11520 * 0.95
+    assert stream.bitrate_cap() == pytest.approx(11520 * 8 * 0.7, rel=0.1)
@@ -0,0 +1,43 @@
+import asyncio
+import socket
+import threading
+import time
+from unittest.mock import patch
+
+from common.protocol import MessageReader, create_message
+from web_ui import main
+from web_ui.main import HubConnector
+
+def connect_to_fake_hub(command, reply_type, reply):
+    """A connector whose hub answers command with reply, sent in small pieces."""
+    ui_sock, hub_sock = socket.socketpair()
+    connector = HubConnector()
+    connector.control_socket, connector.connected = ui_sock, True
+
+    def hub():
+        assert MessageReader().feed(hub_sock.recv(65536))[0]["type"] == command
+        data = create_message(reply_type, reply)
+        for start in range(0, len(data), 1000):
+            hub_sock.sendall(data[start:start + 1000])
+            time.sleep(0.001)
+    threading.Thread(target=hub, daemon=True).start()
+    return connector, (ui_sock, hub_sock)
+
+def test_replies_longer_than_one_recv_are_read_whole():
+    clients = [{"address": f"('10.0.0.{i}', 5000)", "streams": [{"id": s, "width": 1920, "height": 1080}
+                                                                for s in range(4)]} for i in range(200)]
+    connector, socks = connect_to_fake_hub("get_clients", "clients", {"clients": clients})
+
+    assert connector.send_command("get_clients") == {"clients": clients}
+    for sock in socks:
+        sock.close()
+
+def test_long_transfer_lists_reach_the_browser():
+    transfers = [{"transfer": f"t{i}", "address": "('10.0.0.1', 5000)", "name": f"file-{i}.bin",
+                  "state": "done", "size": 1 << 30, "done": 1 << 30} for i in range(100)]
+    connector, socks = connect_to_fake_hub("get_transfers", "transfers", {"transfers": transfers})
+
+    with patch.object(main, "hub_connector", connector):
+        assert asyncio.run(main.get_transfers()) == {"transfers": transfers}
+    for sock in socks:
+        sock.close()
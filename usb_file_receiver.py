@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+USB File Receiver
+Receives files sent by working_usb_transfer.py / usb_file_transfer.py --resumable,
+acknowledging chunks and resuming interrupted transfers
+"""
+
+import argparse
+import os
+
+import usb.core
+import usb.util
+import usb.backend.libusb1
+
+from usb_transfer_engine import DEFAULT_MAX_PACKET, FileReceiver, PyUSBLink
+
+class USBFileReceiver:
+    def __init__(self, vid, pid, output_dir):
+        self.vid = vid
+        self.pid = pid
+        self.output_dir = output_dir
+        self.backend = None
+        self.device = None
+
+    def setup_backend(self):
+        """Setup libusb backend"""
+        try:
+            import libusb_package
+            self.backend = usb.backend.libusb1.get_backend(find_library=libusb_package.find_library)
+            print("✅ USB backend ready")
+            return True
+        except Exception as e:
+            print(f"❌ Backend setup failed: {e}")
+            return False
+
+    def find_device(self):
+        """Find and configure the device; None if it is not there"""
+        self.device = usb.core.find(idVendor=self.vid, idProduct=self.pid, backend=self.backend)
+        if self.device is not None:
+            try:
+                self.device.set_configuration()
+            except usb.core.USBError as e:
+                print(f"⚠️  Configuration warning: {e}")
+        return self.device
+
+    def find_bulk_endpoints(self):
+        """(OUT address, IN address, OUT wMaxPacketSize) of the first interface with both"""
+        for interface in self.device.get_active_configuration():
+            out_ep = in_ep = None
+            max_packet = DEFAULT_MAX_PACKET
+            for endpoint in interface:
+                if usb.util.endpoint_type(endpoint.bmAttributes) != usb.util.ENDPOINT_TYPE_BULK:
+                    continue
+                if usb.util.endpoint_direction(endpoint.bEndpointAddress) == usb.util.ENDPOINT_OUT:
+                    out_ep, max_packet = endpoint.bEndpointAddress, endpoint.wMaxPacketSize
+                else:
+                    in_ep = endpoint.bEndpointAddress
+            if out_ep is not None and in_ep is not None:
+                return out_ep, in_ep, max_packet
+        return None
+
+    def run(self):
+        """Receive files until interrupted"""
+        print("📥 USB FILE RECEIVER")
+        print("=" * 60)
+
+        if not self.setup_backend():
+            return False
+
+        print(f"🔍 Connecting to device {self.vid:04X}:{self.pid:04X}...")
+        if self.find_device() is None:
+            print("❌ Device not found!")
+            return False
+
+        endpoints = self.find_bulk_endpoints()
+        if endpoints is None:
+            print("❌ No interface with bulk IN and OUT endpoints")
+            return False
+        out_ep, in_ep, max_packet = endpoints
+        print(f"📡 Bulk OUT 0x{out_ep:02x}, IN 0x{in_ep:02x} (max packet: {max_packet})")
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        link = PyUSBLink(self.device, out_ep, in_ep, max_packet, find=self.find_device)
+        receiver = FileReceiver(link, self.output_dir)
+        print(f"📂 Saving files to {os.path.abspath(self.output_dir)}")
+        print("⏳ Waiting for files (Ctrl+C to stop)...")
+
+        try:
+            while True:
+                receiver.serve()
+        except KeyboardInterrupt:
+            print(f"\n👋 Stopped after {len(receiver.received)} file(s)")
+        finally:
+            usb.util.dispose_resources(self.device)
+        return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Receive files over a USB bulk link")
+    parser.add_argument("--vid", type=lambda v: int(v, 16), default=0x2B7E, help="Vendor id (hex)")
+    parser.add_argument("--pid", type=lambda v: int(v, 16), default=0x0134, help="Product id (hex)")
+    parser.add_argument("--output", default="received_files", help="Directory for received files")
+    args = parser.parse_args()
+    USBFileReceiver(args.vid, args.pid, args.output).run()
+
+if __name__ == "__main__":
+    main()
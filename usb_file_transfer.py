@@ -4,25 +4,28 @@ USB-C File Transfer Implementation
 Test sending files over the USB-C connection between computers
 """
 
+import argparse
 import usb.core
 import usb.util
 import usb.backend.libusb1
 import time
 import os
-import struct
-import hashlib
 import json
 from pathlib import Path
 
+from usb_transfer_engine import DEFAULT_MAX_PACKET, PyUSBLink, ResumableSender, StreamingSender
+
 # Target device from our detection
 TARGET_VID = 0x2B7E
 TARGET_PID = 0x0134
 
 class USBFileTransfer:
-    def __init__(self):
+    def __init__(self, resumable=False):
+        self.resumable = resumable  # Acknowledged, resumable protocol; needs usb_file_receiver.py on the other end
         self.device = None
         self.bulk_out = None
         self.bulk_in = None
+        self.bulk_out_max_packet = DEFAULT_MAX_PACKET
         self.backend = None
         self.setup_backend()
     
@@ -83,6 +86,16 @@ class USBFileTransfer:
             print(f"❌ Connection failed: {e}")
             return False
     
+    def reconnect(self):
+        """Find the device again after an unplug, for resuming a transfer"""
+        self.device = usb.core.find(idVendor=TARGET_VID, idProduct=TARGET_PID, backend=self.backend)
+        if self.device is not None:
+            try:
+                self.device.set_configuration()
+            except usb.core.USBError:
+                pass
+        return self.device
+    
     def find_endpoints(self):
         """Find bulk endpoints for communication"""
         print("🔍 Searching for communication endpoints...")
@@ -101,6 +114,7 @@ class USBFileTransfer:
                     if ep_type == usb.util.ENDPOINT_TYPE_BULK:
                         if direction == usb.util.ENDPOINT_OUT:
                             self.bulk_out = ep_addr
+                            self.bulk_out_max_packet = endpoint.wMaxPacketSize
                             print(f"✅ Found BULK OUT endpoint: 0x{ep_addr:02x}")
                         elif direction == usb.util.ENDPOINT_IN:
                             self.bulk_in = ep_addr
@@ -141,6 +155,12 @@ class USBFileTransfer:
                 print(f"❌ Send failed: {e}")
                 return 0
     
+    def _write_chunk(self, data):
+        """Write one chunk of a file transfer; errors are raised, not printed per chunk"""
+        if self.bulk_out is None:
+            return self.send_raw_data(data)  # Finds a working endpoint first
+        return self.device.write(self.bulk_out, data, 5000)
+    
     def receive_raw_data(self, size=1024, timeout=5000):
         """Receive raw data from device"""
         if self.bulk_in is None:
@@ -178,69 +198,54 @@ class USBFileTransfer:
             return False
         
         try:
-            # Read file
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-            
-            file_size = len(file_data)
+            file_size = os.path.getsize(file_path)
             file_name = os.path.basename(file_path)
-            file_hash = hashlib.md5(file_data).hexdigest()
             
             print(f"📊 File info:")
             print(f"   Name: {file_name}")
             print(f"   Size: {file_size} bytes")
-            print(f"   Hash: {file_hash}")
             
             # Create file transfer protocol
-            # Format: [HEADER][FILENAME][DATA]
+            # Format: [4 bytes header size][header][file data][4 bytes trailer size][trailer]
+            # The file is streamed from disk, so its hash goes in the trailer
             header = {
                 'magic': 'NETKVMFILE',
-                'version': 1,
+                'version': 2,
                 'filename': file_name,
                 'filesize': file_size,
-                'hash': file_hash,
                 'timestamp': int(time.time())
             }
             
-            header_json = json.dumps(header).encode('utf-8')
-            header_size = len(header_json)
-            
-            # Protocol: [4 bytes header size][header][file data]
-            packet = struct.pack('<I', header_size) + header_json + file_data
-            
-            print(f"📦 Packet info:")
-            print(f"   Header size: {header_size} bytes")
-            print(f"   Total packet: {len(packet)} bytes")
-            
-            # Send the packet
-            print(f"\n📤 Sending file...")
+            if self.resumable:
+                # Chunks are acknowledged and an interrupted transfer resumes. Legacy receivers would take the
+                # OFFER for data, so there is no falling back to the plain stream on this link.
+                if self.bulk_in is None:
+                    print("❌ The resumable protocol needs a bulk IN endpoint")
+                    return False
+                link = PyUSBLink(self.device, self.bulk_out, self.bulk_in, self.bulk_out_max_packet,
+                                 find=self.reconnect)
+                resumable = ResumableSender(link, max_packet=self.bulk_out_max_packet, hash_name='md5')
+                offset = resumable.offer(file_path, header)
+                if offset is not None:
+                    print(f"🤝 Receiver ready at byte {offset:,}")
+                    if not resumable.send_file(file_path, header, offset):
+                        return False
+                    print(f"✅ File sent and verified by the receiver!")
+                    print(f"   Total bytes sent: {resumable.bytes_written}")
+                    print(f"   Hash: {resumable.file_hash}")
+                    return True
+                print("⏰ No receiver answered; is usb_file_receiver.py running on the other end?")
+                return False
             
-            # Send in chunks for large files
-            chunk_size = 1024  # 1KB chunks
-            sent_bytes = 0
+            sender = StreamingSender(self._write_chunk, max_packet=self.bulk_out_max_packet, hash_name='md5')
+            print(f"\n📤 Sending file in {sender.chunk_size:,}-byte chunks...")
             
-            for i in range(0, len(packet), chunk_size):
-                chunk = packet[i:i + chunk_size]
-                
-                try:
-                    result = self.send_raw_data(chunk)
-                    if result > 0:
-                        sent_bytes += result
-                        progress = (sent_bytes / len(packet)) * 100
-                        print(f"   Progress: {progress:.1f}% ({sent_bytes}/{len(packet)} bytes)")
-                    else:
-                        print(f"❌ Failed to send chunk {i//chunk_size + 1}")
-                        return False
-                    
-                    # Small delay between chunks
-                    time.sleep(0.01)
-                    
-                except Exception as e:
-                    print(f"❌ Error sending chunk: {e}")
-                    return False
+            if not sender.send_file(file_path, header):
+                return False
             
             print(f"✅ File sent successfully!")
-            print(f"   Total bytes sent: {sent_bytes}")
+            print(f"   Total bytes sent: {sender.sent_bytes}")
+            print(f"   Hash: {sender.file_hash}")
             
             # Try to get acknowledgment
             print(f"\n📥 Waiting for acknowledgment...")
@@ -333,12 +338,16 @@ def main():
     print("Testing real file transfer over USB-C connection")
     print("This will prove the USB communication works!")
     print()
+    parser = argparse.ArgumentParser(description="Send a test file over USB")
+    parser.add_argument("--resumable", action="store_true",
+                        help="Acknowledged, resumable transfer to usb_file_receiver.py")
+    args = parser.parse_args()
     
     # Create test file
     test_file = create_test_file()
     
     # Initialize USB transfer
-    usb_transfer = USBFileTransfer()
+    usb_transfer = USBFileTransfer(resumable=args.resumable)
     
     try:
         # Connect to device
@@ -7,11 +7,12 @@ Alternative approaches for USB communication on Windows
 import time
 import os
 import json
-import hashlib
 import subprocess
 import tempfile
 from pathlib import Path
 
+from usb_transfer_engine import StreamingSender
+
 class WindowsUSBTransfer:
     def __init__(self):
         self.target_vid = "2B7E"
@@ -102,35 +103,30 @@ class WindowsUSBTransfer:
             self.temp_dir = tempfile.mkdtemp(prefix="netkvmswitch_")
             print(f"📂 Created temp dir: {self.temp_dir}")
             
-            # Read the source file
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-            
             file_name = os.path.basename(file_path)
-            file_size = len(file_data)
-            file_hash = hashlib.md5(file_data).hexdigest()
+            file_size = os.path.getsize(file_path)
             
             print(f"📊 File to transfer:")
             print(f"   Name: {file_name}")
             print(f"   Size: {file_size} bytes")
-            print(f"   Hash: {file_hash}")
             
-            # Create transfer packet
-            transfer_data = {
+            # Same framing as the bulk transfer scripts, streamed from disk instead of hex-encoded in JSON
+            header = {
                 'magic': 'NETKVMSWITCH_FILE',
-                'version': 1,
+                'version': 2,
                 'timestamp': int(time.time()),
                 'source_file': file_name,
-                'file_size': file_size,
-                'file_hash': file_hash,
-                'data': file_data.hex()  # Hex encode for JSON safety
+                'file_size': file_size
             }
             
             # Save transfer file
-            transfer_file = os.path.join(self.temp_dir, f"transfer_{int(time.time())}.json")
-            with open(transfer_file, 'w') as f:
-                json.dump(transfer_data, f, indent=2)
+            transfer_file = os.path.join(self.temp_dir, f"transfer_{int(time.time())}.nkvm")
+            with open(transfer_file, 'wb') as out:
+                sender = StreamingSender(out.write, hash_name='md5', progress=None)
+                if not sender.send_file(file_path, header):
+                    return False
             
+            print(f"   Hash: {sender.file_hash}")
             print(f"✅ Created transfer file: {transfer_file}")
             print(f"📦 Transfer packet size: {os.path.getsize(transfer_file)} bytes")
             
@@ -220,16 +216,14 @@ class WindowsUSBTransfer:
         print(f"📞 Pipe name: {pipe_name}")
         
         try:
-            # Read file data
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
+            data_size = os.path.getsize(file_path)
             
-            print(f"📊 Preparing to send {len(file_data)} bytes via named pipe...")
+            print(f"📊 Preparing to send {data_size} bytes via named pipe...")
             
             # For now, just create the pipe info file
             pipe_info = {
                 'pipe_name': pipe_name,
-                'data_size': len(file_data),
+                'data_size': data_size,
                 'timestamp': int(time.time()),
                 'status': 'ready_to_send'
             }
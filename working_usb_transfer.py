@@ -4,17 +4,20 @@ Working USB File Transfer Implementation
 This will work after installing WinUSB driver with Zadig
 """
 
+import argparse
 import usb.core
 import usb.util
 import usb.backend.libusb1
 import time
 import os
 import json
-import hashlib
 from pathlib import Path
 
+from usb_transfer_engine import PyUSBLink, ResumableSender, StreamingSender
+
 class WorkingUSBTransfer:
-    def __init__(self):
+    def __init__(self, resumable=False):
+        self.resumable = resumable  # Acknowledged, resumable protocol; needs usb_file_receiver.py on the other end
         self.device = None
         self.backend = None
         self.target_vid = 0x2B7E  # Your device VID
@@ -70,6 +73,16 @@ class WorkingUSBTransfer:
             print(f"❌ Connection failed: {e}")
             return False
     
+    def reconnect_device(self):
+        """Find the device again after an unplug, for resuming a transfer"""
+        self.device = usb.core.find(idVendor=self.target_vid, idProduct=self.target_pid, backend=self.backend)
+        if self.device is not None:
+            try:
+                self.device.set_configuration()
+            except usb.core.USBError:
+                pass
+        return self.device
+    
     def find_endpoints(self):
         """Discover available endpoints"""
         print("🔍 Discovering communication endpoints...")
@@ -143,33 +156,9 @@ class WorkingUSBTransfer:
         print("=" * 50)
         
         try:
-            # Read file
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-            
             file_name = os.path.basename(file_path)
-            file_size = len(file_data)
-            file_hash = hashlib.sha256(file_data).hexdigest()[:16]
-            
+            file_size = os.path.getsize(file_path)
             print(f"📊 File: {file_name} ({file_size} bytes)")
-            print(f"🔐 Hash: {file_hash}")
-            
-            # Create transfer packet
-            header = {
-                'magic': 'NKVMFILE',
-                'name': file_name,
-                'size': file_size,
-                'hash': file_hash,
-                'timestamp': int(time.time())
-            }
-            
-            header_json = json.dumps(header, separators=(',', ':')).encode('utf-8')
-            header_size = len(header_json)
-            
-            # Packet format: [4-byte header size][header][file data]
-            packet = header_size.to_bytes(4, 'little') + header_json + file_data
-            
-            print(f"📦 Total packet: {len(packet)} bytes")
             
             # Get output endpoint
             out_endpoints = self.endpoints[interface_num]['out']
@@ -182,30 +171,42 @@ class WorkingUSBTransfer:
             
             print(f"📤 Using endpoint 0x{out_ep:02x} (max packet: {max_packet})")
             
-            # Send data in chunks
-            chunk_size = min(max_packet, 1024)  # Don't exceed max packet size
-            sent_bytes = 0
+            # Streamed from disk in whole packets; the hash follows the data in the trailer
+            header = {
+                'magic': 'NKVMFILE',
+                'name': file_name,
+                'size': file_size,
+                'timestamp': int(time.time())
+            }
+            in_endpoints = self.endpoints[interface_num]['in']
+            if self.resumable:
+                # Chunks are acknowledged and an interrupted transfer resumes. Legacy receivers would take the
+                # OFFER for data, so there is no falling back to the plain stream on this link.
+                if not in_endpoints:
+                    print("❌ The resumable protocol needs a bulk IN endpoint")
+                    return False
+                link = PyUSBLink(self.device, out_ep, in_endpoints[0]['address'], max_packet, find=self.reconnect_device)
+                resumable = ResumableSender(link, max_packet=max_packet, hash_name='sha256', hash_length=16)
+                offset = resumable.offer(file_path, header)
+                if offset is not None:
+                    print(f"🤝 Receiver ready at byte {offset:,}")
+                    if not resumable.send_file(file_path, header, offset):
+                        return False
+                    print(f"🔐 Hash: {resumable.file_hash} (verified by the receiver)")
+                    print(f"✅ File sent successfully! ({resumable.bytes_written:,} bytes written)")
+                    return True
+                print("⏰ No receiver answered; is usb_file_receiver.py running on the other end?")
+                return False
             
-            print(f"🚀 Sending in {chunk_size}-byte chunks...")
+            sender = StreamingSender(lambda data: self.device.write(out_ep, data, timeout=5000),
+                                     max_packet=max_packet, hash_name='sha256', hash_length=16)
+            print(f"🚀 Sending in {sender.chunk_size:,}-byte chunks...")
             
-            for i in range(0, len(packet), chunk_size):
-                chunk = packet[i:i + chunk_size]
-                
-                try:
-                    result = self.device.write(out_ep, chunk, timeout=5000)
-                    sent_bytes += len(chunk)
-                    
-                    progress = (sent_bytes / len(packet)) * 100
-                    print(f"   📈 {progress:5.1f}% ({sent_bytes:,}/{len(packet):,} bytes)")
-                    
-                    # Small delay to prevent overwhelming the device
-                    time.sleep(0.01)
-                    
-                except usb.core.USBError as e:
-                    print(f"❌ Send error at byte {sent_bytes}: {e}")
-                    return False
+            if not sender.send_file(file_path, header):
+                return False
             
-            print(f"✅ File sent successfully! ({sent_bytes:,} bytes)")
+            print(f"🔐 Hash: {sender.file_hash}")
+            print(f"✅ File sent successfully! ({sender.sent_bytes:,} bytes)")
             
             # Try to receive acknowledgment
             self.try_receive_ack(interface_num)
@@ -311,7 +312,7 @@ Technical details:
 - Transfer method: USB bulk endpoints
 - Driver: WinUSB (via Zadig)
 - Protocol: Custom NetKVMSwitch file transfer
-- Packet format: [size][header][data]
+- Packet format: [size][header][data][size][trailer]
 
 Next: Implement KVM control protocol over this connection.
 """
@@ -328,12 +329,16 @@ def main():
     print("🚀 WORKING USB FILE TRANSFER")
     print("This version should work after installing WinUSB driver!")
     print()
+    parser = argparse.ArgumentParser(description="Send a test file over USB")
+    parser.add_argument("--resumable", action="store_true",
+                        help="Acknowledged, resumable transfer to usb_file_receiver.py")
+    args = parser.parse_args()
     
     # Create test file
     test_file = create_test_file()
     
     # Run transfer test
-    usb_transfer = WorkingUSBTransfer()
+    usb_transfer = WorkingUSBTransfer(resumable=args.resumable)
     
     try:
         success = usb_transfer.test_file_transfer(test_file)